@@ -1,3 +1,3 @@
-set(pyfiles "")
+set(pyfiles "${CMAKE_CURRENT_SOURCE_DIR}/benchmark_hmc.py")
 set(cppfiles "")
 set(cudafiles "")
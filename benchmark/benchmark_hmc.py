@@ -0,0 +1,358 @@
+"""Benchmark the throughput and efficiency of HMC sampling.
+
+Each system is set up at each requested dimension, and for each metric type
+the following are measured:
+
+- `raw_evals_per_sec`: rate of `sf.evaluate(True)` alone
+- `grad_evals_per_sec`: rate of log density and gradient evaluations in the
+  free space, including transforms and marshalling
+- `overhead_per_eval`: difference in time per evaluation between the two
+- `warmup_time`: time of the warm-up
+- `sample_time`: time of sampling
+- `min_ess_bulk`, `ess_per_sec`: the minimum bulk effective sample size of
+  any variable, and that divided by the sampling time
+
+Results are written as JSON lines, one record per system, dimension and
+metric, with sorted keys. Pass a previous output file with `--compare` to
+print the ratio of each quantity to the previous run.
+
+    python benchmark_hmc.py --quick --output results.jsonl
+"""
+
+import argparse
+import json
+import sys
+from timeit import default_timer as timer
+
+import numpy as np
+
+import IMP
+import IMP.algebra
+import IMP.core
+import IMP.isd
+import IMP.hmc
+from IMP.hmc.defaults import setup_warmup_hmc
+from IMP.hmc.log_density import LogDensity, TransformedLogDensity
+from IMP.hmc.parallel import seed_all
+from IMP.hmc.variables import OptimizedVariables
+
+FORMAT_VERSION = 1
+
+QUANTITIES = (
+    "raw_evals_per_sec",
+    "grad_evals_per_sec",
+    "overhead_per_eval",
+    "warmup_time",
+    "sample_time",
+    "min_ess_bulk",
+    "ess_per_sec",
+)
+
+
+def setup_normal(m, n):
+    rs = []
+    for i in range(n):
+        p = IMP.isd.Nuisance.setup_particle(IMP.Particle(m))
+        p.set_nuisance_is_optimized(True)
+        p.set_nuisance(np.random.normal())
+        rs.append(IMP.isd.GaussianRestraint(p.get_particle(), 0.0, 1.0))
+    return IMP.core.RestraintsScoringFunction(IMP.RestraintSet(rs, 1.0))
+
+
+class vonMisesFisherRestraint(IMP.Restraint):
+    def __init__(self, x, mu, kappa):
+        self.x = IMP.core.Direction(x)
+        super().__init__(self.x.get_model(), "vonMisesFisherRestraint%1%")
+        self.km = kappa * np.array(mu, dtype=np.double)
+
+    def do_add_score_and_derivatives(self, sa):
+        score = -self.km.dot(self.x.get_direction())
+        if sa.get_derivative_accumulator():
+            self.x.add_to_direction_derivatives(
+                -self.km, sa.get_derivative_accumulator()
+            )
+        sa.add_score(score)
+
+    def do_get_inputs(self):
+        return [self.x.get_particle()]
+
+
+def setup_vmf(m, n):
+    rs = []
+    for i in range(n):
+        p = IMP.core.Direction.setup_particle(
+            IMP.Particle(m), IMP.algebra.get_random_vector_on_unit_sphere()
+        )
+        p.set_direction_is_optimized(True)
+        rs.append(vonMisesFisherRestraint(p, [0.0, 0.0, 1.0], 50.0))
+    return IMP.core.RestraintsScoringFunction(IMP.RestraintSet(rs, 1.0))
+
+
+class DirichletRestraint(IMP.Restraint):
+    def __init__(self, x, alpha):
+        self.x = IMP.isd.Weight(x)
+        super().__init__(self.x.get_model(), "DirichletRestraint%1%")
+        self.beta = np.array(alpha, dtype=np.double) - 1
+
+    def do_add_score_and_derivatives(self, sa):
+        w = np.array(self.x.get_weights(), dtype=np.double)
+        score = -np.dot(self.beta, np.log(w))
+        if sa.get_derivative_accumulator():
+            self.x.add_to_weights_derivatives(
+                -self.beta / w, sa.get_derivative_accumulator()
+            )
+        sa.add_score(score)
+
+    def do_get_inputs(self):
+        return [self.x.get_particle()]
+
+
+def setup_dirichlet(m, n):
+    alpha = 4.0 * 2.0 ** np.arange(n)
+    w = -np.log(np.random.uniform(size=n))
+    p = IMP.isd.Weight.setup_particle(IMP.Particle(m), w / w.sum())
+    p.set_weights_are_optimized(True)
+    r = DirichletRestraint(p, alpha)
+    return IMP.core.RestraintsScoringFunction(IMP.RestraintSet([r], 1.0))
+
+
+def setup_xyz(m, n):
+    """`n` particles harmonically restrained to random points."""
+    rs = []
+    for i in range(n):
+        center = IMP.algebra.get_random_vector_in(
+            IMP.algebra.BoundingBox3D(
+                IMP.algebra.Vector3D(-10, -10, -10),
+                IMP.algebra.Vector3D(10, 10, 10),
+            )
+        )
+        p = IMP.core.XYZ.setup_particle(
+            IMP.Particle(m), center + IMP.algebra.Vector3D(np.random.normal(size=3))
+        )
+        p.set_coordinates_are_optimized(True)
+        score = IMP.core.DistanceToSingletonScore(
+            IMP.core.Harmonic(0.0, 1.0), center
+        )
+        rs.append(IMP.core.SingletonRestraint(m, score, p))
+    return IMP.core.RestraintsScoringFunction(IMP.RestraintSet(rs, 1.0))
+
+
+def setup_rigid_bodies(m, n, nmembers=4):
+    """`n` rigid bodies, each of whose members is harmonically restrained to
+    a random point."""
+    rs = []
+    for i in range(n):
+        members = []
+        for j in range(nmembers):
+            p = IMP.core.XYZR.setup_particle(
+                IMP.Particle(m),
+                IMP.algebra.Sphere3D(
+                    IMP.algebra.Vector3D(3 * np.random.normal(size=3)), 1.0
+                ),
+            )
+            members.append(p)
+        rb = IMP.core.RigidBody.setup_particle(IMP.Particle(m), members)
+        rb.set_coordinates_are_optimized(True)
+        for p in members:
+            center = IMP.core.XYZ(p).get_coordinates() + IMP.algebra.Vector3D(
+                np.random.normal(size=3)
+            )
+            score = IMP.core.DistanceToSingletonScore(
+                IMP.core.Harmonic(0.0, 1.0), center
+            )
+            rs.append(IMP.core.SingletonRestraint(m, score, p))
+    return IMP.core.RestraintsScoringFunction(IMP.RestraintSet(rs, 1.0))
+
+
+SYSTEMS = {
+    "normal": setup_normal,
+    "vmf": setup_vmf,
+    "dirichlet": setup_dirichlet,
+    "xyz": setup_xyz,
+    "rigid_body": setup_rigid_bodies,
+}
+
+
+def time_evaluations(sf, nevals):
+    """Time raw scoring and log density evaluations in the free space."""
+    m = sf.get_model()
+    opt_vars = OptimizedVariables(m)
+    transform = opt_vars.get_transformation()
+    logpdf = TransformedLogDensity(
+        LogDensity(sf, opt_vars.get_interface(), cache_size=0), transform
+    )
+    y = transform.free(opt_vars.get_interface().get_values())
+
+    sf.evaluate(True)
+    start = timer()
+    for _ in range(nevals):
+        sf.evaluate(True)
+    raw_time = (timer() - start) / nevals
+
+    logpdf.get_logpdf_with_gradient(y)
+    start = timer()
+    for _ in range(nevals):
+        logpdf.get_logpdf_with_gradient(y)
+    grad_time = (timer() - start) / nevals
+
+    return {
+        "raw_evals_per_sec": 1 / raw_time,
+        "grad_evals_per_sec": 1 / grad_time,
+        "overhead_per_eval": grad_time - raw_time,
+    }
+
+
+def get_min_ess_bulk(samples):
+    import arviz as az
+
+    dataset = az.convert_to_dataset(np.asarray(samples)[np.newaxis])
+    ess = az.ess(dataset, method="bulk")
+    return float(ess.to_array().values.min())
+
+
+def run_benchmark(system, n, metric, engine, nadapt, nsample, nevals, seed):
+    seed_all(seed)
+    m = IMP.Model()
+    sf = SYSTEMS[system](m, n)
+
+    result = time_evaluations(sf, nevals)
+
+    start = timer()
+    hmc = setup_warmup_hmc(
+        sf, metric=metric, nadapt=nadapt, engine=engine, log=lambda msg: None
+    )
+    if nadapt > 0:
+        hmc = hmc[0]
+    result["warmup_time"] = timer() - start
+
+    hmc.set_save_samples(True)
+    start = timer()
+    hmc.optimize(nsample)
+    result["sample_time"] = timer() - start
+
+    ess = get_min_ess_bulk(hmc.sample_saver.get_values_numpy())
+    result["min_ess_bulk"] = ess
+    result["ess_per_sec"] = ess / result["sample_time"]
+
+    return {
+        "format_version": FORMAT_VERSION,
+        "system": system,
+        "size": n,
+        "ndim": hmc.hamiltonian.logpdf.get_dimension(),
+        "metric": metric,
+        "engine": engine,
+        "nadapt": nadapt,
+        "nsample": nsample,
+        "seed": seed,
+        "imp_version": IMP.get_module_version(),
+        "results": result,
+    }
+
+
+def get_record_key(record):
+    return tuple(
+        record[k] for k in ("system", "size", "metric", "engine", "nsample")
+    )
+
+
+def compare(records, path, out=sys.stdout):
+    """Print the ratio of each quantity to that of a previous run."""
+    with open(path) as fh:
+        baseline = [json.loads(line) for line in fh if line.strip()]
+    baseline = {get_record_key(r): r for r in baseline}
+    for record in records:
+        base = baseline.get(get_record_key(record))
+        if base is None:
+            continue
+        ratios = [
+            "{0}={1:.3g}".format(
+                k, record["results"][k] / base["results"][k]
+            )
+            for k in QUANTITIES
+            if base["results"].get(k)
+        ]
+        out.write(
+            "{0} {1} {2} {3}: {4}\n".format(
+                record["system"],
+                record["size"],
+                record["metric"],
+                record["engine"],
+                " ".join(ratios),
+            )
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--systems", nargs="+", default=sorted(SYSTEMS), choices=sorted(SYSTEMS)
+    )
+    parser.add_argument(
+        "--sizes", nargs="+", type=int, default=[1, 10, 100],
+        help="Number of particles or variables of each system",
+    )
+    parser.add_argument(
+        "--metrics", nargs="+", default=["unit", "diag", "dense"],
+        choices=["unit", "diag", "dense", "lowrank", "block"],
+        help="Metrics to benchmark; lowrank and block are only run with "
+        "the numpy engine",
+    )
+    parser.add_argument(
+        "--engines", nargs="+", default=["julia"], choices=["julia", "numpy"]
+    )
+    parser.add_argument("--nadapt", type=int, default=1000)
+    parser.add_argument("--nsample", type=int, default=1000)
+    parser.add_argument("--nevals", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument(
+        "--quick", action="store_true",
+        help="Run a small subset suitable for a quick regression check",
+    )
+    parser.add_argument("--output", help="Write results to this file")
+    parser.add_argument(
+        "--compare", metavar="BASELINE",
+        help="Compare with the results of a previous run",
+    )
+    args = parser.parse_args()
+    if args.quick:
+        args.sizes = [1, 10]
+        args.metrics = ["diag"]
+        args.nadapt = 200
+        args.nsample = 200
+        args.nevals = 200
+    return args
+
+
+def main():
+    args = parse_args()
+    out = open(args.output, "w") if args.output else sys.stdout
+    records = []
+    try:
+        for system in args.systems:
+            for n in args.sizes:
+                if system == "dirichlet" and n < 2:
+                    continue
+                for engine in args.engines:
+                    for metric in args.metrics:
+                        # structured metrics need the numpy engine
+                        if engine == "julia" and metric in (
+                            "lowrank",
+                            "block",
+                        ):
+                            continue
+                        record = run_benchmark(
+                            system, n, metric, engine, args.nadapt,
+                            args.nsample, args.nevals, args.seed,
+                        )
+                        records.append(record)
+                        out.write(json.dumps(record, sort_keys=True) + "\n")
+                        out.flush()
+    finally:
+        if args.output:
+            out.close()
+    if args.compare:
+        compare(records, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,17 +20,58 @@
 
 IMPHMC_BEGIN_NAMESPACE
 
+//! Store attributes of the model.
+/** Each update appends one row of values to a contiguous row-major buffer
+    of shape (number of samples, dimension), which grows geometrically.
+    Optionally only a subset of the interface's values is recorded. To thin
+    the samples, use set_period().
+
+    From Python, get_values_numpy() returns the buffer as a NumPy array
+    without copying. The array is only valid until the next update or
+    clear(), and while this object is alive.
+ */
 class IMPHMCEXPORT SaveAttributesOptimizerState : public OptimizerState {
   PointerMember<ValueGradientInterface> interface_;
-  FloatsList vs_;
+  Ints indexes_;
+  Floats data_;
+  mutable Floats row_;
+  unsigned int nsamples_;
+
+  void grow(unsigned int nsamples);
 
  public:
   SaveAttributesOptimizerState(ValueGradientInterface* interface);
 
+  //! Only record the values at the given indexes of the interface.
+  SaveAttributesOptimizerState(ValueGradientInterface* interface,
+                               const Ints& indexes);
+
   ValueGradientInterface* get_interface();
 
+  //! Get the recorded indexes of the interface (empty if all are recorded).
+  Ints get_indexes() const;
+
+  //! Get the number of values recorded per sample.
+  unsigned int get_dimension() const;
+
+  unsigned int get_number_of_samples() const;
+
+  //! Preallocate storage for at least the given number of samples.
+  void reserve(unsigned int nsamples);
+
+  //! Remove all recorded samples, keeping the allocated storage.
+  void clear();
+
   FloatsList get_values() const;
 
+  //! Append samples stored row-major in a buffer of length n.
+  void add_values_from(const double* data, unsigned int n);
+
+#ifndef SWIG
+  //! Get a pointer to the contiguous sample buffer.
+  const double* get_data() const;
+#endif
+
  protected:
   virtual void do_update(unsigned int update_number) override;
 
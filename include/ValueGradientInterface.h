@@ -18,13 +18,27 @@
 IMPHMC_BEGIN_NAMESPACE
 
 //! Utility for setting/getting values and getting the gradient
+/** Values are stored in a flat vector whose i-th element is the attribute
+    with the i-th float key of the i-th particle. Internally the elements are
+    grouped by key so that each attribute table is traversed in one pass.
+
+    The buffer methods (get_values_into(), set_values_from() and
+    get_gradient_into()) read from or write to caller-owned memory. From
+    Python they accept any C-contiguous float64 buffer, such as a NumPy array,
+    without copying.
+ */
 class IMPHMCEXPORT ValueGradientInterface : public IMP::ModelObject {
  private:
   IMP::FloatKeys fks_;
   IMP::ParticleIndexes pis_;
+  IMP::FloatKeys group_keys_;
+  IMP::Vector<IMP::ParticleIndexes> group_pis_;
+  IMP::Vector<IMP::Ints> group_slots_;
   mutable IMP::Vector<double> x_;
   mutable IMP::Vector<double> gradx_;
 
+  void setup_key_groups();
+
  public:
   ValueGradientInterface(IMP::Model* m, const IMP::FloatKeys& fks,
                          const IMP::ParticleIndexes& pis,
@@ -42,6 +56,15 @@ class IMPHMCEXPORT ValueGradientInterface : public IMP::ModelObject {
 
   IMP::Vector<double> get_gradient() const;
 
+  //! Write the current values into a buffer of length n.
+  void get_values_into(double* data, unsigned int n) const;
+
+  //! Set the values from a buffer of length n.
+  void set_values_from(const double* data, unsigned int n);
+
+  //! Write the current gradient into a buffer of length n.
+  void get_gradient_into(double* data, unsigned int n) const;
+
   virtual IMP::ModelObjectsTemp do_get_inputs() const override;
 
   virtual IMP::ModelObjectsTemp do_get_outputs() const override;
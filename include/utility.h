@@ -0,0 +1,31 @@
+/**
+ *  \file IMP/hmc/utility.h
+ *  \brief Utility functions for finding optimized attributes.
+ *
+ *  Copyright 2007-2019 IMP Inventors. All rights reserved.
+ *
+ */
+
+#ifndef IMPHMC_UTILITY_H
+#define IMPHMC_UTILITY_H
+
+#include <IMP/hmc/hmc_config.h>
+#include <IMP/Model.h>
+#include <IMP/base_types.h>
+
+IMPHMC_BEGIN_NAMESPACE
+
+//! Get the indexes of all particles on which the attribute is optimized.
+/** The particles are returned in the order of Model::get_particle_indexes().
+ */
+IMPHMCEXPORT ParticleIndexes get_optimized_particle_indexes(Model* m,
+                                                            FloatKey k);
+
+//! Get the indexes of the given particles on which the attribute is optimized.
+/** The order of the given particles is preserved. */
+IMPHMCEXPORT ParticleIndexes get_optimized_particle_indexes(
+    Model* m, FloatKey k, const ParticleIndexes& pis);
+
+IMPHMC_END_NAMESPACE
+
+#endif /* IMPHMC_UTILITY_H */
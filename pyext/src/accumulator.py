@@ -2,47 +2,174 @@ import numpy as np
 
 
 class SampleAccumulator(object):
-    def __init__(self, keys):
-        self.keys = keys
-        self.values = []
+
+    """Columnar store of samples with one typed array per key.
+
+    Columns are grown in chunks, so adding a sample does not allocate in the
+    common case. `dtypes`, if given, are the types of the columns; otherwise
+    columns whose first value is a boolean are boolean and all others are
+    double precision floats."""
+
+    def __init__(self, keys, chunk_size=1024, dtypes=None):
+        self.keys = list(keys)
+        self.key_indexes = {k: i for i, k in enumerate(self.keys)}
+        self.chunk_size = chunk_size
+        self.dtypes = None if dtypes is None else list(map(np.dtype, dtypes))
+        self.columns = None
+        self.nsamples = 0
+
+    def __len__(self):
+        return self.nsamples
+
+    def _allocate(self, values):
+        if self.dtypes is None:
+            self.dtypes = [
+                np.dtype(bool if np.asarray(v).dtype == bool else np.double)
+                for v in values
+            ]
+        self.columns = [
+            np.empty(self.chunk_size, dtype=dtype) for dtype in self.dtypes
+        ]
+
+    def _reserve(self, nsamples):
+        capacity = len(self.columns[0]) if self.columns else 0
+        if nsamples <= capacity:
+            return
+        nchunks = -(-nsamples // self.chunk_size)
+        capacity = max(nchunks * self.chunk_size, 2 * capacity)
+        for i, col in enumerate(self.columns):
+            new_col = np.empty(capacity, dtype=col.dtype)
+            new_col[: self.nsamples] = col[: self.nsamples]
+            self.columns[i] = new_col
 
     def add_sample(self, values):
-        self.values.append(values)
+        if self.columns is None:
+            self._allocate(values)
+        self._reserve(self.nsamples + 1)
+        n = self.nsamples
+        for col, v in zip(self.columns, values):
+            col[n] = v
+        self.nsamples += 1
+
+    def add_samples(self, values):
+        """Add several samples at once from a sequence of columns."""
+        values = [np.asarray(v) for v in values]
+        m = len(values[0])
+        if m == 0:
+            return
+        if self.columns is None:
+            self._allocate([v[0] for v in values])
+        self._reserve(self.nsamples + m)
+        n = self.nsamples
+        for col, v in zip(self.columns, values):
+            col[n : n + m] = v
+        self.nsamples += m
 
-    def get_samples(self, key=None):
+    def get_samples(self, key=None, copy=True):
+        """Get the samples of `key`, or a dict of those of all keys.
+
+        If not `copy`, return views of the stored columns instead, which
+        are only valid until the accumulator is cleared."""
         if key is None:
-            return dict(zip(self.keys, map(np.array, zip(*self.values))))
-        i = self.keys.index(key)
-        return np.array([vals[i] for vals in self.values])
+            return {k: self.get_samples(k, copy=copy) for k in self.keys}
+        i = self.key_indexes[key]
+        if self.columns is None:
+            return np.empty(0, dtype=np.double)
+        column = self.columns[i][: self.nsamples]
+        return column.copy() if copy else column
 
     def clear(self):
-        self.values.clear()
+        self.nsamples = 0
 
 
 class StatisticsAccumulator(SampleAccumulator):
-    def __init__(self, keys):
-        super().__init__(keys)
-        self.means = np.zeros(len(keys), dtype=np.double)
+
+    """Store of per-transition statistics.
+
+    The running mean, variance, minimum and maximum of each statistic are
+    updated online with Welford's algorithm."""
+
+    def __init__(self, keys, chunk_size=1024, dtypes=None):
+        super().__init__(keys, chunk_size=chunk_size, dtypes=dtypes)
+        n = len(self.keys)
+        self.means = np.zeros(n, dtype=np.double)
+        self.m2 = np.zeros(n, dtype=np.double)
+        self.mins = np.full(n, np.inf)
+        self.maxs = np.full(n, -np.inf)
+        self._x = np.empty(n, dtype=np.double)
+        self._delta = np.empty(n, dtype=np.double)
+        self._tmp = np.empty(n, dtype=np.double)
         self.current = {}
 
+    def _update_moments(self, values):
+        x, delta, tmp = self._x, self._delta, self._tmp
+        x[:] = values
+        np.minimum(self.mins, x, out=self.mins)
+        np.maximum(self.maxs, x, out=self.maxs)
+        np.subtract(x, self.means, out=delta)
+        np.divide(delta, self.nsamples, out=tmp)
+        self.means += tmp
+        np.subtract(x, self.means, out=tmp)
+        tmp *= delta
+        self.m2 += tmp
+
     def add_sample(self, stats):
         values = list(stats.values())
+        if len(values) != len(self.keys):
+            raise ValueError(
+                "Expected {0} statistics, got {1}".format(
+                    len(self.keys), len(values)
+                )
+            )
         super().add_sample(values)
-        self.means += (np.asarray(values, dtype=np.double) - self.means) / len(
-            self.values
-        )
+        self._update_moments(values)
         self.current = dict(zip(self.keys, values))
 
+    def add_samples(self, values):
+        values = [np.asarray(v) for v in values]
+        nb = len(values[0])
+        if nb == 0:
+            return
+        na = self.nsamples
+        super().add_samples(values)
+        x = np.column_stack(values).astype(np.double)
+        n = na + nb
+        mean_b = x.mean(axis=0)
+        delta = mean_b - self.means
+        self.means += delta * (nb / n)
+        self.m2 += ((x - mean_b) ** 2).sum(axis=0) + delta ** 2 * (na * nb / n)
+        np.minimum(self.mins, x.min(axis=0), out=self.mins)
+        np.maximum(self.maxs, x.max(axis=0), out=self.maxs)
+        self.current = {k: v[-1] for k, v in zip(self.keys, values)}
+
     def get_mean_stats(self):
         return dict(zip(self.keys, self.means))
 
+    def get_variance_stats(self):
+        if self.nsamples < 2:
+            var = np.full_like(self.m2, np.nan)
+        else:
+            var = self.m2 / (self.nsamples - 1)
+        return dict(zip(self.keys, var))
+
+    def get_min_stats(self):
+        return dict(zip(self.keys, self.mins))
+
+    def get_max_stats(self):
+        return dict(zip(self.keys, self.maxs))
+
     def clear(self):
         super().clear()
         self.means = np.zeros_like(self.means)
+        self.m2 = np.zeros_like(self.m2)
+        self.mins = np.full_like(self.mins, np.inf)
+        self.maxs = np.full_like(self.maxs, -np.inf)
         self.current = {}
 
-    def log_current(self, title="HMC statistics:", prefix="    ", prec=3):
-        print(
+    def log_current(
+        self, title="HMC statistics:", prefix="    ", prec=3, log=print
+    ):
+        log(
             "{0}\n{1}".format(
                 title,
                 "\n".join(
@@ -54,8 +181,10 @@ class StatisticsAccumulator(SampleAccumulator):
             )
         )
 
-    def log_mean(self, title="Mean HMC statistics:", prefix="    ", prec=3):
-        print(
+    def log_mean(
+        self, title="Mean HMC statistics:", prefix="    ", prec=3, log=print
+    ):
+        log(
             "{0}\n{1}".format(
                 title,
                 "\n".join(
@@ -0,0 +1,289 @@
+"""Building blocks for step size and metric adaptation during warm-up.
+
+These do not depend on Julia and can be shared between chains and
+processes (all are picklable).
+"""
+
+import copy
+from collections import deque
+
+import numpy as np
+
+
+def get_slow_windows(nadapt, init_buffer=75, term_buffer=50, base_window=25):
+    """Get the slow (metric) adaptation windows of a Stan-style schedule.
+
+    Warm-up starts with an initial fast window of `init_buffer` steps where
+    only the step size is adapted, followed by slow windows of doubling size
+    starting at `base_window` steps, after each of which the metric is
+    updated, and ends with a final fast window of `term_buffer` steps.
+    Returns a list of `(start, end)` step ranges of the slow windows.
+    """
+    if nadapt < init_buffer + term_buffer + base_window:
+        init_buffer = int(0.15 * nadapt)
+        term_buffer = int(0.1 * nadapt)
+        base_window = nadapt - init_buffer - term_buffer
+    end_slow = nadapt - term_buffer
+    windows = []
+    start, size = init_buffer, base_window
+    while size > 0 and start < end_slow:
+        end = start + size
+        if end + 2 * size > end_slow:
+            end = end_slow
+        windows.append((start, end))
+        start, size = end, 2 * size
+    return windows
+
+
+class DualAveraging(object):
+
+    """Nesterov dual averaging of the log step size.
+
+    See Hoffman & Gelman, JMLR 15 (2014), algorithm 5."""
+
+    def __init__(
+        self, step_size, target=0.8, gamma=0.05, t0=10.0, kappa=0.75
+    ):
+        self.target = target
+        self.gamma = gamma
+        self.t0 = t0
+        self.kappa = kappa
+        self.restart(step_size)
+
+    def restart(self, step_size):
+        self.mu = np.log(10 * step_size)
+        self.counter = 0
+        self.s_bar = 0.0
+        self.x_bar = 0.0
+        self.step_size = step_size
+
+    def update(self, accept):
+        """Update with the acceptance rate of a transition and return the
+        new step size."""
+        accept = min(1.0, accept) if np.isfinite(accept) else 0.0
+        self.counter += 1
+        t = self.counter
+        eta = 1.0 / (t + self.t0)
+        self.s_bar = (1 - eta) * self.s_bar + eta * (self.target - accept)
+        x = self.mu - self.s_bar * np.sqrt(t) / self.gamma
+        x_eta = t ** -self.kappa
+        self.x_bar = x_eta * x + (1 - x_eta) * self.x_bar
+        self.step_size = np.exp(x)
+        return self.step_size
+
+    def get_final_step_size(self):
+        return np.exp(self.x_bar)
+
+
+class WelfordEstimator(object):
+
+    """Online estimate of the mean and (co)variance of positions."""
+
+    def __init__(self, n, dense=False):
+        self.n = n
+        self.dense = dense
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = np.zeros(self.n)
+        if self.dense:
+            self.m2 = np.zeros((self.n, self.n))
+        else:
+            self.m2 = np.zeros(self.n)
+
+    def add_sample(self, x):
+        x = np.asarray(x, dtype=np.double)
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        if self.dense:
+            self.m2 += np.outer(x - self.mean, delta)
+        else:
+            self.m2 += (x - self.mean) * delta
+
+    def merge(self, other):
+        """Merge the samples of another estimator into this one."""
+        if other.count == 0:
+            return
+        n = self.count + other.count
+        delta = other.mean - self.mean
+        w = self.count * other.count / n
+        if self.dense:
+            self.m2 += other.m2 + w * np.outer(delta, delta)
+        else:
+            self.m2 += other.m2 + w * delta ** 2
+        self.mean += delta * (other.count / n)
+        self.count = n
+
+    def get_variance(self, regularize=True):
+        """Get the estimated (co)variance.
+
+        If `regularize`, shrink it towards a small multiple of the identity
+        as Stan does."""
+        var = self.m2 / max(self.count - 1, 1)
+        if not regularize:
+            return var
+        n = self.count
+        shrunk = (n / (n + 5.0)) * var
+        if self.dense:
+            shrunk += 1e-3 * (5.0 / (n + 5.0)) * np.eye(self.n)
+        else:
+            shrunk += 1e-3 * (5.0 / (n + 5.0))
+        return shrunk
+
+
+def merge_estimators(estimators):
+    """Pool several estimators of the same kind (`WelfordEstimator` or one
+    of `IMP.hmc.metrics`) into a new one."""
+    pooled = copy.deepcopy(estimators[0])
+    for e in estimators[1:]:
+        pooled.merge(e)
+    return pooled
+
+
+def get_metric_change(old, new):
+    """Get the largest relative change in the variance of any variable
+    between two inverse metrics (vectors, matrices or metrics of
+    `IMP.hmc.metrics`), as an absolute log ratio."""
+    return float(
+        np.max(np.abs(np.log(_get_diagonal(new) / _get_diagonal(old))))
+    )
+
+
+def _get_diagonal(metric):
+    if hasattr(metric, "get_diagonal"):
+        return metric.get_diagonal()
+    metric = np.asarray(metric)
+    return np.diag(metric) if metric.ndim == 2 else metric
+
+
+def _make_estimator(metric, ndim, rank, blocks):
+    if metric == "lowrank":
+        from .metrics import LowRankEstimator
+
+        return LowRankEstimator(ndim, rank=rank)
+    elif metric == "block":
+        from .metrics import BlockEstimator
+
+        return BlockEstimator(ndim, blocks or [])
+    return WelfordEstimator(ndim, dense=metric == "dense")
+
+
+class WindowedAdaptation(object):
+
+    """Stan-style windowed adaptation of the step size and metric of one
+    chain, optionally ending early once both have converged.
+
+    The step size is adapted by dual averaging throughout. Positions visited
+    in each slow window (see `get_slow_windows`) are collected to estimate
+    the metric, which is updated at the end of the window, after which dual
+    averaging restarts.
+
+    If `early_stop`, once a slow window's metric estimate differs from the
+    previous one by less than `metric_tol` (see `get_metric_change`), the
+    remaining slow windows are skipped and the final fast window begins.
+    That window then ends as soon as the averaged log step size has varied
+    by less than `step_size_tol` over the last `step_size_window` steps.
+    Warm-up runs for at least `min_steps` (by default the shortest full
+    schedule, `init_buffer + base_window + term_buffer`) and at most
+    `nadapt` steps.
+
+    A "lowrank" metric is estimated with rank `rank`, and a "block" metric
+    with the given `blocks` of variable indexes (see `IMP.hmc.metrics`)."""
+
+    def __init__(
+        self,
+        nadapt,
+        ndim,
+        step_size,
+        metric="diag",
+        rank=10,
+        blocks=None,
+        target=0.8,
+        init_buffer=75,
+        term_buffer=50,
+        base_window=25,
+        early_stop=False,
+        min_steps=None,
+        metric_tol=0.1,
+        step_size_tol=0.02,
+        step_size_window=25,
+    ):
+        self.nadapt = nadapt
+        self.dual_averaging = DualAveraging(step_size, target=target)
+        if metric in ("diag", "dense", "lowrank", "block"):
+            self.estimator = _make_estimator(metric, ndim, rank, blocks)
+            self.windows = get_slow_windows(
+                nadapt,
+                init_buffer=init_buffer,
+                term_buffer=term_buffer,
+                base_window=base_window,
+            )
+        else:
+            self.estimator = None
+            self.windows = []
+        self.early_stop = early_stop
+        if min_steps is None:
+            min_steps = init_buffer + base_window + term_buffer
+        self.min_steps = min(min_steps, nadapt)
+        self.metric_tol = metric_tol
+        self.step_size_tol = step_size_tol
+        self.step_size_window = step_size_window
+        self.counter = 0
+        self.metric = None
+        self.metric_change = None
+        self.term_start = self.windows[-1][1] if self.windows else 0
+        self.log_step_sizes = deque(maxlen=step_size_window)
+        self.converged = False
+
+    def is_adapting(self):
+        return self.counter < self.nadapt and not self.converged
+
+    def is_step_size_converged(self):
+        steps = self.log_step_sizes
+        return (
+            len(steps) == steps.maxlen
+            and max(steps) - min(steps) < self.step_size_tol
+        )
+
+    def update(self, position, accept):
+        """Update with the position and acceptance rate of a transition.
+
+        Returns the new step size and, at the end of a slow window, the new
+        inverse metric (otherwise None). Once adaptation finishes, the
+        returned step size is the final averaged one."""
+        step = self.counter
+        self.counter += 1
+        step_size = self.dual_averaging.update(accept)
+        metric = None
+        for i, (start, end) in enumerate(self.windows):
+            if start <= step < end:
+                self.estimator.add_sample(position)
+                if self.counter == end:
+                    metric = self._end_window(i)
+                    self.dual_averaging.restart(step_size)
+                break
+
+        if self.counter > self.term_start:
+            self.log_step_sizes.append(self.dual_averaging.x_bar)
+            if (
+                self.early_stop
+                and self.counter >= self.min_steps
+                and self.is_step_size_converged()
+            ):
+                self.converged = True
+        if not self.is_adapting():
+            step_size = self.dual_averaging.get_final_step_size()
+        return step_size, metric
+
+    def _end_window(self, i):
+        metric = self.estimator.get_variance()
+        self.estimator.reset()
+        if self.metric is not None:
+            self.metric_change = get_metric_change(self.metric, metric)
+            if self.early_stop and self.metric_change < self.metric_tol:
+                self.windows = self.windows[: i + 1]
+                self.term_start = self.counter
+        self.metric = metric
+        return metric
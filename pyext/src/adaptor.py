@@ -1,60 +1,144 @@
 import datetime
 from timeit import default_timer as timer
 
-from .julia import Main, HMCUtilities, AdvancedHMC
+from . import checkpoint
+from .adaptation import (
+    DualAveraging,
+    WindowedAdaptation,
+    _make_estimator,
+    get_slow_windows,
+    merge_estimators,
+)
 
 
 class Adaptor(object):
 
     """Adapt the step size and metric during warm-up.
 
-    Currently just a thin wrapper for an `AdvancedHMC.StanHMCAdaptor`."""
+    Warm-up follows a Stan-style windowed schedule: an initial fast window
+    of `init_buffer` steps, slow windows of doubling size starting at
+    `base_window` steps, after each of which the metric is re-estimated, and
+    a final fast window of `term_buffer` steps. If `early_stop`, warm-up
+    ends once the metric and step size have converged, after at least
+    `min_steps` and at most `nadapt` steps. See
+    `IMP.hmc.adaptation.WindowedAdaptation`, which holds the state of the
+    adaptation for both engines.
 
-    def __init__(self, hmc, nadapt=2000, adapt_delta=0.8):
+    With a "lowrank" or "block" metric, `metric_rank` and `metric_blocks`
+    give the rank and the blocks of free variable indexes to estimate (see
+    `IMP.hmc.metrics` and `OptimizedVariables.get_blocks`)."""
+
+    def __init__(
+        self,
+        hmc,
+        nadapt=2000,
+        adapt_delta=0.8,
+        log=None,
+        metric_rank=10,
+        metric_blocks=None,
+        init_buffer=75,
+        term_buffer=50,
+        base_window=25,
+        early_stop=False,
+        min_steps=None,
+        metric_tol=0.1,
+        step_size_tol=0.02,
+        step_size_window=25,
+    ):
         self.hmc = hmc
+        self.log = hmc.log if log is None else log
+        self.schedule = dict(
+            init_buffer=init_buffer,
+            term_buffer=term_buffer,
+            base_window=base_window,
+            early_stop=early_stop,
+            min_steps=min_steps,
+            metric_tol=metric_tol,
+            step_size_tol=step_size_tol,
+            step_size_window=step_size_window,
+            rank=metric_rank,
+            blocks=metric_blocks,
+        )
         self.create_adaptor(nadapt, adapt_delta=adapt_delta)
         self.nadapt = nadapt
 
     def is_adapting(self):
-        return self.nadapt_counter < self.nadapt
+        return self.adaptor.is_adapting()
+
+    @property
+    def nadapt_counter(self):
+        return self.adaptor.counter
 
     def create_adaptor(self, nadapt, adapt_delta=0.8):
-        self.adaptor = AdvancedHMC.StanHMCAdaptor(
+        self.adaptor = WindowedAdaptation(
             nadapt,
-            AdvancedHMC.Preconditioner(self.hmc.hamiltonian.metric),
-            AdvancedHMC.NesterovDualAveraging(adapt_delta, self.hmc.step_size),
+            self.hmc.hamiltonian.logpdf.get_dimension(),
+            self.hmc.step_size,
+            metric=self.hmc.hamiltonian.metric_type,
+            target=adapt_delta,
+            **self.schedule
         )
-        self.nadapt_counter = 0
 
     def adapt_step(self):
-        AdvancedHMC.adapt_b(
-            self.adaptor,
-            HMCUtilities.position(self.hmc.phasepoint),
+        step_size, metric = self.adaptor.update(
+            self.hmc.get_position(),
             self.hmc.stats.current["mean_tree_accept"],
         )
-        self.hmc.hamiltonian.hamiltonian = AdvancedHMC.reconstruct(
-            self.hmc.hamiltonian.hamiltonian, self.adaptor
+        if metric is not None:
+            self.hmc.set_metric(metric)
+        self.hmc.set_step_size(step_size)
+
+    def save_checkpoint(self, path):
+        """Save the state of the sampler and of the adaptation to `path`."""
+        checkpoint.save_checkpoint(path, self.hmc, adaptor=self)
+
+    def restore_checkpoint(self, path, rng=True, samples=True):
+        """Restore the sampler and adaptation from a checkpoint.
+
+        A subsequent call to `adapt` resumes the warm-up where it was
+        saved."""
+        checkpoint.restore_checkpoint(
+            path, self.hmc, adaptor=self, rng=rng, samples=samples
         )
-        self.hmc.sampler = AdvancedHMC.reconstruct(self.hmc.sampler, self.adaptor)
-        self.nadapt_counter += 1
 
     def adapt(
-        self, update_states=False, log_freq=0.01, log_prec=3, verbose=True
+        self,
+        update_states=False,
+        log_freq=0.01,
+        log_prec=3,
+        verbose=True,
+        checkpoint_path=None,
+        checkpoint_period=100,
+        callback=None,
     ):
-        print("Warming up HMC for {0} steps.".format(self.nadapt))
+        """Run the warm-up.
 
-        try:
-            self.hmc.stats.clear()
-        except AttributeError:
-            pass
+        If `checkpoint_path` is given, a checkpoint is saved there every
+        `checkpoint_period` steps and at the end of the warm-up.
 
-        try:
-            self.hmc.samples.clear()
-        except AttributeError:
-            pass
+        Progress messages are passed to `self.log`. If `callback` is given,
+        it is also called at each logging interval with a dict describing
+        the progress, and once at the end of the warm-up."""
+        self.log(
+            "Warming up HMC for {0}{1} steps.".format(
+                "up to " if self.adaptor.early_stop else "", self.nadapt
+            )
+        )
 
-        if verbose:
-            log_interval = int(self.nadapt * log_freq)
+        if self.nadapt_counter == 0:
+            try:
+                self.hmc.stats.clear()
+            except AttributeError:
+                pass
+
+            try:
+                self.hmc.samples.clear()
+            except AttributeError:
+                pass
+        else:
+            self.log("Resuming from step {0}.".format(self.nadapt_counter))
+
+        log_interval = max(int(self.nadapt * log_freq), 1)
 
         if not update_states:
             opt_states = self.hmc.get_optimizer_states()
@@ -63,17 +147,31 @@ class Adaptor(object):
         ndivergent = 0
         nevals = 0
         self.hmc.before_sample()
+        self.hmc.set_is_adapt(True)
         start = timer()
         while self.is_adapting():
             self.hmc.sample()
             self.adapt_step()
             ndivergent += self.hmc.is_diverging
             nevals += self.hmc.stats.current["tree_size"]
-            if verbose and (self.nadapt_counter + 1) % log_interval == 0:
+            if (
+                checkpoint_path is not None
+                and self.nadapt_counter % checkpoint_period == 0
+            ):
+                self.save_checkpoint(checkpoint_path)
+            if (verbose or callback is not None) and (
+                self.nadapt_counter + 1
+            ) % log_interval == 0:
                 lap = timer() - start
                 per_eval = lap / nevals
                 eta = lap * (self.nadapt / (self.nadapt_counter + 1) - 1)
-                print(
+                if callback is not None:
+                    callback(
+                        self._get_progress(lap, nevals, ndivergent, eta=eta)
+                    )
+                if not verbose:
+                    continue
+                self.log(
                     "Warmup step {0}/{1} ({2:.{4}g}s/eval  ETA: {3})".format(
                         self.nadapt_counter + 1,
                         self.nadapt,
@@ -82,26 +180,228 @@ class Adaptor(object):
                         log_prec,
                     )
                 )
-                self.hmc.stats.log_mean()
-                print("Metric:\n    {0}".format(
-                    Main.eval("x -> getproperty(x, :(M⁻¹))")(self.hmc.hamiltonian.metric)
+                self.hmc.stats.log_mean(log=self.log)
+                self.log("Metric:\n    {0}".format(
+                    self.hmc.hamiltonian.get_inverse_metric()
                 ))
 
-        self.hmc.after_sample()
+        self.hmc.set_is_adapt(False)
+        self.hmc.update_model()
+        if update_states and self.hmc.get_has_optimizer_states():
+            self.hmc.update_states()
+        if checkpoint_path is not None:
+            self.save_checkpoint(checkpoint_path)
 
         if not update_states:
             self.hmc.set_optimizer_states(opt_states)
 
         lap = timer() - start
-        per_eval = lap / nevals
-        print(
+        per_eval = lap / max(nevals, 1)
+        if self.adaptor.converged:
+            self.log(
+                "Step size and metric converged after {0} of {1} warmup "
+                "steps.".format(self.nadapt_counter, self.nadapt)
+            )
+        if callback is not None:
+            callback(self._get_progress(lap, nevals, ndivergent, eta=0.0))
+        self.log(
             "Finished warmup after {0:.{2}g}s ({1:.{2}g}s/eval)".format(
                 lap, per_eval, log_prec
             )
         )
-        print(
+        self.log(
             "{0} divergent transitions were encountered during warm-up ({1:.{2}%}%)".format(
-                ndivergent, ndivergent / self.nadapt, log_prec
+                ndivergent, ndivergent / max(self.nadapt_counter, 1), log_prec
+            )
+        )
+        self.hmc.stats.log_mean(title="Mean warm-up statistics:", log=self.log)
+        instrumentation = self.hmc.get_instrumentation()
+        if instrumentation is not None:
+            instrumentation.log_summary(log=self.log)
+
+    def _get_progress(self, elapsed, nevals, ndivergent, eta=None):
+        progress = {
+            "step": self.nadapt_counter,
+            "nadapt": self.nadapt,
+            "converged": self.adaptor.converged,
+            "metric_change": self.adaptor.metric_change,
+            "elapsed": elapsed,
+            "eta": eta,
+            "time_per_eval": elapsed / max(nevals, 1),
+            "nevals": nevals,
+            "ndivergent": ndivergent,
+            "step_size": float(self.hmc.step_size),
+            "mean_stats": self.hmc.stats.get_mean_stats(),
+        }
+        instrumentation = self.hmc.get_instrumentation()
+        if instrumentation is not None:
+            progress["timing"] = instrumentation.get_summary()
+        return progress
+
+
+class ChainAdaptation(object):
+
+    """Per-chain state of a pooled warm-up.
+
+    The step size of the chain is adapted with its own dual averaging, while
+    the positions visited in slow windows are collected into an estimator
+    of the `metric` to be pooled with those of other chains. A "lowrank"
+    metric is estimated with rank `rank`, and a "block" metric over
+    `blocks`, groups of particles as for `OptimizedVariables.get_blocks`."""
+
+    def __init__(
+        self, hmc, adapt_delta=0.8, metric="diag", rank=10, blocks=None
+    ):
+        self.hmc = hmc
+        self.dual_averaging = DualAveraging(hmc.step_size, target=adapt_delta)
+        if metric == "block":
+            blocks = hmc.opt_vars.get_blocks(blocks)
+        self.estimator = _make_estimator(
+            metric, hmc.hamiltonian.logpdf.get_dimension(), rank, blocks
+        )
+        self.ndivergent = 0
+
+    def start_window(self, nsteps, collect):
+        """Run `nsteps` warm-up transitions, collecting positions if
+        `collect`, then set the model to the last position."""
+        self.estimator.reset()
+        self.hmc.set_is_adapt(True)
+        for _ in range(nsteps):
+            self.hmc.sample()
+            self.ndivergent += self.hmc.is_diverging
+            self.hmc.set_step_size(
+                self.dual_averaging.update(
+                    self.hmc.stats.current["mean_tree_accept"]
+                )
             )
+            if collect:
+                self.estimator.add_sample(self.hmc.get_position())
+        self.hmc.update_model()
+
+    def finish_window(self):
+        """Get the estimator of the last window."""
+        return self.estimator
+
+    def set_metric(self, metric):
+        """Set the metric and restart step size adaptation."""
+        self.hmc.set_metric(metric)
+        step_size = self.hmc.init_step_size()
+        self.hmc.set_step_size(step_size)
+        self.dual_averaging.restart(step_size)
+
+    def finalize(self):
+        """Set the final adapted step size and set the model to the last
+        position, from which sampling continues."""
+        self.hmc.set_step_size(self.dual_averaging.get_final_step_size())
+        self.hmc.set_is_adapt(False)
+        self.hmc.update_model()
+        return self.ndivergent
+
+
+class PooledAdaptor(object):
+
+    """Adapt several chains with a metric estimated from all of them.
+
+    Warm-up follows a Stan-style windowed schedule (see
+    `IMP.hmc.adaptation.get_slow_windows`). Each chain adapts its own step
+    size, but at the end of each slow window the position statistics of all
+    chains are pooled into one metric estimate, which is then used by every
+    chain. Pooling gives a less noisy metric from fewer warm-up steps.
+
+    `chains` are `ChainAdaptation` instances or proxies for chains running in
+    other processes with the same methods (see
+    `IMP.hmc.parallel.RemoteChainAdaptation`); all chains run each window
+    before the results are collected, so remote chains run concurrently."""
+
+    def __init__(
+        self,
+        chains,
+        nadapt=1000,
+        metric="diag",
+        init_buffer=75,
+        term_buffer=50,
+        base_window=25,
+        verbose=True,
+        log=print,
+    ):
+        self.chains = chains
+        self.log = log
+        self.nadapt = nadapt
+        self.metric = metric
+        self.windows = get_slow_windows(
+            nadapt,
+            init_buffer=init_buffer,
+            term_buffer=term_buffer,
+            base_window=base_window,
         )
-        self.hmc.stats.log_mean(title="Mean warm-up statistics:")
+        self.verbose = verbose
+        self.nadapt_counter = 0
+
+    @classmethod
+    def from_hmcs(
+        cls,
+        hmcs,
+        adapt_delta=0.8,
+        metric="diag",
+        metric_rank=10,
+        metric_blocks=None,
+        **kwargs
+    ):
+        """Create an adaptor for chains running in this process."""
+        chains = [
+            ChainAdaptation(
+                hmc,
+                adapt_delta=adapt_delta,
+                metric=metric,
+                rank=metric_rank,
+                blocks=metric_blocks,
+            )
+            for hmc in hmcs
+        ]
+        return cls(chains, metric=metric, **kwargs)
+
+    def is_adapting(self):
+        return self.nadapt_counter < self.nadapt
+
+    def run_window(self, nsteps, collect=False):
+        """Run all chains for a window and return their estimators."""
+        if nsteps <= 0:
+            return []
+        for chain in self.chains:
+            chain.start_window(nsteps, collect)
+        estimators = [chain.finish_window() for chain in self.chains]
+        self.nadapt_counter += nsteps
+        return estimators
+
+    def adapt(self):
+        if self.verbose:
+            self.log(
+                "Warming up {0} chains for {1} steps with pooled metric "
+                "adaptation.".format(len(self.chains), self.nadapt)
+            )
+        collect = self.metric != "unit"
+        start = timer()
+        for wstart, wend in self.windows:
+            self.run_window(wstart - self.nadapt_counter)
+            estimators = self.run_window(wend - wstart, collect=collect)
+            if not collect:
+                continue
+            metric = merge_estimators(estimators).get_variance()
+            for chain in self.chains:
+                chain.set_metric(metric)
+            if self.verbose:
+                self.log(
+                    "Warmup step {0}/{1}: updated metric from {2} pooled "
+                    "samples".format(
+                        self.nadapt_counter,
+                        self.nadapt,
+                        len(estimators) * (wend - wstart),
+                    )
+                )
+        self.run_window(self.nadapt - self.nadapt_counter)
+        ndivergent = sum(chain.finalize() for chain in self.chains)
+        if self.verbose:
+            self.log(
+                "Finished pooled warmup after {0:.3g}s with {1} divergent "
+                "transitions".format(timer() - start, ndivergent)
+            )
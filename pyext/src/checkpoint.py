@@ -0,0 +1,391 @@
+"""Saving and restoring the state of a sampler.
+
+A checkpoint is a NumPy `.npz` file holding the current position of the
+chain in free space, the step size and inverse metric, the state of the
+warm-up adaptor (if any) and the state of the NumPy and Julia random number
+generators. It is written atomically, so an interrupted write leaves any
+previous checkpoint intact.
+
+The samples and statistics accumulated so far are kept next to it in
+append-only files `<path>.<id>.samples` and `<path>.<id>.stats`, of which
+the checkpoint records the names and the number of rows written. Repeated
+checkpoints of a run only append what was added since the last one, so
+checkpointing a long run does not rewrite all of its samples each time.
+If the samples of the sampler were cleared since the last checkpoint, they
+are written to new files and the old ones removed.
+
+The state of the IMP random number generator is not saved. When sampling
+resumes, `optimize` draws a fresh momentum for the restored position, so a
+resumed chain is a valid continuation of the interrupted one, but is only
+identical to it up to this momentum refresh.
+"""
+
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+from .accumulator import StatisticsAccumulator
+
+CHECKPOINT_VERSION = 1
+
+
+def _julia_serialize(obj):
+    from .julia import Main
+
+    Main.eval("using Serialization")
+    f = Main.eval(
+        "x -> (io = IOBuffer(); Serialization.serialize(io, x); take!(io))"
+    )
+    return np.asarray(f(obj), dtype=np.uint8)
+
+
+def _julia_deserialize(data):
+    from .julia import Main
+
+    Main.eval("using Serialization")
+    f = Main.eval("b -> Serialization.deserialize(IOBuffer(b))")
+    return f(np.asarray(data, dtype=np.uint8))
+
+
+def _get_julia_rng_state():
+    from .julia import Main
+
+    Main.eval("using Random")
+    # GLOBAL_RNG is the default generator of every Julia version; from 1.7
+    # it forwards to the task-local generator
+    return _julia_serialize(Main.eval("copy(Random.GLOBAL_RNG)"))
+
+
+def _set_julia_rng_state(data):
+    from .julia import Main
+
+    Main.eval("using Random")
+    Main.eval("r -> (copy!(Random.GLOBAL_RNG, r); nothing)")(
+        _julia_deserialize(data)
+    )
+
+
+def _serialize(obj):
+    return np.frombuffer(pickle.dumps(obj), dtype=np.uint8)
+
+
+def _deserialize(data):
+    return pickle.loads(np.asarray(data, dtype=np.uint8).tobytes())
+
+
+def get_checkpoint(hmc, adaptor=None):
+    """Get the state of `hmc` (and optionally its `adaptor.Adaptor`) as a
+    dict of arrays."""
+    hamiltonian = hmc.hamiltonian
+    state = {
+        "version": CHECKPOINT_VERSION,
+        "engine": hmc.engine,
+        "position": hmc.get_position(),
+        "step_size": float(hmc.step_size),
+        "metric_type": hamiltonian.metric_type,
+        "inverse_metric": np.asarray(
+            hamiltonian.get_inverse_metric(), dtype=np.double
+        ),
+    }
+    if hamiltonian.metric_type in ("lowrank", "block"):
+        state["metric"] = _serialize(hamiltonian.metric)
+
+    if adaptor is not None:
+        state["nadapt"] = adaptor.nadapt
+        state["adaptor"] = _serialize(adaptor.adaptor)
+
+    rng_name, rng_keys, rng_pos, rng_has_gauss, rng_gauss = (
+        np.random.get_state()
+    )
+    state.update(
+        rng_name=rng_name,
+        rng_keys=rng_keys,
+        rng_pos=rng_pos,
+        rng_has_gauss=rng_has_gauss,
+        rng_gauss=rng_gauss,
+    )
+    if hmc.engine == "julia":
+        state["julia_rng"] = _get_julia_rng_state()
+    return state
+
+
+def _get_stats_columns(hmc):
+    if hmc.stats is None:
+        return [], []
+    keys = list(hmc.stats.keys)
+    return keys, [hmc.stats.get_samples(k, copy=False) for k in keys]
+
+
+def _get_stats_row(columns, i):
+    return np.array([c[i] for c in columns], dtype=np.double)
+
+
+def _get_samples_row(samples, i):
+    return np.array(samples[i], dtype=np.double)
+
+
+def _append_rows(path, rows, start, row_size):
+    """Write `rows` to `path` after the first `start` rows, discarding
+    anything after them."""
+    with open(path, "ab") as fh:
+        fh.truncate(start * row_size * 8)
+        np.ascontiguousarray(rows, dtype=np.double).tofile(fh)
+
+
+def _is_extended(get_row, n, nwritten, last_row):
+    """Check whether `n` rows, of which `get_row(i)` gets row `i`, still
+    start with the `nwritten` rows written before, the last of which was
+    `last_row`. Used to detect samples cleared since the last checkpoint."""
+    if nwritten == 0:
+        return True
+    return n >= nwritten and np.array_equal(get_row(nwritten - 1), last_row)
+
+
+def _get_data_files(path):
+    """Get the paths of the sample and statistics files of the checkpoint
+    at `path`, if any."""
+    try:
+        state = load_checkpoint(path)
+    except (OSError, ValueError, KeyError):
+        return []
+    return [
+        os.path.join(os.path.dirname(state["path"]), str(state[k]))
+        for k in ("samples_file", "stats_file")
+    ]
+
+
+def _set_progress(hmc, path, prefix, samples, nvars, keys, columns):
+    """Record what was written to the checkpoint at `path`."""
+    nsamples = len(samples)
+    nstats = len(columns[0]) if columns else 0
+    dirname = os.path.dirname(path)
+    hmc._checkpoint_progress = dict(
+        path=path,
+        prefix=prefix,
+        files=[
+            os.path.join(dirname, prefix + ext)
+            for ext in (".samples", ".stats")
+        ],
+        nsamples=nsamples,
+        nvars=nvars,
+        nstats=nstats,
+        stats_keys=keys,
+        last_sample=(
+            _get_samples_row(samples, nsamples - 1) if nsamples else None
+        ),
+        last_stats=_get_stats_row(columns, nstats - 1) if nstats else None,
+    )
+
+
+def save_checkpoint(path, hmc, adaptor=None):
+    """Write the state of `hmc` (and optionally `adaptor`) to `path`.
+
+    Samples and statistics added since the last checkpoint written to
+    `path` by this sampler are appended to its data files."""
+    path = os.path.abspath(path)
+    dirname = os.path.dirname(path)
+    state = get_checkpoint(hmc, adaptor=adaptor)
+    samples = hmc.sample_saver.get_values_numpy()
+    if samples.ndim != 2:
+        samples = samples.reshape(0, 0)
+    nsamples, nvars = samples.shape
+    keys, columns = _get_stats_columns(hmc)
+    nstats = len(columns[0]) if columns else 0
+
+    progress = hmc._checkpoint_progress
+    append = (
+        progress is not None
+        and progress["path"] == path
+        and progress["stats_keys"] == keys
+        and progress["nvars"] in (0, nvars)
+        and _is_extended(
+            lambda i: _get_samples_row(samples, i),
+            nsamples,
+            progress["nsamples"],
+            progress["last_sample"],
+        )
+        and _is_extended(
+            lambda i: _get_stats_row(columns, i),
+            nstats,
+            progress["nstats"],
+            progress["last_stats"],
+        )
+        and all(os.path.exists(f) for f in progress["files"])
+    )
+    if append:
+        prefix = progress["prefix"]
+        start_samples, start_stats = progress["nsamples"], progress["nstats"]
+        old_files = []
+    else:
+        # a new name, without using any of the sampler's random numbers
+        prefix = "{0}.{1}".format(os.path.basename(path), os.urandom(4).hex())
+        start_samples = start_stats = 0
+        old_files = _get_data_files(path)
+    _append_rows(
+        os.path.join(dirname, prefix + ".samples"),
+        samples[start_samples:],
+        start_samples,
+        nvars,
+    )
+    _append_rows(
+        os.path.join(dirname, prefix + ".stats"),
+        np.column_stack([c[start_stats:] for c in columns])
+        if columns
+        else [],
+        start_stats,
+        len(keys),
+    )
+    state.update(
+        samples_file=prefix + ".samples",
+        stats_file=prefix + ".stats",
+        nsamples=nsamples,
+        nvars=nvars,
+        nstats=nstats,
+        stats_keys=np.array(keys, dtype=str),
+        stats_dtypes=np.array([c.dtype.str for c in columns], dtype=str),
+    )
+
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=".npz.tmp")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            np.savez(fh, **state)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    _set_progress(hmc, path, prefix, samples, nvars, keys, columns)
+    for f in old_files:
+        if f not in hmc._checkpoint_progress["files"] and os.path.exists(f):
+            os.remove(f)
+
+
+def load_checkpoint(path):
+    """Read a checkpoint written by `save_checkpoint` into a dict.
+
+    The samples and statistics are not read until the checkpoint is
+    restored."""
+    with np.load(path) as data:
+        state = {k: data[k] for k in data.files}
+    if int(state["version"]) != CHECKPOINT_VERSION:
+        raise ValueError(
+            "Checkpoint version {0} is not supported".format(
+                int(state["version"])
+            )
+        )
+    state["path"] = os.path.abspath(path)
+    return state
+
+
+def _read_rows(state, key, nrows, row_size):
+    path = os.path.join(os.path.dirname(state["path"]), str(state[key]))
+    data = np.fromfile(path, dtype=np.double, count=nrows * row_size)
+    if len(data) < nrows * row_size:
+        raise ValueError("Checkpoint data file {0} is truncated".format(path))
+    return data.reshape(nrows, row_size)
+
+
+def _read_samples(state):
+    """Get the samples (nsamples, nvars), statistics keys and columns of a
+    checkpoint."""
+    keys = [str(k) for k in state["stats_keys"]]
+    samples = _read_rows(
+        state, "samples_file", int(state["nsamples"]), int(state["nvars"])
+    )
+    stats = _read_rows(state, "stats_file", int(state["nstats"]), len(keys))
+    columns = [
+        stats[:, i].astype(np.dtype(str(dtype)))
+        for i, dtype in enumerate(state["stats_dtypes"])
+    ]
+    return samples, keys, columns
+
+
+def _get_state(checkpoint):
+    if isinstance(checkpoint, dict):
+        return checkpoint
+    return load_checkpoint(checkpoint)
+
+
+def warm_start(checkpoint, hmc):
+    """Use the adapted metric and step size of a previous run.
+
+    `checkpoint` is a path or a dict returned by `load_checkpoint`. The
+    position of `hmc` is not changed."""
+    state = _get_state(checkpoint)
+    metric_type = str(state["metric_type"])
+    if metric_type == "unit":
+        hmc.set_metric("unit")
+    elif "metric" in state:
+        hmc.set_metric(_deserialize(state["metric"]))
+    else:
+        hmc.set_metric(state["inverse_metric"])
+    hmc.set_step_size(float(state["step_size"]))
+
+
+def restore_checkpoint(checkpoint, hmc, adaptor=None, rng=True, samples=True):
+    """Restore the state of `hmc` (and optionally `adaptor`).
+
+    `checkpoint` is a path or a dict returned by `load_checkpoint`. If `rng`
+    is True, the random number generators are also restored, so that
+    sampling continues as it would have without interruption, up to the
+    momentum drawn when sampling resumes (see above). If `samples` is True,
+    the saved statistics and samples replace those of `hmc`, and later
+    checkpoints to the same path append to them."""
+    state = _get_state(checkpoint)
+    engine = str(state["engine"])
+    if engine != hmc.engine:
+        raise ValueError(
+            "Checkpoint was written with the {0} engine, but the sampler "
+            "uses the {1} engine".format(engine, hmc.engine)
+        )
+    position = np.asarray(state["position"], dtype=np.double)
+    if position.shape != (hmc.hamiltonian.logpdf.get_dimension(),):
+        raise ValueError(
+            "Checkpoint position does not match the number of free variables"
+        )
+
+    warm_start(state, hmc)
+    hmc.set_values(hmc.transformation.constrain(position))
+    hmc.get_model().update()
+    hmc.create_phasepoint(position)
+
+    if adaptor is not None and "adaptor" in state:
+        adaptor.nadapt = int(state["nadapt"])
+        adaptor.adaptor = _deserialize(state["adaptor"])
+
+    if rng:
+        np.random.set_state(
+            (
+                str(state["rng_name"]),
+                state["rng_keys"],
+                int(state["rng_pos"]),
+                int(state["rng_has_gauss"]),
+                float(state["rng_gauss"]),
+            )
+        )
+        if "julia_rng" in state:
+            _set_julia_rng_state(state["julia_rng"])
+
+    if samples:
+        saved, keys, columns = _read_samples(state)
+        if keys:
+            hmc.stats = StatisticsAccumulator(
+                keys, dtypes=[c.dtype for c in columns]
+            )
+            hmc.stats.add_samples(columns)
+        else:
+            hmc.stats = None
+        hmc.sample_saver.clear()
+        saved = np.ascontiguousarray(saved, dtype=np.double)
+        if saved.size > 0:
+            hmc.sample_saver.add_values_from(saved.ravel())
+        _set_progress(
+            hmc,
+            state["path"],
+            str(state["samples_file"])[: -len(".samples")],
+            saved,
+            int(state["nvars"]),
+            keys,
+            columns,
+        )
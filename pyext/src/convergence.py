@@ -0,0 +1,332 @@
+"""Convergence diagnostics computed during sampling, and early stopping.
+
+The diagnostics follow Vehtari et al., "Rank-normalization, folding, and
+localization: An improved R-hat for assessing convergence of MCMC" (2021),
+as implemented in Stan and ArviZ: bulk and tail effective sample size (ESS),
+rank-normalized split R-hat, and the Monte Carlo standard error (MCSE) of
+the mean. All are computed for every variable at once with NumPy.
+
+A `ConvergenceMonitor` accumulates the draws of one or more chains as they
+are sampled, and `sample_until_converged` samples in blocks until the
+diagnostics meet a `StoppingCriteria`, or the sample or time budget runs
+out.
+"""
+
+from timeit import default_timer as timer
+
+import numpy as np
+
+try:
+    from scipy.special import ndtri as _ndtri
+except ImportError:
+    from statistics import NormalDist
+
+    _ndtri = np.frompyfunc(NormalDist().inv_cdf, 1, 1)
+
+
+def _split_chains(x):
+    """Split each chain of `x` (nchains, ndraws, ...) into two halves."""
+    n = x.shape[1] // 2
+    return np.concatenate([x[:, :n], x[:, x.shape[1] - n :]], axis=0)
+
+
+def _rank_normalize(x):
+    """Replace the draws of each variable with the normal quantiles of
+    their ranks among all chains."""
+    shape = x.shape
+    flat = x.reshape(shape[0] * shape[1], -1)
+    ranks = np.empty_like(flat, dtype=np.double)
+    order = np.argsort(flat, axis=0, kind="mergesort")
+    np.put_along_axis(
+        ranks,
+        order,
+        np.arange(1, len(flat) + 1, dtype=np.double)[:, np.newaxis],
+        axis=0,
+    )
+    z = _ndtri((ranks - 0.375) / (len(flat) + 0.25))
+    return np.asarray(z, dtype=np.double).reshape(shape)
+
+
+def _autocovariance(x):
+    """Biased autocovariance of each chain and variable along the draws."""
+    n = x.shape[1]
+    nfft = 1 << (2 * n - 1).bit_length()
+    centered = x - x.mean(axis=1, keepdims=True)
+    f = np.fft.rfft(centered, n=nfft, axis=1)
+    acov = np.fft.irfft(f * np.conjugate(f), n=nfft, axis=1)[:, :n]
+    return acov / n
+
+
+def ess(x):
+    """ESS of each variable of `x` (nchains, ndraws, nvars).
+
+    Uses Geyer's initial monotone sequence estimator of the autocorrelation
+    time, combining the chains as in Stan."""
+    x = np.asarray(x, dtype=np.double)
+    nchains, ndraws = x.shape[:2]
+    if ndraws < 4:
+        return np.full(x.shape[2:], np.nan)
+    acov = _autocovariance(x)
+    mean_var = acov[:, 0].mean(axis=0) * ndraws / (ndraws - 1)
+    var_plus = mean_var * (ndraws - 1) / ndraws
+    if nchains > 1:
+        var_plus = var_plus + x.mean(axis=1).var(axis=0, ddof=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rho = 1 - (mean_var - acov.mean(axis=0)) / var_plus
+        npairs = ndraws // 2
+        pairs = rho[0 : 2 * npairs : 2] + rho[1 : 2 * npairs : 2]
+        # initial positive sequence
+        positive = pairs > 0
+        positive[0] = True
+        positive = np.cumprod(positive, axis=0).astype(bool)
+        # initial monotone sequence
+        pairs = np.minimum.accumulate(np.where(positive, pairs, np.inf), axis=0)
+        tau = -1 + 2 * np.where(positive, pairs, 0).sum(axis=0)
+        ntotal = nchains * ndraws
+        tau = np.maximum(tau, 1 / np.log10(ntotal))
+        return np.where(np.isfinite(var_plus) & (var_plus > 0), ntotal / tau, np.nan)
+
+
+def ess_bulk(x):
+    """Bulk ESS: the ESS of the rank-normalized split chains."""
+    return ess(_rank_normalize(_split_chains(np.asarray(x, dtype=np.double))))
+
+
+def ess_tail(x, prob=0.05):
+    """Tail ESS: the minimum ESS of the indicators of being below the `prob`
+    and `1 - prob` quantiles."""
+    x = _split_chains(np.asarray(x, dtype=np.double))
+    flat = x.reshape(x.shape[0] * x.shape[1], -1)
+    lower, upper = np.quantile(flat, [prob, 1 - prob], axis=0)
+    return np.fmin(
+        ess((x <= lower).astype(np.double)), ess((x <= upper).astype(np.double))
+    )
+
+
+def _rhat(x):
+    ndraws = x.shape[1]
+    between = ndraws * x.mean(axis=1).var(axis=0, ddof=1)
+    within = x.var(axis=1, ddof=1).mean(axis=0)
+    var_hat = (ndraws - 1) / ndraws * within + between / ndraws
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sqrt(var_hat / within)
+
+
+def rhat(x):
+    """Rank-normalized split R-hat: the maximum of the R-hat of the bulk and
+    of the folded draws."""
+    x = _split_chains(np.asarray(x, dtype=np.double))
+    median = np.median(x.reshape(x.shape[0] * x.shape[1], -1), axis=0)
+    return np.fmax(
+        _rhat(_rank_normalize(x)), _rhat(_rank_normalize(np.abs(x - median)))
+    )
+
+
+def mcse_mean(x):
+    """Monte Carlo standard error of the mean."""
+    x = np.asarray(x, dtype=np.double)
+    sd = x.reshape(x.shape[0] * x.shape[1], -1).std(axis=0, ddof=1)
+    return sd / np.sqrt(ess(_split_chains(x)))
+
+
+class ConvergenceMonitor(object):
+
+    """Accumulates the draws of one or more chains and computes convergence
+    diagnostics on them.
+
+    Draws are added in blocks with `add_samples`, into a buffer whose
+    capacity doubles as needed, so adding draws takes amortized constant
+    time per draw. Diagnostics use the first `get_number_of_samples()` draws
+    of each chain, i.e. as many as the shortest chain has, and are computed
+    from scratch on each call, in O(N log N) time for N draws."""
+
+    def __init__(self, nchains=1):
+        self.nchains = nchains
+        self._counts = [0] * nchains
+        self._buffer = None
+
+    def _reserve(self, size, nvars):
+        if self._buffer is None:
+            self._buffer = np.empty((self.nchains, max(size, 16), nvars))
+        elif size > self._buffer.shape[1]:
+            capacity = max(size, 2 * self._buffer.shape[1])
+            buffer = np.empty((self.nchains, capacity, nvars))
+            n = max(self._counts)
+            buffer[:, :n] = self._buffer[:, :n]
+            self._buffer = buffer
+        elif nvars != self._buffer.shape[2]:
+            raise ValueError(
+                "Expected draws of {0} variables, got {1}.".format(
+                    self._buffer.shape[2], nvars
+                )
+            )
+
+    def add_samples(self, samples, chain=0):
+        """Add draws (nsamples, nvars) of the given chain."""
+        samples = np.asarray(samples, dtype=np.double)
+        if samples.ndim == 1:
+            samples = samples[np.newaxis]
+        n = self._counts[chain]
+        self._reserve(n + len(samples), samples.shape[1])
+        self._buffer[chain, n : n + len(samples)] = samples
+        self._counts[chain] += len(samples)
+
+    def get_number_of_samples(self):
+        return min(self._counts)
+
+    def get_draws(self):
+        """Get the draws as an array (nchains, ndraws, nvars).
+
+        This is a read-only view of the monitor's buffer; adding more draws
+        does not change it."""
+        if self._buffer is None:
+            return np.empty((self.nchains, 0, 0))
+        draws = self._buffer[:, : self.get_number_of_samples()]
+        draws.flags.writeable = False
+        return draws
+
+    def get_diagnostics(self):
+        """Get the diagnostics of each variable and their extremes."""
+        draws = self.get_draws()
+        diagnostics = {
+            "nsamples": draws.shape[1],
+            "ess_bulk": ess_bulk(draws),
+            "ess_tail": ess_tail(draws),
+            "mcse_mean": mcse_mean(draws),
+        }
+        if self.nchains > 1:
+            diagnostics["r_hat"] = rhat(draws)
+        with np.errstate(invalid="ignore"):
+            diagnostics["min_ess_bulk"] = float(np.min(diagnostics["ess_bulk"]))
+            diagnostics["min_ess_tail"] = float(np.min(diagnostics["ess_tail"]))
+            if "r_hat" in diagnostics:
+                diagnostics["max_r_hat"] = float(np.max(diagnostics["r_hat"]))
+        return diagnostics
+
+
+class StoppingCriteria(object):
+
+    """Thresholds at which to stop sampling.
+
+    Sampling stops once the minimum bulk and tail ESS of all variables reach
+    `min_ess_bulk` and `min_ess_tail` and, with multiple chains, the maximum
+    R-hat is at most `max_rhat`, or once `max_time` seconds have passed.
+    Thresholds that are None are not checked. Undefined diagnostics (NaN)
+    never meet a threshold."""
+
+    def __init__(
+        self, min_ess_bulk=400, min_ess_tail=None, max_rhat=1.01, max_time=None
+    ):
+        self.min_ess_bulk = min_ess_bulk
+        self.min_ess_tail = min_ess_tail
+        self.max_rhat = max_rhat
+        self.max_time = max_time
+
+    def is_converged(self, diagnostics):
+        if self.min_ess_bulk is not None and not (
+            diagnostics["min_ess_bulk"] >= self.min_ess_bulk
+        ):
+            return False
+        if self.min_ess_tail is not None and not (
+            diagnostics["min_ess_tail"] >= self.min_ess_tail
+        ):
+            return False
+        if (
+            self.max_rhat is not None
+            and "max_r_hat" in diagnostics
+            and not diagnostics["max_r_hat"] <= self.max_rhat
+        ):
+            return False
+        return True
+
+    def is_out_of_time(self, elapsed):
+        return self.max_time is not None and elapsed >= self.max_time
+
+
+class LocalChain(object):
+
+    """A `HamiltonianMonteCarlo` chain in this process, for
+    `sample_until_converged`."""
+
+    def __init__(self, hmc):
+        self.hmc = hmc
+        self._block = None
+
+    def start_block(self, nsample):
+        self._block = self.hmc.sample_block(nsample)
+
+    def finish_block(self):
+        block, self._block = self._block, None
+        return block
+
+
+def sample_until_converged(
+    chains,
+    criteria,
+    max_samples,
+    block_size=100,
+    min_samples=None,
+    check_growth=1.5,
+    monitor=None,
+    log=print,
+):
+    """Sample `chains` in blocks until `criteria` are met.
+
+    `chains` have methods `start_block(nsample)` and `finish_block()`, which
+    returns the draws of the block; all chains are started before any block
+    is collected, so remote chains (see `IMP.hmc.parallel`) run
+    concurrently. The diagnostics of all draws are checked against the
+    `StoppingCriteria` once at least `min_samples` (by default `block_size`)
+    draws per chain have been taken, and then after every block once the
+    number of draws has grown by a factor of `check_growth`. As each check
+    recomputes the diagnostics from all draws, in O(N log N) time for N
+    draws, checks at geometrically growing intervals keep their total cost
+    within a constant factor of the last one; a `check_growth` of 1 checks
+    after every block, at a total cost quadratic in the number of blocks.
+    Sampling stops after at most `max_samples` draws per chain.
+
+    Returns the `ConvergenceMonitor` and the reason for stopping, one of
+    "converged", "max_time" or "max_samples"."""
+    if monitor is None:
+        monitor = ConvergenceMonitor(len(chains))
+    if min_samples is None:
+        min_samples = block_size
+    start = timer()
+    nsampled = 0
+    next_check = min_samples
+    reason = "max_samples"
+    while nsampled < max_samples:
+        nblock = min(block_size, max_samples - nsampled)
+        for chain in chains:
+            chain.start_block(nblock)
+        for i, chain in enumerate(chains):
+            monitor.add_samples(chain.finish_block(), chain=i)
+        nsampled += nblock
+        elapsed = timer() - start
+        if nsampled >= next_check:
+            next_check = nsampled * check_growth
+            diagnostics = monitor.get_diagnostics()
+            log(
+                "Sample {0}/{1}: min bulk ESS {2:.4g}, min tail ESS {3:.4g}"
+                "{4}".format(
+                    nsampled,
+                    max_samples,
+                    diagnostics["min_ess_bulk"],
+                    diagnostics["min_ess_tail"],
+                    ", max R-hat {0:.4g}".format(diagnostics["max_r_hat"])
+                    if "max_r_hat" in diagnostics
+                    else "",
+                )
+            )
+            if criteria.is_converged(diagnostics):
+                reason = "converged"
+                break
+        if criteria.is_out_of_time(elapsed):
+            reason = "max_time"
+            break
+    log(
+        "Stopped sampling after {0} samples per chain ({1}).".format(
+            nsampled, reason
+        )
+    )
+    return monitor, reason
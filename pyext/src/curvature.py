@@ -0,0 +1,141 @@
+"""Initial metrics from the local curvature of the log density.
+
+Without a good initial metric, much of warm-up is spent finding the scales
+of the variables, which can differ by orders of magnitude between, e.g.,
+coordinates, nuisances and quaternions. The inverse of the diagonal of the
+Hessian of the negative log density at the initial position gives those
+scales at the cost of a few gradient evaluations.
+
+The diagonal is estimated with Hutchinson's estimator, `E[v * Hv]` over
+random Rademacher vectors `v`, with Hessian-vector products from central
+finite differences of the gradient, so each probe costs two gradient
+evaluations regardless of the dimension. For few variables the diagonal is
+instead computed exactly, one variable at a time. Where the curvature is not
+positive, e.g. away from a mode, the scales suggested by the transformation
+builders (see `OptimizedVariables.get_free_scales`) are used instead.
+"""
+
+import numpy as np
+
+
+def get_hessian_vector_product(logpdf, y, v, eps=1e-4):
+    """Approximate the product of the Hessian of `logpdf` at `y` with `v` by
+    central finite differences of the gradient with step `eps`, relative to
+    the largest entry of `v`."""
+    h = eps / np.max(np.abs(v))
+    _, gp = logpdf.get_logpdf_with_gradient(y + h * v)
+    gp = np.array(gp, dtype=np.double)
+    _, gm = logpdf.get_logpdf_with_gradient(y - h * v)
+    return (gp - np.asarray(gm, dtype=np.double)) / (2 * h)
+
+
+def estimate_hessian_diagonal(logpdf, y, nprobes=8, eps=1e-4):
+    """Estimate the diagonal of the Hessian of `logpdf` at `y`.
+
+    If the dimension is at most `nprobes`, the diagonal is computed exactly
+    (up to finite differences); otherwise it is estimated from `nprobes`
+    random probes."""
+    y = np.array(y, dtype=np.double)
+    n = len(y)
+    diag = np.zeros(n)
+    if n <= nprobes:
+        for i in range(n):
+            v = np.zeros(n)
+            v[i] = 1.0
+            diag[i] = get_hessian_vector_product(logpdf, y, v, eps=eps)[i]
+        return diag
+    for _ in range(nprobes):
+        v = np.random.choice([-1.0, 1.0], size=n)
+        diag += v * get_hessian_vector_product(logpdf, y, v, eps=eps)
+    return diag / nprobes
+
+
+def get_curvature_inverse_metric(
+    logpdf, y, nprobes=8, eps=1e-4, scales=None, bounds=(1e-4, 1e4)
+):
+    """Get a diagonal inverse metric from the curvature of `logpdf` at `y`.
+
+    Each entry is the inverse of the curvature of the negative log density
+    along that variable, if positive, or else the square of the variable's
+    entry of `scales` (NaN where unknown), or else 1. Entries are clipped to
+    `bounds`."""
+    curvature = -estimate_hessian_diagonal(logpdf, y, nprobes=nprobes, eps=eps)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv = np.where(
+            np.isfinite(curvature) & (curvature > 0), 1 / curvature, np.nan
+        )
+    if scales is not None:
+        inv = np.where(np.isnan(inv), np.asarray(scales) ** 2, inv)
+    inv = np.where(np.isfinite(inv), inv, 1.0)
+    return np.clip(inv, *bounds)
+
+
+def get_heuristic_inverse_metric(scales, bounds=(1e-4, 1e4)):
+    """Get a diagonal inverse metric from the squares of `scales`, using 1
+    where the scale is unknown (NaN)."""
+    scales = np.asarray(scales, dtype=np.double)
+    inv = np.where(np.isfinite(scales), scales ** 2, 1.0)
+    return np.clip(inv, *bounds)
+
+
+def make_metric(metric, inverse_diagonal, blocks=None):
+    """Make an initial metric of type `metric` from a diagonal inverse
+    metric, in a form accepted by `HamiltonianMonteCarlo.set_metric`.
+
+    Returns None for a unit metric, which has no scales to set."""
+    if metric == "unit":
+        return None
+    elif metric == "diag":
+        return inverse_diagonal
+    elif metric == "dense":
+        return np.diag(inverse_diagonal)
+    elif metric == "lowrank":
+        from .metrics import LowRankEuclideanMetric
+
+        return LowRankEuclideanMetric(inverse_diagonal)
+    elif metric == "block":
+        from .metrics import BlockDiagEuclideanMetric, _stack_blocks
+
+        block_metrics = []
+        for idx in _stack_blocks(blocks or []):
+            Minv = inverse_diagonal[idx][:, :, np.newaxis] * np.eye(
+                idx.shape[1]
+            )
+            block_metrics.append((idx, Minv))
+        return BlockDiagEuclideanMetric(inverse_diagonal, block_metrics)
+    raise ValueError(
+        "'metric' must be in {'unit', 'diag', 'dense', 'lowrank', 'block'}"
+    )
+
+
+def seed_metric(
+    hmc, method="curvature", nprobes=8, eps=1e-4, blocks=None, log=None
+):
+    """Set the metric of `hmc` from the curvature at its current position
+    (`method="curvature"`) or from the scales suggested by the
+    transformations alone (`method="heuristic"`), then reinitialize the step
+    size for the new metric."""
+    metric_type = hmc.hamiltonian.metric_type
+    if metric_type == "unit":
+        return
+    if log is None:
+        log = hmc.log
+    scales = hmc.opt_vars.get_free_scales()
+    if method == "curvature":
+        inv = get_curvature_inverse_metric(
+            hmc.hamiltonian.logpdf,
+            hmc.transformation.free(hmc.get_values()),
+            nprobes=nprobes,
+            eps=eps,
+            scales=scales,
+        )
+    elif method == "heuristic":
+        inv = get_heuristic_inverse_metric(scales)
+    else:
+        raise ValueError("'method' must be in {'curvature', 'heuristic'}")
+    log(
+        "Seeded {0} metric from {1}: inverse metric in "
+        "[{2:.3g}, {3:.3g}]".format(metric_type, method, inv.min(), inv.max())
+    )
+    hmc.set_metric(make_metric(metric_type, inv, blocks=blocks))
+    hmc.set_step_size(hmc.init_step_size())
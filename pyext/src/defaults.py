@@ -1,15 +1,99 @@
+import os
+
+import numpy as np
+
+import IMP
+import IMP.core
+
 from .variables import OptimizedVariables
-from .log_density import LogDensity, TransformedLogDensity
+from .log_density import (
+    LogDensity,
+    SplitLogDensity,
+    TemperedLogDensity,
+    TransformedLogDensity,
+)
 from .hmc import HamiltonianMonteCarlo
 from .adaptor import Adaptor
 
 
+def _get_weighted_restraints(restraints, weight=1.0):
+    """Flatten restraint sets, yielding each restraint with the product of
+    the weights of the sets containing it."""
+    for r in restraints:
+        try:
+            rs = IMP.RestraintSet.get_from(r)
+        except ValueError:
+            yield r, weight
+        else:
+            for item in _get_weighted_restraints(
+                rs.get_restraints(), weight * rs.get_weight()
+            ):
+                yield item
+
+
+def get_flattened_restraints(sf):
+    """Get the restraints of `sf`, with restraint sets flattened, as a list
+    of `(restraint, weight)` pairs, where `weight` is the product of the
+    weights of the sets containing the restraint."""
+    return list(_get_weighted_restraints(sf.create_restraints()))
+
+
+def _make_scoring_function(m, weighted_restraints):
+    by_weight = {}
+    for r, weight in weighted_restraints:
+        by_weight.setdefault(weight, []).append(r)
+    return IMP.core.RestraintsScoringFunction(
+        [
+            IMP.RestraintSet(rs, weight, "RestraintSet%1%")
+            for weight, rs in by_weight.items()
+        ]
+        or [IMP.RestraintSet(m, "RestraintSet%1%")]
+    )
+
+
+def get_restraint_group_scoring_functions(sf, groups):
+    """Get a scoring function for each group of restraints of `sf`.
+
+    `groups` is a list of lists of indexes into `get_flattened_restraints`.
+    """
+    restraints = get_flattened_restraints(sf)
+    m = sf.get_model()
+    return [
+        _make_scoring_function(m, [restraints[i] for i in group])
+        for group in groups
+    ]
+
+
+def split_scoring_function(sf, slow_restraints):
+    """Split `sf` into scoring functions of its fast and slow restraints.
+
+    `slow_restraints` are the expensive restraints (or restraint sets) of
+    `sf`, such as EM density or cross-link restraints; all others are fast.
+    Restraint sets are flattened, keeping their weights. Raises ValueError
+    if the two scoring functions do not add up to `sf`."""
+    slow = [r for r, _ in _get_weighted_restraints(slow_restraints)]
+    groups = ([], [])
+    for i, (r, _) in enumerate(get_flattened_restraints(sf)):
+        groups[any(r == s for s in slow)].append(i)
+    fast_sf, slow_sf = get_restraint_group_scoring_functions(sf, groups)
+    score = sf.evaluate(False)
+    split_score = fast_sf.evaluate(False) + slow_sf.evaluate(False)
+    if abs(split_score - score) > 1e-6 * max(1.0, abs(score)):
+        raise ValueError(
+            "The fast and slow restraints do not add up to the scoring "
+            "function ({0} != {1})".format(split_score, score)
+        )
+    return fast_sf, slow_sf
+
+
 def setup_warmup_hmc(
     sf,
     hmc_type="dynamic",
     max_depth=10,
     metric="diag",
     save_warmup=False,
+    save_period=1,
+    save_indexes=None,
     warmup_optimizer_states=[],
     nadapt=1000,
     adapt_delta=0.8,
@@ -17,35 +101,212 @@ def setup_warmup_hmc(
     verbose=False,
     shuffle=False,
     shuffle_sigma=1,
+    engine="julia",
+    transform_backend="numpy",
+    warm_start=None,
+    checkpoint_path=None,
+    checkpoint_period=100,
+    instrumentation=None,
+    log=print,
+    init_buffer=75,
+    term_buffer=50,
+    base_window=25,
+    early_stop=False,
+    min_adapt=None,
+    metric_rank=10,
+    metric_blocks=None,
+    slow_restraints=None,
+    n_fast_steps=4,
+    sf_factory=None,
+    logpdf_workers=None,
+    logpdf_worker_mode="process",
+    restraint_groups=None,
+    beta=None,
+    batch_size=1,
+    init_metric=None,
+    init_metric_probes=8,
+    init_optimize=False,
+    init_restarts=0,
+    init_sigma=1.0,
+    init_workers=None,
 ):
+    """Set up HMC and warm it up for `nadapt` steps.
+
+    Warm-up follows a windowed schedule set by `init_buffer`, `base_window`
+    and `term_buffer`. If `early_stop`, it ends once the step size and
+    metric have converged, after at least `min_adapt` steps (see
+    `IMP.hmc.adaptor.Adaptor`).
+
+    With `engine="numpy"`, `metric` may also be "lowrank", estimated with
+    rank `metric_rank`, or "block", estimated over `metric_blocks`, a list of
+    groups of particles (by default, one block per particle). See
+    `IMP.hmc.metrics`.
+
+    If `slow_restraints` are given (with `engine="numpy"`), a
+    multiple-time-step integrator is used that evaluates them only once for
+    every `n_fast_steps` evaluations of the other restraints (see
+    `split_scoring_function` and `IMP.hmc.nuts.MultipleTimeStepLeapfrog`).
+
+    If `logpdf_workers` is given, groups of restraints are instead scored
+    concurrently by that many replicas of the model built by `sf_factory`,
+    in worker processes or threads according to `logpdf_worker_mode` (see
+    `IMP.hmc.parallel.ParallelLogDensity`, whose workers are shut down by
+    `hmc.close()` or when it is garbage collected).
+
+    If `beta` is given, the scoring function is tempered by that inverse
+    temperature (see `IMP.hmc.tempering`). It cannot be combined with
+    `slow_restraints`.
+
+    With `batch_size > 1`, `optimize` runs that many transitions per call
+    into the sampler, updating optimizer states only at the transitions at
+    which they are due (see `HamiltonianMonteCarlo.sample_batch`).
+
+    If `init_metric` is "curvature", the metric is seeded before warm-up
+    from the curvature of the log density at the initial position,
+    estimated with `init_metric_probes` probes, and if "heuristic", from the
+    scales suggested by the transformations alone (see
+    `IMP.hmc.curvature`). It is ignored with `warm_start`.
+
+    If `init_optimize`, the log density is first maximized with L-BFGS
+    from the initial position and from `init_restarts` random perturbations
+    of it with standard deviation `init_sigma` in free space, which run in
+    up to `init_workers` worker processes if `sf_factory` is given. The
+    chain starts at the best point found, and, unless `init_metric` is
+    given, the metric is seeded with the L-BFGS inverse Hessian diagonal
+    (see `IMP.hmc.initialization`). It is ignored with `warm_start`.
+
+    If `warm_start` is the path to a checkpoint of a previous run (see
+    `IMP.hmc.checkpoint`), its adapted metric and step size are used to start
+    the warm-up, which can then be shortened or skipped with `nadapt=0`. If
+    `checkpoint_path` is given, the warm-up is checkpointed there every
+    `checkpoint_period` steps and, if a checkpoint already exists there, is
+    resumed from it.
+
+    If `instrumentation` is given, it records the time spent in each phase of
+    sampling (see `IMP.hmc.instrumentation`). Progress messages are passed to
+    `log`.
+    """
     m = sf.get_model()
     hmc_vars = OptimizedVariables(m)
     if shuffle:
         hmc_vars.shuffle(shuffle_sigma)
     interface = hmc_vars.get_interface()
     transformation = hmc_vars.get_transformation()
-    logpdf = TransformedLogDensity(LogDensity(sf, interface), transformation)
-    hmc = HamiltonianMonteCarlo(
-        sf,
-        hmc_vars,
-        logpdf,
-        hmc_type=hmc_type,
-        max_depth=max_depth,
-        metric=metric,
-        save_samples=save_warmup,
-    )
-    hmc.add_optimizer_states(warmup_optimizer_states)
+    if slow_restraints:
+        if logpdf_workers is not None:
+            raise ValueError(
+                "slow_restraints cannot be combined with logpdf_workers"
+            )
+        if beta is not None:
+            raise ValueError("slow_restraints cannot be combined with beta")
+        fast_sf, slow_sf = split_scoring_function(sf, slow_restraints)
+        logpdf = SplitLogDensity(
+            LogDensity(fast_sf, interface),
+            LogDensity(slow_sf, interface),
+            transformation,
+            backend=transform_backend,
+        )
+    else:
+        if logpdf_workers is not None:
+            from .parallel import ParallelLogDensity
 
-    if nadapt > 0:
-        adaptor = Adaptor(hmc, nadapt=nadapt, adapt_delta=adapt_delta)
-        adaptor.adapt(log_freq=log_freq, verbose=verbose)
-        adapt_stats = hmc.stats
-        adapt_samples = hmc.sample_saver.get_values()
-        hmc.stats = None
-        hmc.samples = None
-        return hmc, adapt_stats, adapt_samples
+            if sf_factory is None:
+                raise ValueError("logpdf_workers requires sf_factory")
+            logpdf = ParallelLogDensity(
+                sf_factory,
+                sf,
+                hmc_vars,
+                nworkers=logpdf_workers,
+                groups=restraint_groups,
+                mode=logpdf_worker_mode,
+            )
+        else:
+            logpdf = LogDensity(sf, interface)
+        if beta is not None:
+            logpdf = TemperedLogDensity(logpdf, beta)
+        logpdf = TransformedLogDensity(
+            logpdf, transformation, backend=transform_backend
+        )
+    try:
+        hmc = HamiltonianMonteCarlo(
+            sf,
+            hmc_vars,
+            logpdf,
+            hmc_type=hmc_type,
+            max_depth=max_depth,
+            metric=metric,
+            save_samples=save_warmup,
+            save_period=save_period,
+            save_indexes=save_indexes,
+            engine=engine,
+            log=log,
+            n_fast_steps=n_fast_steps,
+        )
+        hmc.set_instrumentation(instrumentation)
+        hmc.set_batch_size(batch_size)
+        hmc.add_optimizer_states(warmup_optimizer_states)
+        blocks = (
+            hmc_vars.get_blocks(metric_blocks) if metric == "block" else None
+        )
+        if warm_start is not None:
+            hmc.warm_start(warm_start)
+        else:
+            if init_optimize:
+                from .initialization import initialize_hmc
 
-    return hmc
+                initialize_hmc(
+                    hmc,
+                    init_metric=init_metric is None,
+                    blocks=blocks,
+                    nrestarts=init_restarts,
+                    sigma=init_sigma,
+                    sf_factory=sf_factory,
+                    nworkers=init_workers,
+                    seed=int(np.random.randint(1, 2 ** 31 - 1)),
+                )
+            if init_metric is not None:
+                from .curvature import seed_metric
+
+                seed_metric(
+                    hmc,
+                    method=init_metric,
+                    nprobes=init_metric_probes,
+                    blocks=blocks,
+                )
+
+        if nadapt > 0:
+            adaptor = Adaptor(
+                hmc,
+                nadapt=nadapt,
+                adapt_delta=adapt_delta,
+                init_buffer=init_buffer,
+                term_buffer=term_buffer,
+                base_window=base_window,
+                early_stop=early_stop,
+                min_steps=min_adapt,
+                metric_rank=metric_rank,
+                metric_blocks=blocks,
+            )
+            if checkpoint_path is not None and os.path.exists(checkpoint_path):
+                adaptor.restore_checkpoint(checkpoint_path)
+            adaptor.adapt(
+                log_freq=log_freq,
+                verbose=verbose,
+                checkpoint_path=checkpoint_path,
+                checkpoint_period=checkpoint_period,
+            )
+            adapt_stats = hmc.stats
+            adapt_samples = hmc.sample_saver.get_values_numpy().copy()
+            hmc.sample_saver.clear()
+            hmc.stats = None
+            hmc.samples = None
+            return hmc, adapt_stats, adapt_samples
+
+        return hmc
+    except BaseException:
+        # shut down any workers of the log density
+        logpdf.close()
+        raise
 
 
 def setup_warmup_run_hmc(
@@ -53,17 +314,67 @@ def setup_warmup_run_hmc(
     nsample=2000,
     save_samples=True,
     sample_optimizer_states=[],
+    seed=None,
+    convergence=None,
+    check_every=100,
+    store=None,
+    store_block=1000,
     **warmup_kwargs
 ):
+    """Warm up and run HMC, returning the `HamiltonianMonteCarlo`.
+
+    If `seed` is given, it seeds the IMP, NumPy and Julia random number
+    generators. To run several chains in worker processes, use
+    `IMP.hmc.parallel.run_chains`, which calls this function for each chain.
+
+    If `convergence` is an `IMP.hmc.convergence.StoppingCriteria`, sampling
+    stops early once it is met, sampling in blocks of `check_every` samples
+    and checking at geometrically growing intervals (see
+    `IMP.hmc.convergence.sample_until_converged`); `nsample` is then the
+    maximum number of samples.
+
+    If `store`, an `IMP.hmc.store.ChainWriter`, is given, samples and
+    statistics are instead moved to disk every `store_block` samples, so
+    that long runs do not hold them all in memory.
+    """
+    if seed is not None:
+        from .parallel import seed_all
+
+        seed_all(seed)
+
     hmc = setup_warmup_hmc(sf, **warmup_kwargs)
     if "nadapt" not in warmup_kwargs or warmup_kwargs["nadapt"] > 0:
         hmc, _, _ = hmc
 
-    print("Sampling from HMC for {0} steps.".format(nsample))
-    hmc.set_save_samples(save_samples)
     hmc.add_optimizer_states(sample_optimizer_states)
-    hmc.optimize(nsample)
+    if store is not None:
+        from .store import sample_to_store
+
+        if convergence is not None:
+            raise ValueError(
+                "Stopping on convergence is not supported with a store."
+            )
+        hmc.log("Sampling from HMC for {0} steps to store.".format(nsample))
+        sample_to_store(hmc, store, nsample, block_size=store_block)
+        return hmc
+    elif convergence is None:
+        hmc.log("Sampling from HMC for {0} steps.".format(nsample))
+        hmc.set_save_samples(save_samples)
+        hmc.optimize(nsample)
+    else:
+        from .convergence import LocalChain, sample_until_converged
+
+        hmc.log("Sampling from HMC for up to {0} steps.".format(nsample))
+        sample_until_converged(
+            [LocalChain(hmc)],
+            convergence,
+            nsample,
+            block_size=check_every,
+            log=hmc.log,
+        )
 
-    hmc.stats.log_mean()
+    hmc.stats.log_mean(log=hmc.log)
+    if hmc.get_instrumentation() is not None:
+        hmc.get_instrumentation().log_summary(log=hmc.log)
 
     return hmc
@@ -2,22 +2,39 @@ import numpy as np
 import arviz as az
 
 
+def _get_chain_dataset(samples, stats, varnames):
+    posterior = {name: samples[:, i] for i, name in enumerate(varnames)}
+    return az.from_dict(posterior=posterior, sample_stats=stats)
+
+
 def get_inference_data(*hmcs, **kwargs):
     """Build an Arviz `InferenceData` instance from 1 or more chains."""
     varnames = kwargs.get("varnames", None)
     if varnames is None:
-        varnames = hmcs[0].opt_vars.get_names()
+        varnames = hmcs[0].get_sample_names()
+
+    chains = [
+        (hmc.sample_saver.get_values_numpy(), hmc.stats.get_samples())
+        for hmc in hmcs
+    ]
+    return get_inference_data_from_chains(chains, varnames=varnames)
+
+
+def get_inference_data_from_chains(chains, varnames):
+    """Build an Arviz `InferenceData` instance from `(samples, stats)` pairs.
+
+    `samples` is a (nsamples, ndim) array and `stats` a dict of per-sample
+    statistics arrays."""
+    datasets = [
+        _get_chain_dataset(samples, stats, varnames)
+        for samples, stats in chains
+    ]
+    return az.concat(*datasets, dim="chain")
 
-    datasets = []
-    for hmc in hmcs:
-        posterior = dict(
-            zip(varnames, map(np.array, zip(*hmc.sample_saver.get_values())))
-        )
-        dataset = az.from_dict(
-            posterior=posterior, sample_stats=hmc.stats.get_samples()
-        )
-        datasets.append(dataset)
 
-    dataset = az.concat(*datasets, dim="chain")
+def open_inference_data(path, varnames=None):
+    """Open the samples in an `IMP.hmc.store.SampleStore` as a lazily loaded
+    Arviz `InferenceData` instance."""
+    from .store import SampleStore
 
-    return dataset
+    return SampleStore(path).get_inference_data(varnames=varnames)
@@ -1,6 +1,8 @@
 import numpy as np
 
-from .julia import AdvancedHMC
+from .julia import Main, AdvancedHMC
+from . import nuts
+from .metrics import get_cholesky
 
 
 def is_approx_identity_matrix(M):
@@ -14,61 +16,161 @@ def is_approx_diagonal_matrix(M):
 
 
 def is_positive_definite_matrix(x):
-    return np.all(np.linalg.eigvals(x) > 0)
+    return get_cholesky(x) is not None
+
+
+_julia_get_inverse_metric = None
+
+
+def _get_julia_inverse_metric(metric):
+    global _julia_get_inverse_metric
+    if _julia_get_inverse_metric is None:
+        _julia_get_inverse_metric = Main.eval("x -> getproperty(x, :(M⁻¹))")
+    return _julia_get_inverse_metric(metric)
+
+
+def get_backend(engine):
+    """Get the module implementing the sampler for the given engine."""
+    if engine == "julia":
+        return AdvancedHMC
+    elif engine == "numpy":
+        return nuts
+    raise ValueError("'engine' must be in {'julia', 'numpy'}")
 
 
 class Hamiltonian(object):
 
-    """Currently just a thin wrapper for an `AdvancdHMC.Hamiltonian`."""
+    """Currently just a thin wrapper for an `AdvancdHMC.Hamiltonian`.
 
-    def __init__(self, log_density, metric="diag"):
+    With `engine="numpy"`, `IMP.hmc.nuts` is used instead of AdvancedHMC."""
+
+    def __init__(self, log_density, metric="diag", engine="julia"):
         self.logpdf = log_density
+        self.engine = engine
+        self.backend = get_backend(engine)
         self.create_hamiltonian(metric)
 
     def create_metric(self, metric):
-        try:
-            M = np.array(metric, dtype=np.double)
-            m, n = np.shape
-            if m != n or n != self.logpdf.get_dimension():
+        """Create the metric from a name or an inverse metric.
+
+        An inverse metric may be given as a vector (diagonal) or a matrix.
+        With the NumPy engine, the names "lowrank" and "block" (initially
+        the identity) and instances of the metrics of `IMP.hmc.metrics` are
+        also accepted."""
+        n = self.logpdf.get_dimension()
+        if isinstance(
+            metric, (nuts.LowRankEuclideanMetric, nuts.BlockDiagEuclideanMetric)
+        ):
+            self._check_structured_metric(metric.metric_type)
+            if metric.get_dimension() != n:
+                raise ValueError(
+                    "Metric must have the same dimension as the number of "
+                    "free variables"
+                )
+            self.metric_type = metric.metric_type
+            return metric
+        if isinstance(metric, str):
+            if metric == "unit":
+                self.metric_type = "unit"
+                return self.backend.UnitEuclideanMetric(n)
+            elif metric == "diag":
+                self.metric_type = "diag"
+                return self.backend.DiagEuclideanMetric(n)
+            elif metric == "dense":
+                self.metric_type = "dense"
+                return self.backend.DenseEuclideanMetric(n)
+            elif metric == "lowrank":
+                self._check_structured_metric(metric)
+                self.metric_type = "lowrank"
+                return nuts.LowRankEuclideanMetric(n)
+            elif metric == "block":
+                self._check_structured_metric(metric)
+                self.metric_type = "block"
+                return nuts.BlockDiagEuclideanMetric(n)
+            raise ValueError(
+                "metric_type must be either a matrix or "
+                "{'unit', 'diag', 'dense', 'lowrank', 'block'}"
+            )
+
+        M = np.array(metric, dtype=np.double)
+        if M.ndim == 1:
+            if M.shape[0] != n:
                 raise ValueError(
-                    "Metric matrix must be square with the same size in each ",
-                    "dimension as the number of free variables",
+                    "Metric vector must have the same length as the number "
+                    "of free variables"
                 )
-            if is_approx_identity_matrix(M):
-                return AdvancedHMC.UnitEuclideanMetric(n)
-            elif is_approx_diagonal_matrix(M):
-                return AdvancedHMC.DiagEuclideanMetric(M)
-            elif is_positive_definite_matrix(M):
-                return AdvancedHMC.DenseEuclideanMetric(M)
-            else:
-                raise ValueError("Metric matrix is not positive definite")
-        except ValueError:
-            pass
+            if np.any(M <= 0):
+                raise ValueError("Metric vector must be positive")
+            self.metric_type = "diag"
+            return self.backend.DiagEuclideanMetric(M)
 
-        n = self.logpdf.get_dimension()
-        if metric == "unit":
-            return AdvancedHMC.UnitEuclideanMetric(n)
-        elif metric == "diag":
-            return AdvancedHMC.DiagEuclideanMetric(n)
-        elif metric == "dense":
-            return AdvancedHMC.DenseEuclideanMetric(n)
-        else:
+        if M.ndim != 2 or M.shape != (n, n):
+            raise ValueError(
+                "Metric matrix must be square with the same size in each "
+                "dimension as the number of free variables"
+            )
+        if is_approx_identity_matrix(M):
+            self.metric_type = "unit"
+            return self.backend.UnitEuclideanMetric(n)
+        elif is_approx_diagonal_matrix(M):
+            self.metric_type = "diag"
+            return self.backend.DiagEuclideanMetric(np.diag(M).copy())
+        L = get_cholesky(M)
+        if L is None:
+            raise ValueError("Metric matrix is not positive definite")
+        self.metric_type = "dense"
+        if self.engine == "numpy":
+            return self.backend.DenseEuclideanMetric(M, cholesky=L)
+        return self.backend.DenseEuclideanMetric(M)
+
+    def _check_structured_metric(self, metric_type):
+        if self.engine != "numpy":
             raise ValueError(
-                "metric_type must be either a matrix or ",
-                "{'unit', 'diag', 'dense'}",
+                "The {0} metric requires engine='numpy'".format(metric_type)
             )
 
     @property
     def metric(self):
         return self.hamiltonian.metric
 
+    def is_split(self):
+        """Whether the log density is split into fast and slow parts (see
+        `IMP.hmc.log_density.SplitLogDensity`)."""
+        return hasattr(self.logpdf, "get_slow_logpdf_with_gradient")
+
     def create_hamiltonian(self, metric):
         metric = self.create_metric(metric)
-        self.hamiltonian = AdvancedHMC.Hamiltonian(
+        if self.is_split():
+            if self.engine != "numpy":
+                raise ValueError(
+                    "A split log density requires engine='numpy'"
+                )
+            self.hamiltonian = nuts.SplitHamiltonian(
+                metric,
+                self.logpdf.get_logpdf,
+                self.logpdf.get_logpdf_with_gradient,
+                self.logpdf.get_fast_logpdf_with_gradient,
+                self.logpdf.get_slow_logpdf_with_gradient,
+            )
+            return
+        self.hamiltonian = self.backend.Hamiltonian(
             metric,
             self.logpdf.get_logpdf,
             self.logpdf.get_logpdf_with_gradient,
         )
 
+    def get_inverse_metric(self):
+        """Get the inverse metric as a vector (diagonal) or matrix.
+
+        Low-rank and block-diagonal metrics are not stored as a matrix, so
+        only their diagonal is returned; use `metric` for the full metric."""
+        if self.metric_type in ("lowrank", "block"):
+            return self.metric.get_diagonal()
+        if self.metric_type == "unit":
+            return np.ones(self.logpdf.get_dimension())
+        if self.engine == "numpy":
+            return self.metric.Minv
+        return _get_julia_inverse_metric(self.metric)
+
     def get_energy(self):
         return AdvancedHMC.energy(self.hamiltonian)
@@ -3,7 +3,48 @@ import numpy as np
 
 from .hamiltonian import Hamiltonian
 from .accumulator import SampleAccumulator, StatisticsAccumulator
-from .julia import Main, HMCUtilities, AdvancedHMC
+from .julia import Main, HMCUtilities
+from . import nuts
+from . import checkpoint
+from .instrumentation import Timer
+
+
+_julia_sample_n = None
+_julia_nuts = None
+
+
+def _get_julia_nuts():
+    """Get the Julia NUTS sampler type used for dynamic HMC."""
+    global _julia_nuts
+    if _julia_nuts is None:
+        _julia_nuts = Main.eval(
+            "AdvancedHMC.NUTS{AdvancedHMC.MultinomialTS,AdvancedHMC.GeneralisedNoUTurn}"
+        )
+    return _julia_nuts
+
+
+def _get_julia_sample_n():
+    """Get a Julia function running several transitions, with the same
+    interface as `nuts.sample_n`."""
+    global _julia_sample_n
+    if _julia_sample_n is None:
+        _julia_sample_n = Main.eval(
+            """
+            function (h, sampler, z, n)
+                θ = HMCUtilities.position(z)
+                positions = Matrix{Float64}(undef, n, length(θ))
+                stats = Vector{Any}(undef, n)
+                for i in 1:n
+                    z, stats[i] = HMCUtilities.sample(h, sampler, z)
+                    positions[i, :] .= HMCUtilities.position(z)
+                end
+                ks = collect(keys(stats[1]))
+                columns = Any[[s[k] for s in stats] for k in ks]
+                return z, positions, String.(ks), columns
+            end
+            """
+        )
+    return _julia_sample_n
 
 
 class HamiltonianMonteCarlo(IMP.Optimizer):
@@ -29,25 +70,85 @@ class HamiltonianMonteCarlo(IMP.Optimizer):
         max_depth=10,
         metric="diag",
         save_samples=False,
+        save_period=1,
+        save_indexes=None,
+        engine="julia",
+        log=print,
+        n_fast_steps=4,
         name="HamiltonianMonteCarlo%1%",
     ):
         m = sf.get_model()
         super().__init__(m, name)
         self.set_scoring_function(sf)
         self.opt_vars = opt_vars
+        self.log = log
+        self.instrumentation = None
         self.interface = opt_vars.get_interface()
         self.transformation = opt_vars.get_transformation()
-        self.hamiltonian = Hamiltonian(logpdf, metric=metric)
+        self._x = np.empty(self.interface.get_dimension(), dtype=np.double)
+        self.hamiltonian = Hamiltonian(logpdf, metric=metric, engine=engine)
+        self.engine = engine
+        self.backend = self.hamiltonian.backend
+        if engine == "numpy":
+            self.utilities = nuts
+        else:
+            self.utilities = HMCUtilities
         self.phasepoint = None
         self.integrator = None
+        self._step_size = None
         self.sampler = None
+        self.is_adapt = False
+        self.hmc_type = hmc_type
+        self.n_fast_steps = n_fast_steps
         self.create_integrator()
         self.create_sampler(hmc_type=hmc_type, max_depth=max_depth)
         self.max_depth = max_depth
         self.create_phasepoint()
         self.stats = None
-        self.sample_saver = IMP.hmc.SaveAttributesOptimizerState(self.interface)
+        if save_indexes is None:
+            self.sample_saver = IMP.hmc.SaveAttributesOptimizerState(
+                self.interface
+            )
+        else:
+            self.sample_saver = IMP.hmc.SaveAttributesOptimizerState(
+                self.interface, save_indexes
+            )
+        self.sample_saver.set_period(save_period)
         self.set_save_samples(save_samples)
+        self.checkpoint_path = None
+        self.checkpoint_period = 100
+        self._checkpoint_progress = None
+        self.batch_size = 1
+        self._state_schedule = []
+
+    def set_checkpoint(self, path, period=100):
+        """Save a checkpoint to `path` every `period` transitions and at the
+        end of `optimize`.
+
+        See `IMP.hmc.checkpoint`. Set `path` to None to stop saving
+        checkpoints."""
+        self.checkpoint_path = path
+        self.checkpoint_period = period
+
+    def save_checkpoint(self, path=None):
+        """Save the state of the sampler to `path` (by default the path set
+        with `set_checkpoint`)."""
+        if path is None:
+            path = self.checkpoint_path
+        checkpoint.save_checkpoint(path, self)
+
+    def restore_checkpoint(self, path, rng=True, samples=True):
+        """Restore the state of the sampler from a checkpoint."""
+        checkpoint.restore_checkpoint(path, self, rng=rng, samples=samples)
+
+    def warm_start(self, path):
+        """Use the metric and step size saved in a checkpoint."""
+        checkpoint.warm_start(path, self)
+
+    def set_batch_size(self, batch_size):
+        """Run up to `batch_size` transitions per call into the sampler in
+        `optimize` (see `sample_batch`)."""
+        self.batch_size = max(int(batch_size), 1)
 
     def get_save_samples(self):
         return self._save_samples
@@ -62,37 +163,116 @@ class HamiltonianMonteCarlo(IMP.Optimizer):
             if self.sample_saver in oss:
                 self.remove_optimizer_state(self.sample_saver)
 
+    def set_instrumentation(self, instrumentation):
+        """Time the phases of each transition with an
+        `IMP.hmc.instrumentation.Instrumentation`, or stop if None.
+
+        While instrumented, the time spent in each phase and the number of
+        gradient evaluations and cache hits are added to the statistics of
+        each transition. Since this changes the recorded statistics, it must
+        be set before the first transition, or `stats` reset to None;
+        otherwise recording the next transition raises a ValueError."""
+        if instrumentation is not None:
+            instrumentation.mark()
+        self.instrumentation = instrumentation
+        self.hamiltonian.logpdf.set_instrumentation(instrumentation)
+
+    def get_instrumentation(self):
+        return self.instrumentation
+
     def init_step_size(self):
-        print("Initializing step size")
-        return AdvancedHMC.find_good_eps(
-            self.hamiltonian.hamiltonian,
-            HMCUtilities.free(
-                self.transformation, self.interface.get_values()
-            ),
+        """Find a reasonable step size at the current position of the chain,
+        or at the state of the model if the chain has not started."""
+        self.log("Initializing step size")
+        if self.phasepoint is None:
+            position = self.transformation.free(self.get_values())
+        else:
+            position = self.get_position()
+        return self.backend.find_good_eps(
+            self.hamiltonian.hamiltonian, position
         )
 
+    def make_integrator(self, step_size):
+        """Make an integrator with the given step size.
+
+        If the log density is split into fast and slow parts, this is a
+        `nuts.MultipleTimeStepLeapfrog` taking `n_fast_steps` steps of the
+        fast part per step; otherwise it is a leapfrog integrator."""
+        if self.hamiltonian.is_split():
+            return nuts.MultipleTimeStepLeapfrog(step_size, self.n_fast_steps)
+        return self.backend.Leapfrog(step_size)
+
     def create_integrator(self):
         eps = self.init_step_size()
-        self.integrator = AdvancedHMC.Leapfrog(eps)
+        self.integrator = self.make_integrator(eps)
+        self._step_size = eps
 
     def create_sampler(self, hmc_type="dynamic", max_depth=10):
-        if hmc_type == "dynamic":
-            self.sampler = Main.eval(
-                "AdvancedHMC.NUTS{AdvancedHMC.MultinomialTS,AdvancedHMC.GeneralisedNoUTurn}"
-            )(self.integrator, max_depth)
+        if self.engine == "numpy" and hmc_type == "dynamic":
+            self.sampler = nuts.NUTS(self.integrator, max_depth)
+        elif hmc_type == "dynamic":
+            self.sampler = _get_julia_nuts()(self.integrator, max_depth)
         elif hmc_type == "static":
-            self.sampler = AdvancedHMC.StaticTrajectory(self.integrator)
+            self.sampler = self.backend.StaticTrajectory(self.integrator)
         else:
             raise ValueError("'hmc_type' must be in {'dynamic', 'static'}")
 
-    def create_phasepoint(self):
-        self.phasepoint = HMCUtilities.make_phasepoint(
-            self.hamiltonian.hamiltonian,
-            HMCUtilities.free(
-                self.transformation, self.interface.get_values()
-            ),
+    def create_phasepoint(self, position=None):
+        if position is None:
+            position = self.transformation.free(self.get_values())
+        self.phasepoint = self.utilities.make_phasepoint(
+            self.hamiltonian.hamiltonian, position
         )
 
+    def get_position(self):
+        """Get the current position of the chain in free space."""
+        return np.asarray(self.utilities.position(self.phasepoint))
+
+    def set_step_size(self, step_size):
+        """Set the step size of the integrator.
+
+        The integrator and sampler are only rebuilt if the step size
+        changes."""
+        if step_size == self._step_size:
+            return
+        self.integrator = self.make_integrator(step_size)
+        self._step_size = step_size
+        self.create_sampler(hmc_type=self.hmc_type, max_depth=self.max_depth)
+
+    def set_is_adapt(self, tf):
+        """Set whether transitions are marked as warm-up transitions in the
+        `tune` statistic."""
+        self.is_adapt = bool(tf)
+
+    def set_metric(self, metric):
+        """Set the metric from a name or inverse metric vector/matrix.
+
+        The chain keeps its current position."""
+        position = self.get_position()
+        self.hamiltonian.create_hamiltonian(metric)
+        self.create_phasepoint(position)
+
+    def close(self):
+        """Release the resources held by the log density, such as the worker
+        processes of an `IMP.hmc.parallel.ParallelLogDensity`."""
+        self.hamiltonian.logpdf.close()
+
+    def clear_cache(self):
+        """Clear any cached evaluations of the log density.
+
+        This must be called if the scoring function is changed between calls
+        to `sample`; `optimize` does so automatically."""
+        self.hamiltonian.logpdf.clear_cache()
+
+    def get_values(self):
+        """Get the current values of the optimized attributes."""
+        self.interface.get_values_into(self._x)
+        return self._x
+
+    def set_values(self, x):
+        """Set the optimized attributes from a vector of values."""
+        self.interface.set_values_from(np.ascontiguousarray(x, dtype=np.double))
+
     def do_get_inputs(self):
         return [
             self.get_model().get_particle(pi)
@@ -101,20 +281,101 @@ class HamiltonianMonteCarlo(IMP.Optimizer):
 
     def do_optimize(self, ns):
         self.before_optimize()
-        for n in range(ns):
-            self.before_sample()
-            self.sample()
-            self.after_sample()
+        if self.batch_size > 1:
+            self._optimize_batched(ns)
+        else:
+            for n in range(ns):
+                self.before_sample()
+                self.sample()
+                self.after_sample()
+                if (
+                    self.checkpoint_path is not None
+                    and (n + 1) % self.checkpoint_period == 0
+                ):
+                    self.save_checkpoint()
+        if self.checkpoint_path is not None:
+            self.save_checkpoint()
         self.after_optimize()
         return self.get_scoring_function().get_last_score()
 
+    def sample_block(self, nsample):
+        """Run `nsample` transitions, saving samples, and return the values
+        saved during them as an array (nsaved, nvars).
+
+        Unlike `optimize`, previously saved samples are kept. See
+        `IMP.hmc.convergence.sample_until_converged`."""
+        if not self.get_save_samples():
+            self.set_save_samples(True)
+        start = self.sample_saver.get_number_of_samples()
+        self.optimize(nsample)
+        return self.sample_saver.get_values_numpy()[start:].copy()
+
+    def _optimize_batched(self, ns):
+        n = 0
+        while n < ns:
+            nbatch = min(self.batch_size, ns - n)
+            if self.checkpoint_path is not None:
+                nbatch = min(
+                    nbatch, self.checkpoint_period - n % self.checkpoint_period
+                )
+            positions, _ = self.sample_batch(nbatch)
+            with Timer(self.instrumentation, "after_sample"):
+                self._update_due_states(self._get_due_states(nbatch), positions)
+            n += nbatch
+            if (
+                self.checkpoint_path is not None
+                and n % self.checkpoint_period == 0
+            ):
+                self.save_checkpoint()
+
     def before_optimize(self):
+        self.clear_cache()
         self.get_scoring_function().evaluate(True)
         self.create_phasepoint()
+        self._update_state_schedule()
+
+    def _update_state_schedule(self):
+        """Set up the schedule of the current optimizer states.
+
+        Each state keeps its count of transitions across calls to
+        `optimize`, as IMP does for `update_states`, so that periodic
+        states stay evenly spaced when sampling in chunks."""
+        schedule = []
+        for state in self.get_optimizer_states():
+            period = max(state.get_period(), 1)
+            count = 0
+            for entry in self._state_schedule:
+                if entry[0] == state:
+                    count = entry[2] % period
+                    break
+            # the sample saver only reads the optimized attributes, so does
+            # not need the model to be updated
+            schedule.append([state, period, count, state != self.sample_saver])
+        self._state_schedule = schedule
 
     def after_optimize(self):
+        self.update_model()
+
+    def update_model(self):
+        """Set the model to the current position of the chain.
+
+        During `optimize`, the model is only updated at transitions at which
+        an optimizer state is due, and at the end."""
+        self.set_values(
+            self.transformation.constrain(
+                self.utilities.position(self.phasepoint)
+            )
+        )
         self.get_model().update()
 
+    def get_sample_names(self):
+        """Get the names of the variables recorded by `sample_saver`."""
+        names = self.opt_vars.get_names()
+        indexes = self.sample_saver.get_indexes()
+        if len(indexes) == 0:
+            return names
+        return [names[i] for i in indexes]
+
     def is_adapting(self):
         return self.adaptor is not None or self.adaptor.is_adapting()
 
@@ -124,31 +385,110 @@ class HamiltonianMonteCarlo(IMP.Optimizer):
 
     @property
     def step_size(self):
-        return HMCUtilities.step_size(self.integrator)
+        return self.utilities.step_size(self.integrator)
 
     def sample(self):
-        self.phasepoint, stats = HMCUtilities.sample(
-            self.hamiltonian.hamiltonian, self.sampler, self.phasepoint
+        inst = self.instrumentation
+        with Timer(inst, "transition"):
+            self.phasepoint, stats = self.utilities.sample(
+                self.hamiltonian.hamiltonian, self.sampler, self.phasepoint
+            )
+
+        if self.engine == "julia":
+            stats = Main.pairs(stats)
+        stats = dict(stats)
+        stats["is_adapt"] = self.is_adapt
+        if inst is not None:
+            inst.increment("transitions")
+            stats.update(inst.get_sample_stats())
+        self._check_stats_keys(
+            [self._stats_key_map.get(k, k) for k in stats.keys()]
         )
+        self.stats.add_sample(stats)
+
+    def sample_batch(self, n):
+        """Run `n` transitions in a single call into the sampler.
+
+        Statistics are added to `self.stats` as for `sample`, but the model
+        and optimizer states are not updated. Returns the positions in free
+        space as an array (n, ndim) and a dict of the statistics of each
+        transition. While instrumented, the timings and counts of the batch
+        are divided evenly among its transitions."""
+        inst = self.instrumentation
+        if self.engine == "julia":
+            sample_n = _get_julia_sample_n()
+        else:
+            sample_n = nuts.sample_n
+        with Timer(inst, "transition"):
+            self.phasepoint, positions, keys, columns = sample_n(
+                self.hamiltonian.hamiltonian, self.sampler, self.phasepoint, n
+            )
+        positions = np.asarray(positions, dtype=np.double)
+        columns = [
+            np.full(n, self.is_adapt) if k == "is_adapt" else np.asarray(c)
+            for k, c in zip(keys, columns)
+        ]
+        keys = [self._stats_key_map.get(k, k) for k in keys]
+        if inst is not None:
+            inst.increment("transitions", n)
+            for k, v in inst.get_sample_stats().items():
+                keys.append(k)
+                columns.append(np.full(n, v / n))
+        self._check_stats_keys(keys)
+        self.stats.add_samples(columns)
+        return positions, dict(zip(keys, columns))
+
+    def _check_stats_keys(self, keys):
+        """Create the statistics accumulator with `keys`, or check that
+        `keys` are those already being recorded."""
+        if self.stats is None:
+            self.stats = StatisticsAccumulator(keys)
+        elif list(keys) != self.stats.keys:
+            raise ValueError(
+                "Statistics of this transition ({0}) do not match those "
+                "already recorded ({1}). Set `stats` to None to start "
+                "recording new statistics.".format(
+                    ", ".join(keys), ", ".join(self.stats.keys)
+                )
+            )
+
+    def _get_due_states(self, n):
+        """Advance the optimizer state schedule by `n` transitions and get a
+        dict from the index of each transition at which any state is due to
+        a list of `(state, needs_model_update)` pairs.
 
-        stats = Main.pairs(stats)
-        try:
-            self.stats.add_sample(stats)
-        except AttributeError:
-            stats_keys = [self._stats_key_map.get(k, k) for k in stats.keys()]
-            self.stats = StatisticsAccumulator(stats_keys)
-            self.stats.add_sample(stats)
+        Each state is due every `state.get_period()` transitions, starting
+        with the first transition after it was added, as for
+        `update_states`."""
+        due = {}
+        for entry in self._state_schedule:
+            state, period, count, needs_update = entry
+            for i in range((-count) % period, n, period):
+                due.setdefault(i, []).append((state, needs_update))
+            entry[2] = (count + n) % period
+        return due
+
+    def _update_due_states(self, due, positions):
+        """Set the model to the positions at which states are due and
+        update those states."""
+        for i in sorted(due):
+            self.set_values(self.transformation.constrain(positions[i]))
+            if any(needs_update for _, needs_update in due[i]):
+                self.get_model().update()
+            for state, _ in due[i]:
+                state.update_always()
 
     def before_sample(self):
         pass
 
     def after_sample(self):
-        self.interface.set_values(
-            HMCUtilities.constrain(
-                self.transformation,
-                HMCUtilities.position(self.phasepoint)
+        with Timer(self.instrumentation, "after_sample"):
+            self._after_sample()
+
+    def _after_sample(self):
+        # the chain stays in free space unless an optimizer state is due
+        due = self._get_due_states(1)
+        if due:
+            self._update_due_states(
+                due, [self.utilities.position(self.phasepoint)]
             )
-        )
-        if self.get_has_optimizer_states():
-            self.get_model().update()
-            self.update_states()
@@ -0,0 +1,262 @@
+"""Initialization of the sampler by optimization.
+
+Starting from the current state of the model, or from a random draw, chains
+often start far in the tails, where the first warm-up steps run at maximum
+tree depth. This module instead first maximizes the log density in free
+space with L-BFGS (Nocedal, Math Comp 1980), using only its gradient, e.g.
+`TransformedLogDensity.get_logpdf_with_gradient`, and hands the best point
+to the sampler along with the diagonal of the L-BFGS estimate of the
+inverse Hessian, computed from its compact representation (Byrd, Nocedal
+and Schnabel, Math Prog 1994) as an initial metric.
+
+Random restarts can be run in worker processes with `find_initial_point`.
+"""
+
+import collections
+
+import numpy as np
+
+from .parallel import WorkerProxy, get_chain_seeds, seed_all
+
+LBFGSResult = collections.namedtuple(
+    "LBFGSResult",
+    [
+        "position",
+        "logp",
+        "grad",
+        "niter",
+        "nevals",
+        "converged",
+        "inverse_hessian_diagonal",
+    ],
+)
+
+
+def _two_loop(g, S, Y):
+    """Apply the L-BFGS inverse Hessian approximation to `g`."""
+    q = g.copy()
+    rhos = [1 / np.dot(s, y) for s, y in zip(S, Y)]
+    alphas = []
+    for s, y, rho in reversed(list(zip(S, Y, rhos))):
+        alpha = rho * np.dot(s, q)
+        q -= alpha * y
+        alphas.append(alpha)
+    if S:
+        q *= np.dot(S[-1], Y[-1]) / np.dot(Y[-1], Y[-1])
+    for (s, y, rho), alpha in zip(zip(S, Y, rhos), reversed(alphas)):
+        beta = rho * np.dot(y, q)
+        q += (alpha - beta) * s
+    return q
+
+
+def get_lbfgs_inverse_hessian_diagonal(S, Y):
+    """Get the diagonal of the L-BFGS inverse Hessian approximation with
+    position differences `S` and gradient differences `Y`, oldest first,
+    without forming the matrix."""
+    S = np.array(S, dtype=np.double).T
+    Y = np.array(Y, dtype=np.double).T
+    k = S.shape[1]
+    gamma = np.dot(S[:, -1], Y[:, -1]) / np.dot(Y[:, -1], Y[:, -1])
+    SY = S.T.dot(Y)
+    Rinv = np.linalg.inv(np.triu(SY))
+    M = np.zeros((2 * k, 2 * k))
+    M[:k, :k] = Rinv.T.dot(np.diag(np.diag(SY)) + gamma * Y.T.dot(Y)).dot(Rinv)
+    M[:k, k:] = -Rinv.T
+    M[k:, :k] = -Rinv
+    W = np.hstack([S, gamma * Y])
+    return gamma + np.einsum("ij,jk,ik->i", W, M, W)
+
+
+def lbfgs(
+    logpdf,
+    position,
+    max_iter=1000,
+    history=10,
+    gtol=1e-5,
+    ftol=1e-10,
+    max_backtrack=30,
+):
+    """Maximize `logpdf` from `position` with L-BFGS and a backtracking line
+    search.
+
+    `logpdf` has a method `get_logpdf_with_gradient`. Stops when the largest
+    gradient entry is below `gtol`, the relative change of the log density
+    below `ftol`, or after `max_iter` iterations. Returns an `LBFGSResult`,
+    whose `inverse_hessian_diagonal` is None if no curvature pairs were
+    collected."""
+    x = np.array(position, dtype=np.double)
+    logp, grad = logpdf.get_logpdf_with_gradient(x)
+    # minimize the negative log density
+    f, g = -logp, -np.array(grad, dtype=np.double)
+    nevals = 1
+    S = collections.deque(maxlen=history)
+    Y = collections.deque(maxlen=history)
+    converged = False
+    niter = 0
+    for niter in range(1, max_iter + 1):
+        if np.max(np.abs(g)) < gtol:
+            converged = True
+            break
+        d = -_two_loop(g, S, Y)
+        slope = np.dot(g, d)
+        if not slope < 0:
+            S.clear()
+            Y.clear()
+            d = -g
+            slope = -np.dot(g, g)
+        step = 1.0 if S else min(1.0, 1.0 / np.max(np.abs(g)))
+        for _ in range(max_backtrack):
+            x_new = x + step * d
+            logp_new, grad_new = logpdf.get_logpdf_with_gradient(x_new)
+            nevals += 1
+            f_new = -logp_new
+            if np.isfinite(f_new) and f_new <= f + 1e-4 * step * slope:
+                break
+            step *= 0.5
+        else:
+            break
+        g_new = -np.array(grad_new, dtype=np.double)
+        s, y = x_new - x, g_new - g
+        if np.dot(s, y) > 1e-10 * np.linalg.norm(s) * np.linalg.norm(y):
+            S.append(s)
+            Y.append(y)
+        df = f - f_new
+        x, f, g = x_new, f_new, g_new
+        if df <= ftol * max(1.0, abs(f)):
+            converged = True
+            break
+    return LBFGSResult(
+        position=x,
+        logp=-f,
+        grad=-g,
+        niter=niter,
+        nevals=nevals,
+        converged=converged,
+        inverse_hessian_diagonal=(
+            get_lbfgs_inverse_hessian_diagonal(S, Y) if S else None
+        ),
+    )
+
+
+def _get_restart_position(position, sigma):
+    return position + sigma * np.random.normal(size=len(position))
+
+
+class _Initializer(object):
+
+    """Model set up in a worker process for optimization from random
+    restarts."""
+
+    def __init__(self, sf_factory, seed):
+        from .log_density import LogDensity, TransformedLogDensity
+        from .variables import OptimizedVariables
+
+        seed_all(seed)
+        sf = sf_factory()
+        opt_vars = OptimizedVariables(sf.get_model())
+        self.logpdf = TransformedLogDensity(
+            LogDensity(sf, opt_vars.get_interface()),
+            opt_vars.get_transformation(),
+        )
+
+    def run(self, position, sigma, kwargs):
+        return lbfgs(
+            self.logpdf, _get_restart_position(position, sigma), **kwargs
+        )
+
+
+def find_initial_point(
+    logpdf,
+    position,
+    nrestarts=0,
+    sigma=1.0,
+    sf_factory=None,
+    nworkers=None,
+    seed=None,
+    log=print,
+    **kwargs
+):
+    """Optimize `logpdf` from `position` and from `nrestarts` random
+    perturbations of it with standard deviation `sigma` in free space,
+    returning the `LBFGSResult` with the highest log density.
+
+    If `sf_factory` is given, restarts are run in up to `nworkers` worker
+    processes, each of which builds the model by calling it (see
+    `IMP.hmc.parallel`); otherwise they run in turn in this process.
+    `kwargs` are passed to `lbfgs`."""
+    position = np.array(position, dtype=np.double)
+    results = []
+    if nrestarts > 0 and sf_factory is not None:
+        if nworkers is None:
+            nworkers = nrestarts
+        seeds = get_chain_seeds(min(nworkers, nrestarts), seed)
+        workers = []
+        try:
+            for s in seeds:
+                workers.append(WorkerProxy(_Initializer, (sf_factory, s)))
+            remaining = nrestarts
+            local_done = False
+            while remaining > 0:
+                batch = workers[:remaining]
+                for w in batch:
+                    w.call_async("run", position, sigma, kwargs)
+                # optimize from the initial point while the workers run
+                if not local_done:
+                    results.append(lbfgs(logpdf, position, **kwargs))
+                    local_done = True
+                results.extend(w.get_result() for w in batch)
+                remaining -= len(batch)
+        finally:
+            for w in workers:
+                w.close()
+    else:
+        results.append(lbfgs(logpdf, position, **kwargs))
+        for _ in range(nrestarts):
+            results.append(
+                lbfgs(logpdf, _get_restart_position(position, sigma), **kwargs)
+            )
+    logps = [r.logp if np.isfinite(r.logp) else -np.inf for r in results]
+    best = results[int(np.argmax(logps))]
+    log(
+        "Optimized initial point from {0} start(s): log density {1:.6g} after "
+        "{2} iterations ({3})".format(
+            len(results),
+            best.logp,
+            best.niter,
+            "converged" if best.converged else "not converged",
+        )
+    )
+    return best
+
+
+def initialize_hmc(
+    hmc, init_metric=True, bounds=(1e-4, 1e4), blocks=None, **kwargs
+):
+    """Move `hmc` to the best point found by `find_initial_point` and, if
+    `init_metric`, seed its metric with the L-BFGS inverse Hessian diagonal,
+    then reinitialize the step size. `kwargs` are passed to
+    `find_initial_point`."""
+    from .curvature import make_metric
+
+    kwargs.setdefault("log", hmc.log)
+    result = find_initial_point(
+        hmc.hamiltonian.logpdf,
+        hmc.transformation.free(hmc.get_values()),
+        **kwargs
+    )
+    hmc.set_values(hmc.transformation.constrain(result.position))
+    hmc.get_model().update()
+    hmc.create_phasepoint(result.position)
+    diag = result.inverse_hessian_diagonal
+    if (
+        init_metric
+        and diag is not None
+        and hmc.hamiltonian.metric_type != "unit"
+    ):
+        diag = np.where(np.isfinite(diag) & (diag > 0), diag, 1.0)
+        diag = np.clip(diag, *bounds)
+        hmc.set_metric(
+            make_metric(hmc.hamiltonian.metric_type, diag, blocks=blocks)
+        )
+    hmc.set_step_size(hmc.init_step_size())
+    return result
@@ -0,0 +1,145 @@
+"""Timers and counters for profiling sampling.
+
+An `Instrumentation` accumulates the time spent in each phase of a
+transition and counts events such as gradient evaluations. It is attached to
+a sampler with `HamiltonianMonteCarlo.set_instrumentation`; when none is
+attached, no timing is done.
+
+The phases are
+
+- `transition`: a whole transition, including all of the below
+- `score`: evaluating the IMP scoring function
+- `marshal`: copying values and gradients between NumPy and the model
+- `transform`: transforming variables to and from the free space
+- `after_sample`: setting the sampled values and updating optimizer states
+
+The remaining time of a transition, spent building the trajectory in the
+sampler itself, is reported as `tree`.
+"""
+
+import json
+from timeit import default_timer as timer
+
+TIMERS = ("transition", "score", "marshal", "transform", "after_sample")
+COUNTERS = ("logpdf_evals", "gradient_evals", "cache_hits", "transitions")
+
+
+class Instrumentation(object):
+
+    """Accumulated timers and counters."""
+
+    def __init__(self):
+        self.times = dict.fromkeys(TIMERS, 0.0)
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.mark()
+
+    def reset(self):
+        for k in self.times:
+            self.times[k] = 0.0
+        for k in self.counts:
+            self.counts[k] = 0
+        self.mark()
+
+    def add_time(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+
+    def increment(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def snapshot(self):
+        """Get a copy of the current totals."""
+        return dict(self.times), dict(self.counts)
+
+    def get_tree_time(self, times=None):
+        if times is None:
+            times = self.times
+        return max(
+            times["transition"]
+            - times["score"]
+            - times["marshal"]
+            - times["transform"],
+            0.0,
+        )
+
+    def mark(self):
+        """Start the interval reported by the next `get_sample_stats`."""
+        self._last = self.snapshot()
+
+    def get_sample_stats(self):
+        """Get the time spent and events counted in each phase since the
+        last call, as statistics of the last transition."""
+        last_times, last_counts = self._last
+        times = {k: v - last_times.get(k, 0.0) for k, v in self.times.items()}
+        counts = {
+            k: v - last_counts.get(k, 0) for k, v in self.counts.items()
+        }
+        self.mark()
+        stats = {
+            "time_transition": times["transition"],
+            "time_score": times["score"],
+            "time_marshal": times["marshal"],
+            "time_transform": times["transform"],
+            "time_tree": self.get_tree_time(times),
+            "n_grad_evals": counts["gradient_evals"],
+            "n_cache_hits": counts["cache_hits"],
+        }
+        return stats
+
+    def get_summary(self):
+        """Get a machine-readable summary of the totals."""
+        times = dict(self.times)
+        times["tree"] = self.get_tree_time()
+        ntransitions = self.counts["transitions"]
+        nevals = self.counts["logpdf_evals"] + self.counts["gradient_evals"]
+        summary = {
+            "times": times,
+            "counts": dict(self.counts),
+            "time_per_transition": (
+                times["transition"] / ntransitions if ntransitions else None
+            ),
+            "time_per_eval": times["score"] / nevals if nevals else None,
+            "overhead_per_eval": (
+                (times["marshal"] + times["transform"] + times["tree"])
+                / nevals
+                if nevals
+                else None
+            ),
+        }
+        return summary
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.get_summary(), **kwargs)
+
+    def log_summary(self, title="Timing summary:", prefix="    ", log=print):
+        summary = self.get_summary()
+        total = summary["times"]["transition"] or 1.0
+        lines = [title]
+        for k in TIMERS[1:] + ("tree",):
+            t = summary["times"][k]
+            lines.append(
+                "{0}{1}: {2:.3g}s ({3:.1%})".format(prefix, k, t, t / total)
+            )
+        for k, v in summary["counts"].items():
+            lines.append("{0}{1}: {2}".format(prefix, k, v))
+        log("\n".join(lines))
+
+
+class Timer(object):
+
+    """Context manager adding the time spent in its block to a timer of an
+    `Instrumentation`, or doing nothing if it is None."""
+
+    __slots__ = ("instrumentation", "name", "start")
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        if self.instrumentation is not None:
+            self.start = timer()
+        return self
+
+    def __exit__(self, *args):
+        if self.instrumentation is not None:
+            self.instrumentation.add_time(self.name, timer() - self.start)
@@ -1,21 +1,281 @@
-# If numba is imported, it must be before Julia
-# see https://github.com/JuliaPy/pyjulia/issues/307
-try:
-    import numba
-except ImportError:
-    pass
+"""Lazily loaded interface to Julia and the HMCUtilities/AdvancedHMC packages.
 
-import julia
-from julia import Main
-from julia import Base
-import julia.HMCUtilities
-from julia import HMCUtilities
-import julia.HMCUtilities.AdvancedHMC
-from julia.HMCUtilities import AdvancedHMC
+Julia is only started the first time an attribute of `Main`, `Base`,
+`HMCUtilities` or `AdvancedHMC` is used (or `init_julia` is called), so
+modules that do not sample, such as `IMP.hmc.accumulator` or
+`IMP.hmc.diagnostics`, can be imported without waiting for Julia to boot.
 
-Main.eval("using HMCUtilities")
+Startup can be reduced further with a system image in which the sampling
+and transformation code is precompiled. Build one with `build_sysimage` or
 
+    python -m IMP.hmc.julia --build-sysimage [PATH]
 
-def set_julia_seed(seed):
+It is used automatically if the `IMP_HMC_JULIA_SYSIMAGE` environment
+variable gives its path, in which case it must exist, or if it is found at
+`get_default_sysimage_path()`.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+
+SYSIMAGE_ENV_VAR = "IMP_HMC_JULIA_SYSIMAGE"
+
+_modules = {}
+_pending_seed = []
+
+
+def get_default_sysimage_path():
+    """Get the default location of the cached system image."""
+    cache_dir = os.environ.get(
+        "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+    )
+    if sys.platform == "darwin":
+        ext = "dylib"
+    elif sys.platform.startswith("win"):
+        ext = "dll"
+    else:
+        ext = "so"
+    return os.path.join(cache_dir, "imp_hmc", "sys." + ext)
+
+
+def _find_sysimage():
+    path = os.environ.get(SYSIMAGE_ENV_VAR)
+    if path:
+        if not os.path.isfile(path):
+            raise FileNotFoundError(
+                "Julia system image {0} given by the {1} environment "
+                "variable does not exist. Build it with `python -m "
+                "IMP.hmc.julia --build-sysimage {0}` or unset {1}.".format(
+                    path, SYSIMAGE_ENV_VAR
+                )
+            )
+        return path
+    path = get_default_sysimage_path()
+    if os.path.exists(path):
+        return path
+
+
+def init_julia(sysimage=None, runtime=None):
+    """Start Julia and load HMCUtilities, if not already done.
+
+    `sysimage` is the path to a Julia system image to use; by default a
+    cached one is used if it exists (see `get_default_sysimage_path`).
+    `runtime` is the Julia executable. Both are ignored if Julia is already
+    running. Returns a dict of the loaded Julia modules."""
+    if _modules:
+        return _modules
+
+    # If numba is imported, it must be before Julia
+    # see https://github.com/JuliaPy/pyjulia/issues/307
+    try:
+        import numba
+    except ImportError:
+        pass
+
+    if sysimage is None:
+        sysimage = _find_sysimage()
+    if sysimage is not None or runtime is not None:
+        from julia.api import Julia
+
+        Julia(sysimage=sysimage, runtime=runtime)
+
+    import julia
+    from julia import Main
+    from julia import Base
+    import julia.HMCUtilities
+    from julia import HMCUtilities
+    import julia.HMCUtilities.AdvancedHMC
+    from julia.HMCUtilities import AdvancedHMC
+
+    Main.eval("using HMCUtilities")
+
+    _modules.update(
+        Main=Main, Base=Base, HMCUtilities=HMCUtilities, AdvancedHMC=AdvancedHMC
+    )
+    if _pending_seed:
+        _seed(_pending_seed.pop())
+    return _modules
+
+
+def is_julia_initialized():
+    return bool(_modules)
+
+
+class _LazyModule(object):
+
+    """Stand-in for a Julia module that starts Julia on first use."""
+
+    def __init__(self, name):
+        object.__setattr__(self, "_name", name)
+
+    def _get_module(self):
+        return init_julia()[self._name]
+
+    def __getattr__(self, attr):
+        return getattr(self._get_module(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._get_module(), attr, value)
+
+    def __repr__(self):
+        return "<lazily loaded Julia module {0}>".format(self._name)
+
+
+Main = _LazyModule("Main")
+Base = _LazyModule("Base")
+HMCUtilities = _LazyModule("HMCUtilities")
+AdvancedHMC = _LazyModule("AdvancedHMC")
+
+
+def _seed(seed):
     import julia.Random
     julia.Random.seed_b(seed)
+
+
+def set_julia_seed(seed):
+    """Seed the Julia random number generator.
+
+    If Julia is not running yet, it is not started; the seed is instead
+    applied when it is."""
+    if not _modules:
+        _pending_seed[:] = [seed]
+        return
+    _seed(seed)
+
+
+_precompile_script = r'''
+using PyCall
+using HMCUtilities
+using HMCUtilities.AdvancedHMC
+
+py"""
+import numpy as np
+
+def _imp_hmc_logpdf(x):
+    return -0.5 * float(np.dot(x, x))
+
+def _imp_hmc_logpdf_with_gradient(x):
+    return -0.5 * float(np.dot(x, x)), -np.asarray(x)
+"""
+
+c = HMCUtilities.JointConstraint(
+    HMCUtilities.IdentityConstraint(3),
+    HMCUtilities.LowerBoundedConstraint(0.0),
+    HMCUtilities.BoundedConstraint(-1.0, 1.0),
+    HMCUtilities.TransformConstraint(0.0, 1.0),
+    HMCUtilities.UnitVectorConstraint(3),
+    HMCUtilities.UnitVectorScaledConstraint(4, 2.0),
+    HMCUtilities.UnitSimplexConstraint(3),
+)
+n = HMCUtilities.free_dimension(c)
+y = randn(n)
+x = HMCUtilities.constrain(c, y)
+HMCUtilities.free(c, x)
+
+ℓ = PyCall.pyfunction(
+    y -> HMCUtilities.constrain_with_pushlogpdf(c, y), Vector{Float64}
+)
+∂ℓ = PyCall.pyfunction(
+    y -> HMCUtilities.constrain_with_pushlogpdf_grad(c, y), Vector{Float64}
+)
+x, pushlogpdf = HMCUtilities.constrain_with_pushlogpdf(c, y)
+pushlogpdf(-0.5)
+x, pushlogpdf_grad = HMCUtilities.constrain_with_pushlogpdf_grad(c, y)
+pushlogpdf_grad(-0.5, randn(length(x)))
+
+for metric in (
+    AdvancedHMC.UnitEuclideanMetric(n),
+    AdvancedHMC.DiagEuclideanMetric(n),
+    AdvancedHMC.DenseEuclideanMetric(n),
+)
+    h = AdvancedHMC.Hamiltonian(
+        metric, py"_imp_hmc_logpdf", py"_imp_hmc_logpdf_with_gradient"
+    )
+    eps = AdvancedHMC.find_good_eps(h, y)
+    integrator = AdvancedHMC.Leapfrog(eps)
+    samplers = (
+        AdvancedHMC.NUTS{AdvancedHMC.MultinomialTS,AdvancedHMC.GeneralisedNoUTurn}(
+            integrator, 10
+        ),
+        AdvancedHMC.StaticTrajectory(integrator),
+    )
+    for sampler in samplers
+        adaptor = AdvancedHMC.StanHMCAdaptor(
+            10,
+            AdvancedHMC.Preconditioner(metric),
+            AdvancedHMC.NesterovDualAveraging(0.8, eps),
+        )
+        z = HMCUtilities.make_phasepoint(h, y)
+        for i in 1:10
+            z, stats = HMCUtilities.sample(h, sampler, z)
+            stats = Dict(pairs(stats))
+            AdvancedHMC.adapt!(
+                adaptor, HMCUtilities.position(z), stats[:acceptance_rate]
+            )
+            h = AdvancedHMC.reconstruct(h, adaptor)
+            sampler = AdvancedHMC.reconstruct(sampler, adaptor)
+        end
+        HMCUtilities.constrain(c, HMCUtilities.position(z))
+    end
+    HMCUtilities.step_size(integrator)
+end
+'''
+
+_build_script = r"""
+using PackageCompiler
+create_sysimage(
+    [:PyCall, :HMCUtilities];
+    sysimage_path=ARGS[1],
+    precompile_execution_file=ARGS[2],
+)
+"""
+
+
+def build_sysimage(path=None, julia="julia"):
+    """Build a Julia system image with the sampling code precompiled.
+
+    Requires the PackageCompiler Julia package. The image is written to
+    `path` (by default `get_default_sysimage_path()`), which is returned."""
+    if path is None:
+        path = get_default_sysimage_path()
+    path = os.path.abspath(path)
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        precompile_file = os.path.join(tmpdir, "precompile.jl")
+        build_file = os.path.join(tmpdir, "build.jl")
+        with open(precompile_file, "w") as fh:
+            fh.write(_precompile_script)
+        with open(build_file, "w") as fh:
+            fh.write(_build_script)
+        subprocess.check_call(
+            [julia, "--startup-file=no", build_file, path, precompile_file]
+        )
+    return path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Manage the Julia system image used by IMP.hmc."
+    )
+    parser.add_argument(
+        "--build-sysimage",
+        nargs="?",
+        const=get_default_sysimage_path(),
+        metavar="PATH",
+        help="Build a precompiled system image at PATH "
+        "(default: %(const)s)",
+    )
+    parser.add_argument(
+        "--julia", default="julia", help="Julia executable to use"
+    )
+    args = parser.parse_args()
+    if args.build_sysimage is None:
+        parser.print_help()
+    else:
+        print("Wrote " + build_sysimage(args.build_sysimage, julia=args.julia))
@@ -1,9 +1,19 @@
+import collections
+
 import numpy as np
 
-from .julia import Main, HMCUtilities
+from .julia import Main
+from .instrumentation import Timer
 
 
 class LogDensityBase(object):
+    instrumentation = None
+
+    def set_instrumentation(self, instrumentation):
+        """Record timings in an `instrumentation.Instrumentation`, or stop
+        if None."""
+        self.instrumentation = instrumentation
+
     def get_dimension(self):
         raise NotImplementedError
 
@@ -13,38 +23,206 @@ class LogDensityBase(object):
     def get_logpdf_with_gradient(self, x):
         raise NotImplementedError
 
+    def clear_cache(self):
+        pass
+
+    def close(self):
+        """Release any resources held, such as worker processes."""
+        pass
+
+
+CacheInfo = collections.namedtuple(
+    "CacheInfo", ["hits", "misses", "maxsize", "currsize"]
+)
+
 
 class LogDensity(LogDensityBase):
-    def __init__(self, sf, interface):
+
+    """Log density of an IMP scoring function.
+
+    The most recent `cache_size` evaluations are cached, keyed on the input
+    vector, so that evaluating repeatedly at the same point only scores the
+    model once. A request for the value alone is also served from a cached
+    value and gradient. Either way, the optimized variables of the model
+    are left set to `x`, but on a cache hit the model is not updated, so
+    attributes that depend on them (such as the coordinates of rigid body
+    members) may be stale until `IMP.Model.update` is called. The cache
+    must be cleared with `clear_cache` if the scoring function changes; set
+    `cache_size` to 0 to disable it.
+
+    With the cache enabled, the gradients returned by
+    `get_logpdf_with_gradient` are read-only and shared with the cache, so
+    callers must copy them before modifying them."""
+
+    def __init__(self, sf, interface, cache_size=16):
         super().__init__()
 
         self.sf = sf
         self.interface = interface
+        self._grad = np.empty(interface.get_dimension(), dtype=np.double)
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def get_dimension(self):
         return self.interface.get_dimension()
 
+    def set_values(self, x):
+        self.interface.set_values_from(np.ascontiguousarray(x, dtype=np.double))
+
+    def get_cache_info(self):
+        return CacheInfo(
+            self.cache_hits, self.cache_misses, self.cache_size,
+            len(self._cache)
+        )
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def _get_cached(self, x, key, gradient):
+        try:
+            logp, grad = self._cache[key]
+        except KeyError:
+            return None
+        if gradient and grad is None:
+            return None
+        with Timer(self.instrumentation, "marshal"):
+            self.set_values(x)
+        self._cache.move_to_end(key)
+        self.cache_hits += 1
+        if self.instrumentation is not None:
+            self.instrumentation.increment("cache_hits")
+        return logp, grad
+
+    def _add_cached(self, key, logp, grad):
+        self._cache[key] = (logp, grad)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _get_key(self, x):
+        if self.cache_size <= 0:
+            return None
+        return np.ascontiguousarray(x, dtype=np.double).tobytes()
+
+    def get_logpdf(self, x):
+        key = self._get_key(x)
+        if key is not None:
+            cached = self._get_cached(x, key, False)
+            if cached is not None:
+                return cached[0]
+            self.cache_misses += 1
+        if self.instrumentation is not None:
+            self.instrumentation.increment("logpdf_evals")
+        logp = self._evaluate(x)
+        if key is not None:
+            self._add_cached(key, logp, None)
+        return logp
+
+    def _evaluate(self, x):
+        inst = self.instrumentation
+        with Timer(inst, "marshal"):
+            self.set_values(x)
+        with Timer(inst, "score"):
+            return -self.sf.evaluate(False)
+
+    def get_logpdf_with_gradient(self, x):
+        key = self._get_key(x)
+        if key is not None:
+            cached = self._get_cached(x, key, True)
+            if cached is not None:
+                return cached
+            self.cache_misses += 1
+        if self.instrumentation is not None:
+            self.instrumentation.increment("gradient_evals")
+        logp, grad = self._evaluate_with_gradient(x)
+        if key is not None:
+            grad.setflags(write=False)
+            self._add_cached(key, logp, grad)
+        return logp, grad
+
+    def _evaluate_with_gradient(self, x):
+        inst = self.instrumentation
+        with Timer(inst, "marshal"):
+            self.set_values(x)
+        with Timer(inst, "score"):
+            V = self.sf.evaluate(True)
+        with Timer(inst, "marshal"):
+            self.interface.get_gradient_into(self._grad)
+        return -V, -self._grad
+
+
+class TemperedLogDensity(LogDensityBase):
+
+    """Log density raised to the power `beta`, an inverse temperature.
+
+    Wraps a log density of the constrained variables, so that in free space
+    only the scoring function is tempered, not the log-Jacobian of the
+    transformation. Used for replica exchange (see `IMP.hmc.tempering`)."""
+
+    def __init__(self, logpdf, beta=1.0):
+        super().__init__()
+
+        self.logpdf = logpdf
+        self.beta = beta
+
+    def set_beta(self, beta):
+        self.beta = beta
+
+    def get_dimension(self):
+        return self.logpdf.get_dimension()
+
+    def clear_cache(self):
+        self.logpdf.clear_cache()
+
+    def close(self):
+        self.logpdf.close()
+
+    def set_instrumentation(self, instrumentation):
+        super().set_instrumentation(instrumentation)
+        self.logpdf.set_instrumentation(instrumentation)
+
+    def get_untempered_logpdf(self, x):
+        return self.logpdf.get_logpdf(x)
+
     def get_logpdf(self, x):
-        self.interface.set_values(x)
-        return -self.sf.evaluate(False)
+        return self.beta * self.logpdf.get_logpdf(x)
 
     def get_logpdf_with_gradient(self, x):
-        self.interface.set_values(x)
-        V = self.sf.evaluate(True)
-        grad = np.asarray(self.interface.get_gradient(), dtype=np.double)
-        return -V, -grad
+        logp, grad = self.logpdf.get_logpdf_with_gradient(x)
+        return self.beta * logp, self.beta * grad
 
 
 class TransformedLogDensity(LogDensityBase):
-    def __init__(self, logpdf, transform):
+
+    """Log density in the free space of a `transforms.VariableConstraint`.
+
+    With the default "numpy" backend the transformation and its
+    log-Jacobian are computed in Python with batched NumPy operations. With
+    the "julia" backend they are computed by HMCUtilities."""
+
+    def __init__(self, logpdf, transform, backend="numpy"):
         super().__init__()
 
         self.logpdf = logpdf
         self.transform = transform
+        self.backend = backend
+
+        if backend == "numpy":
+            self.constrain_with_pushlogpdf = transform.constrain_with_pushlogpdf
+            self.constrain_with_pushlogpdf_grad = (
+                transform.constrain_with_pushlogpdf_grad
+            )
+        elif backend == "julia":
+            self._init_julia_transform()
+        else:
+            raise ValueError("'backend' must be in {'numpy', 'julia'}")
 
+    def _init_julia_transform(self):
         # Use hash for unique name
-        jcname = "Main.jc{}".format(self.__hash__())
-        exec("{0} = self.transform".format(jcname))
+        jcname = "jc{}".format(self.__hash__())
+        setattr(Main, jcname, self.transform.to_julia())
         self.constrain_with_pushlogpdf = Main.eval(
             "PyCall.pyfunction(y->HMCUtilities.constrain_with_pushlogpdf({0}, y), Vector{{Float64}})".format(
                 jcname
@@ -57,14 +235,105 @@ class TransformedLogDensity(LogDensityBase):
         )
 
     def get_dimension(self):
-        return HMCUtilities.free_dimension(self.transform)
+        return self.transform.free_dimension()
+
+    def clear_cache(self):
+        self.logpdf.clear_cache()
+
+    def close(self):
+        self.logpdf.close()
+
+    def set_instrumentation(self, instrumentation):
+        super().set_instrumentation(instrumentation)
+        self.logpdf.set_instrumentation(instrumentation)
+
+    def free(self, x):
+        return self.transform.free(x)
+
+    def constrain(self, y):
+        return self.transform.constrain(y)
 
     def get_logpdf(self, y):
-        x, pushlogpdf = self.constrain_with_pushlogpdf(y)
+        inst = self.instrumentation
+        with Timer(inst, "transform"):
+            x, pushlogpdf = self.constrain_with_pushlogpdf(y)
         logpdf_x = self.logpdf.get_logpdf(x)
-        return pushlogpdf(logpdf_x)
+        with Timer(inst, "transform"):
+            return pushlogpdf(logpdf_x)
 
     def get_logpdf_with_gradient(self, y):
-        x, pushlogpdf_grad = self.constrain_with_pushlogpdf_grad(y)
+        inst = self.instrumentation
+        with Timer(inst, "transform"):
+            x, pushlogpdf_grad = self.constrain_with_pushlogpdf_grad(y)
         logpdf_x, gradx_logpdf_x = self.logpdf.get_logpdf_with_gradient(x)
-        return pushlogpdf_grad(logpdf_x, gradx_logpdf_x)
+        with Timer(inst, "transform"):
+            return pushlogpdf_grad(logpdf_x, gradx_logpdf_x)
+
+
+class SplitLogDensity(LogDensityBase):
+
+    """Log density in free space split into a fast and a slow part, for a
+    multiple-time-step integrator (see `nuts.MultipleTimeStepLeapfrog`).
+
+    `fast` and `slow` are `LogDensity` instances for scoring functions of
+    the cheap and the expensive restraints on the same variables, which must
+    sum to the full scoring function (see
+    `IMP.hmc.defaults.split_scoring_function`). The log-Jacobian of
+    `transform` is included in the fast part."""
+
+    def __init__(self, fast, slow, transform, backend="numpy"):
+        super().__init__()
+
+        self.fast = TransformedLogDensity(fast, transform, backend=backend)
+        self.slow = slow
+        self.transform = transform
+
+    def get_dimension(self):
+        return self.fast.get_dimension()
+
+    def clear_cache(self):
+        self.fast.clear_cache()
+        self.slow.clear_cache()
+
+    def close(self):
+        self.fast.close()
+        self.slow.close()
+
+    def set_instrumentation(self, instrumentation):
+        super().set_instrumentation(instrumentation)
+        self.fast.set_instrumentation(instrumentation)
+        self.slow.set_instrumentation(instrumentation)
+
+    def free(self, x):
+        return self.transform.free(x)
+
+    def constrain(self, y):
+        return self.transform.constrain(y)
+
+    def get_logpdf(self, y):
+        inst = self.instrumentation
+        with Timer(inst, "transform"):
+            x, pushlogpdf = self.fast.constrain_with_pushlogpdf(y)
+        logpdf_x = self.fast.logpdf.get_logpdf(x) + self.slow.get_logpdf(x)
+        with Timer(inst, "transform"):
+            return pushlogpdf(logpdf_x)
+
+    def get_logpdf_with_gradient(self, y):
+        logp_fast, grad_fast = self.get_fast_logpdf_with_gradient(y)
+        logp_slow, grad_slow = self.get_slow_logpdf_with_gradient(y)
+        return logp_fast + logp_slow, grad_fast + grad_slow
+
+    def get_fast_logpdf_with_gradient(self, y):
+        return self.fast.get_logpdf_with_gradient(y)
+
+    def get_slow_logpdf_with_gradient(self, y):
+        inst = self.instrumentation
+        with Timer(inst, "transform"):
+            x, pushlogpdf_grad = self.fast.constrain_with_pushlogpdf_grad(y)
+        logpdf_x, gradx_logpdf_x = self.slow.get_logpdf_with_gradient(x)
+        with Timer(inst, "transform"):
+            # the pullback includes the log-Jacobian, which belongs to the
+            # fast part, so subtract its contribution
+            logp, grad = pushlogpdf_grad(logpdf_x, gradx_logpdf_x)
+            logjac, grad_logjac = pushlogpdf_grad(0.0, np.zeros_like(x))
+            return logp - logjac, grad - grad_logjac
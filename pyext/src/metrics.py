@@ -0,0 +1,329 @@
+"""Structured Euclidean metrics for high-dimensional systems.
+
+A dense metric needs O(n^2) memory and O(n^3) time to factorize, which is
+impractical for tens of thousands of variables, while a diagonal metric
+ignores all correlations. These metrics sit in between:
+
+- `LowRankEuclideanMetric`: the inverse metric is a diagonal plus a rank-k
+  term, capturing the k most important directions of correlation. Momentum
+  sampling, velocity and kinetic energy take O(nk) time.
+- `BlockDiagEuclideanMetric`: the inverse metric is dense within blocks of
+  variables, e.g. those of a rigid body or domain, and diagonal elsewhere.
+
+Both have the interface of the metrics of `IMP.hmc.nuts`, so they can only
+be used with the NumPy engine. Each has a streaming estimator, with the same
+interface as `IMP.hmc.adaptation.WelfordEstimator`, that estimates it from
+warm-up positions in a single pass.
+"""
+
+import numpy as np
+
+from .adaptation import WelfordEstimator
+
+
+def get_cholesky(M):
+    """Get the lower Cholesky factor of `M`, or None if `M` is not positive
+    definite."""
+    try:
+        return np.linalg.cholesky(M)
+    except np.linalg.LinAlgError:
+        return None
+
+
+class LowRankEuclideanMetric(object):
+
+    """Metric whose inverse is `diag(diag) + factor factor^T`.
+
+    `diag` is a positive vector of length n and `factor` an n x k matrix.
+    Its factorization is computed once, with a thin SVD, on construction."""
+
+    metric_type = "lowrank"
+
+    def __init__(self, diag, factor=None):
+        if np.ndim(diag) == 0:
+            diag = np.ones(int(diag))
+        self.diag = np.array(diag, dtype=np.double)
+        self.n = len(self.diag)
+        if factor is None:
+            factor = np.zeros((self.n, 0))
+        self.factor = np.array(factor, dtype=np.double).reshape(self.n, -1)
+        if not np.all(np.isfinite(self.diag) & (self.diag > 0)):
+            raise ValueError("Diagonal of a low-rank metric must be positive")
+        if not np.all(np.isfinite(self.factor)):
+            raise ValueError("Factor of a low-rank metric must be finite")
+        # Minv = D^1/2 (I + W W^T) D^1/2 with W = D^-1/2 V = Q S R^T, so
+        # M^1/2 = D^-1/2 (I + Q ((1 + S^2)^-1/2 - 1) Q^T)
+        self._sqrt_diag = np.sqrt(self.diag)
+        if self.factor.shape[1] > 0:
+            self._Q, s, _ = np.linalg.svd(
+                self.factor / self._sqrt_diag[:, np.newaxis],
+                full_matrices=False,
+            )
+            self._coef = 1 / np.sqrt(1 + s ** 2) - 1
+        else:
+            self._Q = np.zeros((self.n, 0))
+            self._coef = np.zeros(0)
+
+    def get_dimension(self):
+        return self.n
+
+    def get_rank(self):
+        return self.factor.shape[1]
+
+    def get_diagonal(self):
+        """Get the diagonal of the inverse metric."""
+        return self.diag + np.sum(self.factor ** 2, axis=1)
+
+    def sample_momentum(self):
+        z = np.random.normal(size=self.n)
+        z += self._Q.dot(self._coef * self._Q.T.dot(z))
+        return z / self._sqrt_diag
+
+    def velocity(self, r):
+        return self.diag * r + self.factor.dot(self.factor.T.dot(r))
+
+    def kinetic_energy(self, r):
+        return 0.5 * np.dot(r, self.velocity(r))
+
+
+def _stack_blocks(blocks):
+    """Group blocks of variable indexes by size, returning a list of
+    (nblocks, size) index arrays. Blocks of a single variable are dropped."""
+    by_size = {}
+    for b in blocks:
+        b = np.asarray(b, dtype=np.intp).reshape(-1)
+        if len(b) > 1:
+            by_size.setdefault(len(b), []).append(b)
+    return [np.array(bs) for bs in by_size.values()]
+
+
+class BlockDiagEuclideanMetric(object):
+
+    """Metric whose inverse is dense within blocks of variables and diagonal
+    elsewhere.
+
+    `diag` is the inverse metric of the variables in no block (entries for
+    variables in blocks are ignored), and `blocks` a list of
+    `(indexes, Minv)` pairs, where `Minv` is the inverse metric of the block.
+    A pair may also hold a stack of equally sized blocks, as arrays of shape
+    (nblocks, size) and (nblocks, size, size). Blocks must not overlap.
+    Blocks of the same size are processed together, so the cost per call is
+    O(sum of squared block sizes) with little Python overhead."""
+
+    metric_type = "block"
+
+    def __init__(self, diag, blocks=()):
+        if np.ndim(diag) == 0:
+            diag = np.ones(int(diag))
+        diag = np.array(diag, dtype=np.double)
+        self.n = len(diag)
+        by_size = {}
+        for indexes, Minv in blocks:
+            indexes = np.asarray(indexes, dtype=np.intp)
+            Minv = np.asarray(Minv, dtype=np.double)
+            if indexes.ndim == 1:
+                indexes = indexes[np.newaxis]
+                Minv = Minv[np.newaxis]
+            if Minv.shape != indexes.shape + indexes.shape[-1:]:
+                raise ValueError(
+                    "Block inverse metric does not match its indexes"
+                )
+            idx, mats = by_size.setdefault(indexes.shape[1], ([], []))
+            idx.append(indexes)
+            mats.append(Minv)
+
+        in_block = np.zeros(self.n, dtype=bool)
+        self.blocks = []
+        for idx, mats in by_size.values():
+            idx = np.concatenate(idx)
+            Minv = np.concatenate(mats)
+            if np.any(in_block[idx]) or len(np.unique(idx)) != idx.size:
+                raise ValueError("Metric blocks must not overlap")
+            in_block[idx] = True
+            L = get_cholesky(Minv)
+            if L is None:
+                raise ValueError("Metric block is not positive definite")
+            Linv_T = np.swapaxes(np.linalg.inv(L), 1, 2)
+            self.blocks.append((idx, Minv, Linv_T))
+
+        self.diag = np.where(in_block, 0.0, diag)
+        if not np.all(np.isfinite(diag[~in_block]) & (diag[~in_block] > 0)):
+            raise ValueError("Diagonal of a block metric must be positive")
+        self._sqrt_M = np.where(
+            in_block, 0.0, 1 / np.sqrt(np.where(in_block, 1.0, diag))
+        )
+
+    def get_dimension(self):
+        return self.n
+
+    def get_diagonal(self):
+        """Get the diagonal of the inverse metric."""
+        d = self.diag.copy()
+        for idx, Minv, _ in self.blocks:
+            d[idx] = np.diagonal(Minv, axis1=1, axis2=2)
+        return d
+
+    def sample_momentum(self):
+        p = np.random.normal(size=self.n) * self._sqrt_M
+        for idx, _, Linv_T in self.blocks:
+            z = np.random.normal(size=idx.shape)
+            p[idx] = np.einsum("ijk,ik->ij", Linv_T, z)
+        return p
+
+    def velocity(self, r):
+        v = self.diag * r
+        for idx, Minv, _ in self.blocks:
+            v[idx] = np.einsum("ijk,ik->ij", Minv, r[idx])
+        return v
+
+    def kinetic_energy(self, r):
+        return 0.5 * np.dot(r, self.velocity(r))
+
+
+class LowRankEstimator(object):
+
+    """Streaming estimate of a `LowRankEuclideanMetric` of rank `rank`.
+
+    Variances are estimated exactly with a `WelfordEstimator`, and the
+    scatter matrix of the positions with a Frequent Directions sketch
+    (Liberty, KDD 2013) of `sketch_size` rows (by default `2 * rank`), so
+    memory is O(n * rank) and each sample costs O(n * rank) amortized. The
+    leading principal components of the standardized sketch give the
+    factor, and the remaining variance of each variable the diagonal."""
+
+    def __init__(self, n, rank=10, sketch_size=None):
+        self.n = n
+        self.rank = rank
+        self.sketch_size = 2 * rank if sketch_size is None else sketch_size
+        self.welford = WelfordEstimator(n)
+        self.reset()
+
+    @property
+    def count(self):
+        return self.welford.count
+
+    @property
+    def mean(self):
+        return self.welford.mean
+
+    def reset(self):
+        self.welford.reset()
+        self._sketch = np.zeros((2 * self.sketch_size, self.n))
+        self._nrows = 0
+
+    def _shrink(self):
+        _, s, vt = np.linalg.svd(self._sketch[: self._nrows], full_matrices=False)
+        ell = self.sketch_size
+        delta = s[ell] ** 2 if len(s) > ell else 0.0
+        s = np.sqrt(np.maximum(s[:ell] ** 2 - delta, 0.0))
+        self._sketch[:] = 0.0
+        self._sketch[: len(s)] = s[:, np.newaxis] * vt[:ell]
+        self._nrows = len(s)
+
+    def _add_row(self, row):
+        if self._nrows == len(self._sketch):
+            self._shrink()
+        self._sketch[self._nrows] = row
+        self._nrows += 1
+
+    def add_sample(self, x):
+        x = np.asarray(x, dtype=np.double)
+        count = self.welford.count
+        if count > 0:
+            # the rank-one update of the scatter matrix made by Welford
+            self._add_row(np.sqrt(count / (count + 1.0)) * (x - self.mean))
+        self.welford.add_sample(x)
+
+    def merge(self, other):
+        """Merge the samples of another estimator into this one."""
+        if other.count == 0:
+            return
+        if self.count > 0:
+            w = self.count * other.count / (self.count + other.count)
+            self._add_row(np.sqrt(w) * (other.mean - self.mean))
+        for row in other._sketch[: other._nrows]:
+            self._add_row(row)
+        self.welford.merge(other.welford)
+
+    def get_variance(self, regularize=True):
+        """Get the estimated metric as a `LowRankEuclideanMetric`.
+
+        If `regularize`, the variances are shrunk as by
+        `WelfordEstimator.get_variance`."""
+        var = self.welford.get_variance(regularize=regularize)
+        if self._nrows == 0 or self.rank == 0:
+            return LowRankEuclideanMetric(var)
+        sd = np.sqrt(var)
+        scaled = self._sketch[: self._nrows] / (
+            sd * np.sqrt(max(self.count - 1, 1))
+        )
+        _, s, vt = np.linalg.svd(scaled, full_matrices=False)
+        k = min(self.rank, len(s))
+        factor = vt[:k].T * s[:k]
+        residual = np.maximum(1 - np.sum(factor ** 2, axis=1), 1e-3)
+        return LowRankEuclideanMetric(
+            var * residual, sd[:, np.newaxis] * factor
+        )
+
+
+class BlockEstimator(object):
+
+    """Streaming estimate of a `BlockDiagEuclideanMetric` with the given
+    blocks of variable indexes.
+
+    Means and variances of all variables, and covariances within each block,
+    are accumulated with Welford's algorithm, vectorized over blocks of the
+    same size."""
+
+    def __init__(self, n, blocks):
+        self.n = n
+        self.blocks = _stack_blocks(blocks)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = np.zeros(self.n)
+        self.m2 = np.zeros(self.n)
+        self.block_m2 = [
+            np.zeros(idx.shape + idx.shape[-1:]) for idx in self.blocks
+        ]
+
+    def add_sample(self, x):
+        x = np.asarray(x, dtype=np.double)
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        post = x - self.mean
+        self.m2 += post * delta
+        for idx, m2 in zip(self.blocks, self.block_m2):
+            m2 += post[idx][:, :, np.newaxis] * delta[idx][:, np.newaxis, :]
+
+    def merge(self, other):
+        """Merge the samples of another estimator into this one."""
+        if other.count == 0:
+            return
+        n = self.count + other.count
+        delta = other.mean - self.mean
+        w = self.count * other.count / n
+        self.m2 += other.m2 + w * delta ** 2
+        for idx, m2, om2 in zip(self.blocks, self.block_m2, other.block_m2):
+            d = delta[idx]
+            m2 += om2 + w * d[:, :, np.newaxis] * d[:, np.newaxis, :]
+        self.mean += delta * (other.count / n)
+        self.count = n
+
+    def get_variance(self, regularize=True):
+        """Get the estimated metric as a `BlockDiagEuclideanMetric`.
+
+        If `regularize`, the variances and block covariances are shrunk
+        towards a small multiple of the identity as Stan does."""
+        n = self.count
+        scale = 1.0 / max(n - 1, 1)
+        var = self.m2 * scale
+        covs = [m2 * scale for m2 in self.block_m2]
+        if regularize:
+            var = (n / (n + 5.0)) * var + 1e-3 * (5.0 / (n + 5.0))
+            for idx, cov in zip(self.blocks, covs):
+                cov *= n / (n + 5.0)
+                cov += 1e-3 * (5.0 / (n + 5.0)) * np.eye(idx.shape[1])
+        return BlockDiagEuclideanMetric(var, list(zip(self.blocks, covs)))
@@ -0,0 +1,543 @@
+"""Pure NumPy implementation of the HMC samplers and their adaptation.
+
+This module provides the subset of the AdvancedHMC and HMCUtilities
+interfaces used by IMP.hmc, under the same names, so that it can be
+selected with ``engine="numpy"`` in place of the Julia packages. It
+implements multinomial NUTS with the generalised no-U-turn criterion,
+static HMC, the leapfrog integrator, unit/diagonal/dense Euclidean metrics
+(plus the low-rank and block-diagonal metrics of `IMP.hmc.metrics`) and
+Stan-style windowed adaptation with dual averaging of the step size.
+"""
+
+import numpy as np
+
+from .adaptation import DualAveraging, WelfordEstimator, get_slow_windows
+from .metrics import BlockDiagEuclideanMetric, LowRankEuclideanMetric
+
+
+class UnitEuclideanMetric(object):
+    def __init__(self, n):
+        self.n = int(n)
+        self.Minv = np.ones(self.n)
+
+    def get_dimension(self):
+        return self.n
+
+    def sample_momentum(self):
+        return np.random.normal(size=self.n)
+
+    def velocity(self, r):
+        return r
+
+    def kinetic_energy(self, r):
+        return 0.5 * np.dot(r, r)
+
+
+class DiagEuclideanMetric(object):
+    def __init__(self, Minv):
+        if np.ndim(Minv) == 0:
+            Minv = np.ones(int(Minv))
+        self.Minv = np.array(Minv, dtype=np.double)
+        self.n = len(self.Minv)
+        self._sqrt_M = 1 / np.sqrt(self.Minv)
+
+    def get_dimension(self):
+        return self.n
+
+    def sample_momentum(self):
+        return np.random.normal(size=self.n) * self._sqrt_M
+
+    def velocity(self, r):
+        return self.Minv * r
+
+    def kinetic_energy(self, r):
+        return 0.5 * np.dot(r, self.Minv * r)
+
+
+class DenseEuclideanMetric(object):
+    def __init__(self, Minv, cholesky=None):
+        if np.ndim(Minv) == 0:
+            Minv = np.eye(int(Minv))
+        self.Minv = np.array(Minv, dtype=np.double)
+        self.n = self.Minv.shape[0]
+        # Minv = L L^T, so M = L^-T L^-1 and p = L^-T z ~ N(0, M)
+        L = np.linalg.cholesky(self.Minv) if cholesky is None else cholesky
+        self._Linv_T = np.linalg.inv(L).T
+
+    def get_dimension(self):
+        return self.n
+
+    def sample_momentum(self):
+        return self._Linv_T.dot(np.random.normal(size=self.n))
+
+    def velocity(self, r):
+        return self.Minv.dot(r)
+
+    def kinetic_energy(self, r):
+        return 0.5 * np.dot(r, self.Minv.dot(r))
+
+
+class PhasePoint(object):
+
+    """Position and momentum, with the log density and its gradient at the
+    position.
+
+    For a `SplitHamiltonian`, `grads` may also hold the gradients of the fast
+    and slow parts of the log density."""
+
+    __slots__ = ("position", "momentum", "logp", "grad", "grads")
+
+    def __init__(self, position, momentum, logp, grad, grads=None):
+        self.position = position
+        self.momentum = momentum
+        self.logp = logp
+        self.grad = grad
+        self.grads = grads
+
+    def is_valid(self):
+        return np.isfinite(self.logp) and np.all(np.isfinite(self.grad))
+
+
+class Hamiltonian(object):
+    def __init__(self, metric, logpdf, logpdf_with_gradient):
+        self.metric = metric
+        self.logpdf = logpdf
+        self.logpdf_with_gradient = logpdf_with_gradient
+
+    def evaluate(self, position):
+        logp, grad = self.logpdf_with_gradient(position)
+        return float(logp), np.asarray(grad, dtype=np.double)
+
+    def energy(self, z):
+        if not z.is_valid():
+            return np.inf
+        return -z.logp + self.metric.kinetic_energy(z.momentum)
+
+    def refresh(self, z):
+        """Get a copy of `z` with a new random momentum."""
+        return PhasePoint(
+            z.position, self.metric.sample_momentum(), z.logp, z.grad, z.grads
+        )
+
+
+class SplitHamiltonian(Hamiltonian):
+
+    """Hamiltonian whose log density is the sum of a cheap, fast-varying
+    part and an expensive, slowly varying part, for
+    `MultipleTimeStepLeapfrog`."""
+
+    def __init__(
+        self,
+        metric,
+        logpdf,
+        logpdf_with_gradient,
+        fast_logpdf_with_gradient,
+        slow_logpdf_with_gradient,
+    ):
+        super().__init__(metric, logpdf, logpdf_with_gradient)
+        self.fast_logpdf_with_gradient = fast_logpdf_with_gradient
+        self.slow_logpdf_with_gradient = slow_logpdf_with_gradient
+
+    def evaluate_fast(self, position):
+        logp, grad = self.fast_logpdf_with_gradient(position)
+        return float(logp), np.asarray(grad, dtype=np.double)
+
+    def evaluate_slow(self, position):
+        logp, grad = self.slow_logpdf_with_gradient(position)
+        return float(logp), np.asarray(grad, dtype=np.double)
+
+
+class Leapfrog(object):
+    def __init__(self, step_size):
+        self.step_size = float(step_size)
+
+    def step(self, h, z, step_size):
+        r = z.momentum + 0.5 * step_size * z.grad
+        position = z.position + step_size * h.metric.velocity(r)
+        logp, grad = h.evaluate(position)
+        r = r + 0.5 * step_size * grad
+        return PhasePoint(position, r, logp, grad)
+
+
+class MultipleTimeStepLeapfrog(object):
+
+    """Reversible multiple-time-step (r-RESPA) integrator.
+
+    Each step of size `step_size` kicks the momentum with half a step of the
+    slow gradient, takes `n_fast_steps` leapfrog steps of the fast part of
+    the log density, and kicks with another half step of the slow gradient
+    (Tuckerman, Berne & Martyna, J Chem Phys 97 (1992)). The slow part is
+    thus evaluated once per step rather than once per fast step. Since the
+    integrator is symplectic and reversible, and the energy is computed
+    from the full log density, NUTS and static HMC remain exact.
+
+    Requires a `SplitHamiltonian`."""
+
+    def __init__(self, step_size, n_fast_steps=4):
+        self.step_size = float(step_size)
+        self.n_fast_steps = int(n_fast_steps)
+
+    def step(self, h, z, step_size):
+        if z.grads is None:
+            grad_fast = h.evaluate_fast(z.position)[1]
+            grad_slow = h.evaluate_slow(z.position)[1]
+        else:
+            grad_fast, grad_slow = z.grads
+        inner = step_size / self.n_fast_steps
+        r = z.momentum + 0.5 * step_size * grad_slow
+        position = z.position
+        for _ in range(self.n_fast_steps):
+            r = r + 0.5 * inner * grad_fast
+            position = position + inner * h.metric.velocity(r)
+            logp_fast, grad_fast = h.evaluate_fast(position)
+            if not np.isfinite(logp_fast):
+                return PhasePoint(position, r, -np.inf, grad_fast)
+            r = r + 0.5 * inner * grad_fast
+        logp_slow, grad_slow = h.evaluate_slow(position)
+        r = r + 0.5 * step_size * grad_slow
+        return PhasePoint(
+            position,
+            r,
+            logp_fast + logp_slow,
+            grad_fast + grad_slow,
+            (grad_fast, grad_slow),
+        )
+
+
+class _Tree(object):
+
+    """Subtree built by NUTS, spanning phase points `left` to `right`."""
+
+    __slots__ = (
+        "left",
+        "right",
+        "sample",
+        "log_weight",
+        "rho",
+        "n_steps",
+        "sum_accept",
+        "max_energy_error",
+        "diverging",
+        "turning",
+    )
+
+    def __init__(self, z, log_weight, accept, energy_error, diverging):
+        self.left = self.right = self.sample = z
+        self.log_weight = log_weight
+        self.rho = z.momentum
+        self.n_steps = 1
+        self.sum_accept = accept
+        self.max_energy_error = energy_error
+        self.diverging = diverging
+        self.turning = False
+
+
+class NUTS(object):
+
+    """No-U-turn sampler with multinomial sampling of the trajectory and the
+    generalised no-U-turn criterion (as in Stan)."""
+
+    def __init__(self, integrator, max_depth=10, max_energy_error=1000.0):
+        self.integrator = integrator
+        self.max_depth = max_depth
+        self.max_energy_error = max_energy_error
+        self.is_adapt = False
+
+    def _is_turning(self, h, zl, zr, rho):
+        return (
+            np.dot(h.metric.velocity(zl.momentum), rho) <= 0
+            or np.dot(h.metric.velocity(zr.momentum), rho) <= 0
+        )
+
+    def _leaf(self, h, z, step_size, H0):
+        z = self.integrator.step(h, z, step_size)
+        energy_error = h.energy(z) - H0
+        if not np.isfinite(energy_error):
+            energy_error = np.inf
+        diverging = energy_error > self.max_energy_error
+        accept = min(1.0, np.exp(-energy_error))
+        return _Tree(z, -energy_error, accept, energy_error, diverging)
+
+    def _merge_stats(self, t1, t2):
+        t1.n_steps += t2.n_steps
+        t1.sum_accept += t2.sum_accept
+        if abs(t2.max_energy_error) > abs(t1.max_energy_error):
+            t1.max_energy_error = t2.max_energy_error
+
+    def _build_tree(self, h, z, step_size, depth, H0):
+        if depth == 0:
+            return self._leaf(h, z, step_size, H0)
+        t1 = self._build_tree(h, z, step_size, depth - 1, H0)
+        if t1.diverging or t1.turning:
+            return t1
+        start = t1.right if step_size > 0 else t1.left
+        t2 = self._build_tree(h, start, step_size, depth - 1, H0)
+        self._merge_stats(t1, t2)
+        if t2.diverging or t2.turning:
+            t1.diverging, t1.turning = t2.diverging, t2.turning
+            return t1
+
+        log_weight = np.logaddexp(t1.log_weight, t2.log_weight)
+        if np.log(np.random.uniform()) < t2.log_weight - log_weight:
+            t1.sample = t2.sample
+        t1.log_weight = log_weight
+
+        # order the subtrees along the trajectory
+        a, b = (t1, t2) if step_size > 0 else (t2, t1)
+        rho = a.rho + b.rho
+        t1.turning = (
+            self._is_turning(h, a.left, b.right, rho)
+            or self._is_turning(h, a.left, b.left, a.rho + b.left.momentum)
+            or self._is_turning(h, a.right, b.right, b.rho + a.right.momentum)
+        )
+        t1.left, t1.right = a.left, b.right
+        t1.rho = rho
+        return t1
+
+    def transition(self, h, z0):
+        z0 = h.refresh(z0)
+        H0 = h.energy(z0)
+        step_size = self.integrator.step_size
+        left = right = sample = z0
+        log_weight = 0.0
+        rho = z0.momentum
+        n_steps, sum_accept, max_energy_error = 0, 0.0, 0.0
+        diverging = False
+        depth = 0
+        while depth < self.max_depth:
+            direction = 1 if np.random.uniform() < 0.5 else -1
+            start = right if direction > 0 else left
+            tree = self._build_tree(h, start, direction * step_size, depth, H0)
+            depth += 1
+            n_steps += tree.n_steps
+            sum_accept += tree.sum_accept
+            if abs(tree.max_energy_error) > abs(max_energy_error):
+                max_energy_error = tree.max_energy_error
+            if tree.diverging:
+                diverging = True
+                break
+            if tree.turning:
+                break
+            # biased progressive sampling
+            if np.log(np.random.uniform()) < tree.log_weight - log_weight:
+                sample = tree.sample
+            log_weight = np.logaddexp(log_weight, tree.log_weight)
+            # check the merged tree as _build_tree does, so that the same
+            # tree is built from any of its points
+            if direction > 0:
+                a_left, a_right, a_rho = left, right, rho
+                b_left, b_right, b_rho = tree.left, tree.right, tree.rho
+                right = tree.right
+            else:
+                a_left, a_right, a_rho = tree.left, tree.right, tree.rho
+                b_left, b_right, b_rho = left, right, rho
+                left = tree.left
+            rho = rho + tree.rho
+            if (
+                self._is_turning(h, left, right, rho)
+                or self._is_turning(h, a_left, b_left, a_rho + b_left.momentum)
+                or self._is_turning(
+                    h, a_right, b_right, b_rho + a_right.momentum
+                )
+            ):
+                break
+
+        energy = h.energy(sample)
+        stats = {
+            "n_steps": n_steps,
+            "is_accept": True,
+            "acceptance_rate": sum_accept / n_steps,
+            "log_density": sample.logp,
+            "hamiltonian_energy": energy,
+            "hamiltonian_energy_error": energy - H0,
+            "max_hamiltonian_energy_error": max_energy_error,
+            "tree_depth": depth,
+            "numerical_error": diverging,
+            "step_size": step_size,
+            "nom_step_size": step_size,
+            "is_adapt": self.is_adapt,
+        }
+        return sample, stats
+
+
+class StaticTrajectory(object):
+
+    """HMC with a fixed number of leapfrog steps and a Metropolis
+    correction."""
+
+    def __init__(self, integrator, n_steps=10):
+        self.integrator = integrator
+        self.n_steps = n_steps
+        self.is_adapt = False
+
+    def transition(self, h, z0):
+        z0 = h.refresh(z0)
+        H0 = h.energy(z0)
+        step_size = self.integrator.step_size
+        z = z0
+        for _ in range(self.n_steps):
+            z = self.integrator.step(h, z, step_size)
+            if not z.is_valid():
+                break
+        energy_error = h.energy(z) - H0
+        if not np.isfinite(energy_error):
+            energy_error = np.inf
+        accept_prob = min(1.0, np.exp(-energy_error))
+        is_accept = np.random.uniform() < accept_prob
+        sample = z if is_accept else z0
+        energy = h.energy(sample)
+        stats = {
+            "n_steps": self.n_steps,
+            "is_accept": is_accept,
+            "acceptance_rate": accept_prob,
+            "log_density": sample.logp,
+            "hamiltonian_energy": energy,
+            "hamiltonian_energy_error": energy - H0,
+            "max_hamiltonian_energy_error": energy_error,
+            "tree_depth": 0,
+            "numerical_error": not np.isfinite(energy_error),
+            "step_size": step_size,
+            "nom_step_size": step_size,
+            "is_adapt": self.is_adapt,
+        }
+        return sample, stats
+
+
+def make_phasepoint(h, position):
+    position = np.array(position, dtype=np.double)
+    logp, grad = h.evaluate(position)
+    return PhasePoint(position, h.metric.sample_momentum(), logp, grad)
+
+
+def position(z):
+    return z.position
+
+
+def step_size(integrator):
+    return integrator.step_size
+
+
+def sample(h, sampler, z):
+    return sampler.transition(h, z)
+
+
+def sample_n(h, sampler, z, n):
+    """Run `n` transitions from `z`, returning the final phase point, the
+    positions (n, ndim), and the names and columns of the statistics."""
+    positions = np.empty((n, len(z.position)))
+    stats = []
+    for i in range(n):
+        z, s = sampler.transition(h, z)
+        positions[i] = z.position
+        stats.append(s)
+    keys = list(stats[0])
+    return z, positions, keys, [np.array([s[k] for s in stats]) for k in keys]
+
+
+def find_good_eps(h, position, max_n_iters=100):
+    """Find a reasonable initial step size.
+
+    See Hoffman & Gelman, JMLR 15 (2014), algorithm 4."""
+    integrator = Leapfrog(1.0)
+    z = make_phasepoint(h, position)
+    H0 = h.energy(z)
+
+    def log_accept_ratio(eps):
+        dH = H0 - h.energy(integrator.step(h, z, eps))
+        return dH if np.isfinite(dH) else -np.inf
+
+    eps = 1.0
+    a = 1 if log_accept_ratio(eps) > np.log(0.5) else -1
+    for _ in range(max_n_iters):
+        if a * log_accept_ratio(eps) <= -a * np.log(2):
+            break
+        eps *= 2.0 ** a
+    return eps
+
+
+class NesterovDualAveraging(DualAveraging):
+    def __init__(self, delta, step_size):
+        super().__init__(step_size, target=delta)
+
+
+class Preconditioner(object):
+
+    """Estimator of the metric from warm-up positions."""
+
+    def __init__(self, metric):
+        self.metric = metric
+        if isinstance(metric, UnitEuclideanMetric):
+            self.estimator = None
+        else:
+            self.estimator = WelfordEstimator(
+                metric.get_dimension(),
+                dense=isinstance(metric, DenseEuclideanMetric),
+            )
+
+    def add_sample(self, position):
+        if self.estimator is not None:
+            self.estimator.add_sample(position)
+
+    def update(self):
+        """Update the metric from the collected samples and reset."""
+        if self.estimator is None:
+            return
+        self.metric = type(self.metric)(self.estimator.get_variance())
+        self.estimator.reset()
+
+
+class StanHMCAdaptor(object):
+
+    """Stan-style windowed adaptation of the step size and metric."""
+
+    def __init__(self, n_adapts, preconditioner, step_size_adaptor):
+        self.n_adapts = n_adapts
+        self.preconditioner = preconditioner
+        self.step_size_adaptor = step_size_adaptor
+        self.windows = get_slow_windows(n_adapts)
+        self.step_size = step_size_adaptor.step_size
+        self.counter = 0
+
+    @property
+    def metric(self):
+        return self.preconditioner.metric
+
+    def is_adapting(self):
+        return self.counter < self.n_adapts
+
+    def adapt(self, position, accept):
+        if not self.is_adapting():
+            return
+        step = self.counter
+        self.counter += 1
+        self.step_size = self.step_size_adaptor.update(accept)
+        for start, end in self.windows:
+            if start <= step < end:
+                self.preconditioner.add_sample(position)
+                if step + 1 == end:
+                    self.preconditioner.update()
+                    self.step_size_adaptor.restart(self.step_size)
+                break
+        if self.counter == self.n_adapts:
+            self.step_size = self.step_size_adaptor.get_final_step_size()
+
+
+def adapt_b(adaptor, position, accept):
+    adaptor.adapt(np.asarray(position), accept)
+
+
+def reconstruct(obj, adaptor):
+    """Rebuild a Hamiltonian or sampler with the adapted parameters."""
+    if isinstance(obj, Hamiltonian):
+        if obj.metric is adaptor.metric:
+            return obj
+        return Hamiltonian(
+            adaptor.metric, obj.logpdf, obj.logpdf_with_gradient
+        )
+    integrator = Leapfrog(adaptor.step_size)
+    if isinstance(obj, NUTS):
+        sampler = NUTS(integrator, obj.max_depth, obj.max_energy_error)
+    else:
+        sampler = StaticTrajectory(integrator, obj.n_steps)
+    sampler.is_adapt = adaptor.is_adapting()
+    return sampler
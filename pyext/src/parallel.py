@@ -0,0 +1,613 @@
+"""Run several HMC chains, or the restraints of one chain, in parallel.
+
+Julia cannot be shared across a fork, so workers are started with the
+``spawn`` method and each rebuilds its IMP model from a user-supplied
+factory. The factory must be picklable, i.e. a module-level function.
+"""
+
+import multiprocessing
+import traceback
+import weakref
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+
+import numpy as np
+
+from .log_density import LogDensity
+from .instrumentation import Timer
+
+
+def get_chain_seeds(nchains, seed=None):
+    """Get a distinct 31-bit random seed for each chain."""
+    rng = np.random.RandomState(seed)
+    return [int(s) for s in rng.randint(1, 2 ** 31 - 1, size=nchains)]
+
+
+def seed_all(seed):
+    """Seed the IMP, NumPy and Julia random number generators.
+
+    Julia is not started just to be seeded (see `julia.set_julia_seed`)."""
+    import IMP
+    from .julia import set_julia_seed
+
+    IMP.random_number_generator.seed(seed)
+    np.random.seed(seed)
+    set_julia_seed(seed)
+
+
+def _serve(conn, factory, args):
+    try:
+        obj = factory(*args)
+    except Exception:
+        conn.send((False, traceback.format_exc()))
+        return
+    conn.send((True, None))
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        name, args, kwargs = msg
+        try:
+            conn.send((True, getattr(obj, name)(*args, **kwargs)))
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+
+
+class WorkerProxy(object):
+
+    """Proxy for an object living in its own worker process.
+
+    The object is built in the worker by calling `factory(*args)`. Methods
+    are invoked with `call`, or with `call_async` followed by `get_result`
+    to run several workers concurrently."""
+
+    def __init__(self, factory, args=(), context=None):
+        if context is None:
+            context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_serve, args=(child_conn, factory, args), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.get_result()
+
+    def call_async(self, name, *args, **kwargs):
+        self.conn.send((name, args, kwargs))
+
+    def get_result(self):
+        ok, result = self.conn.recv()
+        if not ok:
+            raise RuntimeError("Error in worker process:\n" + result)
+        return result
+
+    def call(self, name, *args, **kwargs):
+        self.call_async(name, *args, **kwargs)
+        return self.get_result()
+
+    def close(self):
+        if self.process.is_alive():
+            self.conn.send(None)
+            self.process.join()
+        self.conn.close()
+
+
+def _run_chain(sf_factory, chain, seed, kwargs):
+    from .defaults import setup_warmup_run_hmc
+
+    seed_all(seed)
+    if kwargs.get("store") is not None:
+        from .store import SampleStore
+
+        with SampleStore(kwargs["store"]).get_writer(chain) as writer:
+            hmc = setup_warmup_run_hmc(
+                sf_factory(), **dict(kwargs, store=writer)
+            )
+        return chain, hmc.get_sample_names(), None, None
+    hmc = setup_warmup_run_hmc(sf_factory(), **kwargs)
+    samples = hmc.sample_saver.get_values_numpy().copy()
+    stats = {k: np.array(v) for k, v in hmc.stats.get_samples().items()}
+    return chain, hmc.get_sample_names(), samples, stats
+
+
+class _PooledChain(object):
+
+    """Chain set up in a worker process for pooled warm-up."""
+
+    def __init__(self, sf_factory, seed, adapt_delta, metric, kwargs):
+        from .defaults import setup_warmup_hmc
+        from .adaptor import ChainAdaptation
+
+        seed_all(seed)
+        self.hmc = setup_warmup_hmc(
+            sf_factory(), metric=metric, nadapt=0, **kwargs
+        )
+        self.adaptation = ChainAdaptation(
+            self.hmc,
+            adapt_delta=adapt_delta,
+            metric=metric,
+            rank=kwargs.get("metric_rank", 10),
+            blocks=kwargs.get("metric_blocks"),
+        )
+
+    def start_window(self, nsteps, collect):
+        self.adaptation.start_window(nsteps, collect)
+        return self.adaptation.finish_window()
+
+    def set_metric(self, metric):
+        self.adaptation.set_metric(metric)
+
+    def finalize(self):
+        return self.adaptation.finalize()
+
+    def run(self, nsample, save_samples=True):
+        self.hmc.stats = None
+        self.hmc.set_save_samples(save_samples)
+        self.hmc.optimize(nsample)
+        return self.get_results()
+
+    def start_sampling(self):
+        self.hmc.stats = None
+        self.hmc.sample_saver.clear()
+
+    def sample_block(self, nsample):
+        return self.hmc.sample_block(nsample)
+
+    def get_results(self):
+        samples = self.hmc.sample_saver.get_values_numpy().copy()
+        stats = {k: np.array(v) for k, v in self.hmc.stats.get_samples().items()}
+        return self.hmc.get_sample_names(), samples, stats
+
+
+class RemoteChainAdaptation(object):
+
+    """Proxy for the `ChainAdaptation` of a chain in a worker process."""
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def start_window(self, nsteps, collect):
+        self.worker.call_async("start_window", nsteps, collect)
+
+    def finish_window(self):
+        return self.worker.get_result()
+
+    def set_metric(self, metric):
+        self.worker.call("set_metric", metric)
+
+    def finalize(self):
+        return self.worker.call("finalize")
+
+
+class RemoteChain(object):
+
+    """Proxy for sampling a chain in a worker process in blocks, for
+    `IMP.hmc.convergence.sample_until_converged`."""
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def start_block(self, nsample):
+        self.worker.call_async("sample_block", nsample)
+
+    def finish_block(self):
+        return self.worker.get_result()
+
+
+def _run_pooled_chains(
+    sf_factory,
+    seeds,
+    nsample=2000,
+    save_samples=True,
+    nadapt=1000,
+    adapt_delta=0.8,
+    metric="diag",
+    verbose=False,
+    callback=None,
+    convergence=None,
+    check_every=100,
+    log=print,
+    **kwargs
+):
+    from .adaptor import PooledAdaptor
+
+    kwargs.pop("log_freq", None)
+    schedule = {
+        k: kwargs.pop(k)
+        for k in ("init_buffer", "term_buffer", "base_window")
+        if k in kwargs
+    }
+    workers = []
+    try:
+        for seed in seeds:
+            workers.append(
+                WorkerProxy(
+                    _PooledChain,
+                    (
+                        sf_factory,
+                        seed,
+                        adapt_delta,
+                        metric,
+                        dict(kwargs, log=log),
+                    ),
+                )
+            )
+        chains = [RemoteChainAdaptation(w) for w in workers]
+        PooledAdaptor(
+            chains,
+            nadapt=nadapt,
+            metric=metric,
+            verbose=verbose,
+            log=log,
+            **schedule
+        ).adapt()
+        if convergence is None:
+            for w in workers:
+                w.call_async("run", nsample, save_samples)
+        else:
+            from .convergence import sample_until_converged
+
+            for w in workers:
+                w.call("start_sampling")
+            sample_until_converged(
+                [RemoteChain(w) for w in workers],
+                convergence,
+                nsample,
+                block_size=check_every,
+                log=log if verbose else lambda msg: None,
+            )
+            for w in workers:
+                w.call_async("get_results")
+        results = []
+        for chain, w in enumerate(workers):
+            names, samples, stats = w.get_result()
+            results.append((samples, stats))
+            if callback is not None:
+                callback(chain, names, samples, stats)
+    finally:
+        for w in workers:
+            w.close()
+    return names, results
+
+
+def run_chains(
+    sf_factory,
+    nchains=4,
+    nworkers=None,
+    seed=None,
+    callback=None,
+    varnames=None,
+    pool_warmup=False,
+    log=print,
+    **kwargs
+):
+    """Warm up and run `nchains` HMC chains in worker processes.
+
+    `sf_factory` is called without arguments in each worker and must build
+    the model and return its scoring function. `kwargs` are passed to
+    `IMP.hmc.defaults.setup_warmup_run_hmc`. Each chain gets its own seed
+    for the IMP, NumPy and Julia random number generators.
+
+    As each chain finishes, `callback(chain, varnames, samples, stats)` is
+    called, if given. Returns an ArviZ `InferenceData` with all chains,
+    using `varnames` as variable names if given. Progress messages are
+    passed to `log`, which is also passed to the worker processes and so
+    must be picklable, such as `print` or a module-level function.
+
+    If `pool_warmup`, all chains run concurrently in their own process
+    (`nworkers` is ignored) and share a metric estimated from all of their
+    warm-up positions (see `IMP.hmc.adaptor.PooledAdaptor`). Only then
+    can sampling stop early once the chains jointly meet a `convergence`
+    criterion; otherwise each chain would stop on its own.
+
+    If `store` is the path of an `IMP.hmc.store.SampleStore` with `nchains`
+    chains, each chain writes its samples there as it runs instead of
+    returning them, and the returned `InferenceData` is loaded lazily from
+    the store. The callback is then passed None for the samples and
+    statistics.
+    """
+    from .diagnostics import get_inference_data_from_chains
+
+    if kwargs.get("convergence") is not None and not pool_warmup:
+        raise ValueError(
+            "Stopping on convergence of multiple chains requires "
+            "pool_warmup=True."
+        )
+
+    if kwargs.get("store") is not None and pool_warmup:
+        raise ValueError("A sample store cannot be used with pool_warmup.")
+
+    if pool_warmup:
+        names, results = _run_pooled_chains(
+            sf_factory,
+            get_chain_seeds(nchains, seed),
+            callback=callback,
+            log=log,
+            **kwargs
+        )
+        if varnames is None:
+            varnames = names
+        return get_inference_data_from_chains(results, varnames=varnames)
+
+    if nworkers is None:
+        nworkers = min(nchains, multiprocessing.cpu_count())
+    seeds = get_chain_seeds(nchains, seed)
+    ctx = multiprocessing.get_context("spawn")
+    results = [None] * nchains
+    names = None
+    with ProcessPoolExecutor(max_workers=nworkers, mp_context=ctx) as pool:
+        futures = [
+            pool.submit(
+                _run_chain,
+                sf_factory,
+                chain,
+                seeds[chain],
+                dict(kwargs, log=log),
+            )
+            for chain in range(nchains)
+        ]
+        for future in as_completed(futures):
+            chain, names, samples, stats = future.result()
+            results[chain] = (samples, stats)
+            if callback is not None:
+                callback(chain, names, samples, stats)
+    if kwargs.get("store") is not None:
+        from .store import SampleStore
+
+        return SampleStore(kwargs["store"]).get_inference_data(
+            varnames=varnames
+        )
+    if varnames is None:
+        varnames = names
+    return get_inference_data_from_chains(results, varnames=varnames)
+
+
+def _get_restraint_signature(sf):
+    """Get the name and weight of each flattened restraint of `sf`."""
+    from .defaults import get_flattened_restraints
+
+    return [(r.get_name(), w) for r, w in get_flattened_restraints(sf)]
+
+
+def get_round_robin_groups(nrestraints, ngroups):
+    """Assign restraint indexes to `ngroups` groups in turn."""
+    return [list(range(i, nrestraints, ngroups)) for i in range(ngroups)]
+
+
+class _RestraintGroup(object):
+
+    """Replica of the model evaluating one group of restraints.
+
+    Positions are read from, and gradients written to, shared memory
+    blocks if their names are given, so that only small messages pass
+    between processes."""
+
+    def __init__(
+        self,
+        sf_factory,
+        group,
+        names,
+        restraints,
+        x_name=None,
+        grad_name=None,
+        row=0,
+        nrows=1,
+    ):
+        from .defaults import get_restraint_group_scoring_functions
+        from .variables import OptimizedVariables
+
+        sf = sf_factory()
+        opt_vars = OptimizedVariables(sf.get_model())
+        if opt_vars.get_names() != names:
+            raise ValueError(
+                "The model built by the factory does not have the same "
+                "optimized variables as the sampled model"
+            )
+        # groups index the restraints of the sampled model
+        if _get_restraint_signature(sf) != restraints:
+            raise ValueError(
+                "The model built by the factory does not have the same "
+                "restraints and weights as the sampled model"
+            )
+        (group_sf,) = get_restraint_group_scoring_functions(sf, [group])
+        self.logpdf = LogDensity(
+            group_sf, opt_vars.get_interface(), cache_size=0
+        )
+        n = len(names)
+        self._shm = []
+        if x_name is not None:
+            self._x = self._attach(x_name, (n,))
+            self._grads = self._attach(grad_name, (nrows, n))
+        self.row = row
+
+    def _attach(self, name, shape):
+        from multiprocessing import shared_memory
+
+        shm = shared_memory.SharedMemory(name=name)
+        self._shm.append(shm)
+        return np.ndarray(shape, dtype=np.double, buffer=shm.buf)
+
+    def evaluate(self, x=None, gradient=True):
+        """Evaluate at `x` (by default, the shared position), writing the
+        gradient to the shared gradients if `gradient`, and return the log
+        density (and gradient, if not shared)."""
+        shared = x is None
+        if shared:
+            x = self._x
+        if not gradient:
+            return self.logpdf.get_logpdf(x)
+        logp, grad = self.logpdf.get_logpdf_with_gradient(x)
+        if not shared:
+            return logp, grad
+        self._grads[self.row] = grad
+        return logp
+
+
+def _release(pools, workers, shms):
+    for pool in pools:
+        pool.shutdown()
+    for w in workers:
+        if isinstance(w, WorkerProxy):
+            w.close()
+    for shm in shms:
+        try:
+            shm.close()
+        except BufferError:
+            # still mapped by views that are freed with the log density
+            pass
+        shm.unlink()
+    del pools[:], workers[:], shms[:]
+
+
+class ParallelLogDensity(LogDensity):
+
+    """Log density evaluating groups of restraints concurrently.
+
+    The restraints of the scoring function built by `sf_factory` (flattened
+    as by `IMP.hmc.defaults.get_flattened_restraints`) are split into
+    `groups`, lists of restraint indexes, by default assigned in turn to
+    `nworkers` groups. Each group is evaluated by its own replica of the
+    model, built by calling `sf_factory`, and the log densities and
+    gradients of the groups are summed. `sf` and `opt_vars` are the scoring
+    function and `OptimizedVariables` of the sampled model, whose optimized
+    variables must match those of the replicas.
+
+    With `mode="process"`, each replica lives in a worker process, and
+    positions and gradients are exchanged through shared memory, which
+    needs Python 3.8 or later. With
+    `mode="thread"`, the replicas live in this process and are evaluated by
+    a thread pool; this only helps if the restraints release the GIL while
+    scoring.
+
+    The workers are shut down and the shared memory released by `close`,
+    on leaving a `with` block, or when the log density is garbage
+    collected."""
+
+    def __init__(
+        self,
+        sf_factory,
+        sf,
+        opt_vars,
+        nworkers=None,
+        groups=None,
+        mode="process",
+        cache_size=16,
+    ):
+        super().__init__(sf, opt_vars.get_interface(), cache_size=cache_size)
+        if mode not in ("process", "thread"):
+            raise ValueError("'mode' must be in {'process', 'thread'}")
+        self.mode = mode
+        restraints = _get_restraint_signature(sf)
+        nrestraints = len(restraints)
+        if groups is None:
+            if nworkers is None:
+                nworkers = multiprocessing.cpu_count()
+            groups = get_round_robin_groups(
+                nrestraints, min(nworkers, nrestraints)
+            )
+        if any(not 0 <= i < nrestraints for group in groups for i in group):
+            raise ValueError(
+                "Restraint groups must be indexes of the {0} flattened "
+                "restraints of the scoring function".format(nrestraints)
+            )
+        self.groups = groups
+        names = opt_vars.get_names()
+        n = len(names)
+        self._shm = []
+        self._workers = []
+        self._pools = []
+        self._pool = None
+        self._finalizer = weakref.finalize(
+            self, _release, self._pools, self._workers, self._shm
+        )
+        if mode == "thread":
+            try:
+                for group in groups:
+                    self._workers.append(
+                        _RestraintGroup(sf_factory, group, names, restraints)
+                    )
+            except BaseException:
+                self.close()
+                raise
+            self._pool = ThreadPoolExecutor(max_workers=len(groups))
+            self._pools.append(self._pool)
+            return
+        x_shm = self._create_shared(n)
+        grad_shm = self._create_shared(n * len(groups))
+        self._x = np.ndarray((n,), dtype=np.double, buffer=x_shm.buf)
+        self._grads = np.ndarray(
+            (len(groups), n), dtype=np.double, buffer=grad_shm.buf
+        )
+        try:
+            for row, group in enumerate(groups):
+                self._workers.append(
+                    WorkerProxy(
+                        _RestraintGroup,
+                        (
+                            sf_factory,
+                            group,
+                            names,
+                            restraints,
+                            x_shm.name,
+                            grad_shm.name,
+                            row,
+                            len(groups),
+                        ),
+                    )
+                )
+        except BaseException:
+            self.close()
+            raise
+
+    def _create_shared(self, n):
+        # shared memory needs Python 3.8 or later, so is only imported
+        # when worker processes are used
+        from multiprocessing import shared_memory
+
+        shm = shared_memory.SharedMemory(create=True, size=max(n, 1) * 8)
+        self._shm.append(shm)
+        return shm
+
+    def _evaluate(self, x):
+        with Timer(self.instrumentation, "score"):
+            if self.mode == "thread":
+                return sum(
+                    self._pool.map(
+                        lambda w: w.evaluate(x, gradient=False), self._workers
+                    )
+                )
+            self._x[:] = x
+            for w in self._workers:
+                w.call_async("evaluate", gradient=False)
+            return sum(w.get_result() for w in self._workers)
+
+    def _evaluate_with_gradient(self, x):
+        with Timer(self.instrumentation, "score"):
+            if self.mode == "thread":
+                results = list(
+                    self._pool.map(lambda w: w.evaluate(x), self._workers)
+                )
+                logp = sum(r[0] for r in results)
+                grad = np.sum([r[1] for r in results], axis=0)
+                return logp, grad
+            self._x[:] = x
+            for w in self._workers:
+                w.call_async("evaluate")
+            logp = sum(w.get_result() for w in self._workers)
+            return logp, self._grads.sum(axis=0)
+
+    def close(self):
+        """Shut down the workers and release shared memory."""
+        self._pool = None
+        # views of the shared memory must go before it can be closed
+        self._x = self._grads = None
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
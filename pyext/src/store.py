@@ -0,0 +1,292 @@
+"""On-disk storage of samples for long runs.
+
+Building an `InferenceData` from the samples of long chains on large systems
+holds several copies of them in memory. A `SampleStore` instead keeps them
+in a directory, written in chunks as sampling proceeds, and opens them as an
+`InferenceData` backed by memory-mapped files, so that only the parts in use
+are read into memory.
+
+A store directory holds:
+
+- `metadata.json`: the format version, variable names, number of chains,
+  capacity and data type of the samples
+- `posterior.npy`: a preallocated array (nchains, nvars, max_samples) of
+  samples, with the draws of each variable of a chain contiguous. Space for
+  draws not yet written is not allocated on file systems with sparse files.
+- `chain<i>.json`: the number of samples and statistics written for chain
+  `i` and the data types of the statistics
+- `chain<i>.<stat>.dat`: raw values of each statistic of chain `i`
+
+Each chain is written by its own `ChainWriter`, so chains may be written by
+different processes. Progress files are written atomically after the data
+they describe, so a store can be read while it is written and a writer
+resumed after a crash loses at most the unflushed chunk.
+"""
+
+import json
+import os
+import tempfile
+
+import numpy as np
+
+STORE_VERSION = 1
+
+
+def _write_json(path, obj):
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=".json.tmp")
+    try:
+        with os.fdopen(fd, "w") as fh:
+            json.dump(obj, fh)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_json(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+class SampleStore(object):
+
+    """Directory of samples and statistics of one or more chains.
+
+    Open an existing store with `SampleStore(path)`, or create one with
+    `create`."""
+
+    def __init__(self, path):
+        self.path = path
+        metadata = _read_json(os.path.join(path, "metadata.json"))
+        if metadata["version"] > STORE_VERSION:
+            raise ValueError(
+                "Sample store version {0} is newer than supported "
+                "version {1}".format(metadata["version"], STORE_VERSION)
+            )
+        self.varnames = metadata["varnames"]
+        self.nchains = metadata["nchains"]
+        self.max_samples = metadata["max_samples"]
+        self.dtype = np.dtype(metadata["dtype"])
+
+    @classmethod
+    def create(cls, path, varnames, max_samples, nchains=1, dtype=np.float64):
+        """Create a store at `path` for up to `max_samples` samples of each
+        of `nchains` chains, stored as `dtype` (e.g. `np.float32` to halve
+        its size)."""
+        os.makedirs(path, exist_ok=True)
+        varnames = [str(name) for name in varnames]
+        np.lib.format.open_memmap(
+            os.path.join(path, "posterior.npy"),
+            mode="w+",
+            dtype=dtype,
+            shape=(nchains, len(varnames), max_samples),
+        ).flush()
+        for chain in range(nchains):
+            _write_json(
+                cls._get_chain_path(path, chain),
+                {"nsamples": 0, "nstats": 0, "stats": {}},
+            )
+        _write_json(
+            os.path.join(path, "metadata.json"),
+            {
+                "version": STORE_VERSION,
+                "varnames": varnames,
+                "nchains": nchains,
+                "max_samples": max_samples,
+                "dtype": np.dtype(dtype).str,
+            },
+        )
+        return cls(path)
+
+    @classmethod
+    def create_for_hmc(cls, path, hmc, max_samples, nchains=1, **kwargs):
+        """Create a store for the variables saved by `hmc`."""
+        return cls.create(
+            path, hmc.get_sample_names(), max_samples, nchains=nchains, **kwargs
+        )
+
+    @staticmethod
+    def _get_chain_path(path, chain):
+        return os.path.join(path, "chain{0}.json".format(chain))
+
+    def _get_stat_path(self, chain, key):
+        return os.path.join(self.path, "chain{0}.{1}.dat".format(chain, key))
+
+    def get_chain_info(self, chain):
+        """Get the numbers of samples and statistics written for `chain`."""
+        return _read_json(self._get_chain_path(self.path, chain))
+
+    def get_number_of_samples(self):
+        """Get the number of samples written for every chain."""
+        return min(
+            self.get_chain_info(c)["nsamples"] for c in range(self.nchains)
+        )
+
+    def get_writer(self, chain=0):
+        return ChainWriter(self, chain)
+
+    def get_posterior(self, mode="r"):
+        """Get the memory-mapped array (nchains, nvars, max_samples) of
+        samples."""
+        return np.load(os.path.join(self.path, "posterior.npy"), mmap_mode=mode)
+
+    def get_stats(self, chain):
+        """Get the memory-mapped statistics of `chain` as a dict."""
+        info = self.get_chain_info(chain)
+        return {
+            key: np.memmap(
+                self._get_stat_path(chain, key),
+                dtype=np.dtype(dtype),
+                mode="r",
+                shape=(info["nstats"],),
+            )
+            if info["nstats"] > 0
+            else np.empty(0, dtype=np.dtype(dtype))
+            for key, dtype in info["stats"].items()
+        }
+
+    def get_inference_data(self, varnames=None):
+        """Open the samples written to all chains as an ArviZ
+        `InferenceData`, using `varnames` as variable names if given.
+
+        Chains are truncated to the length of the shortest. The posterior is
+        not read into memory until it is used; statistics are."""
+        import arviz as az
+
+        if varnames is None:
+            varnames = self.varnames
+        elif len(varnames) != len(self.varnames):
+            raise ValueError(
+                "Expected {0} variable names, got {1}".format(
+                    len(self.varnames), len(varnames)
+                )
+            )
+        n = self.get_number_of_samples()
+        posterior = self.get_posterior()[:, :, :n]
+        chain_stats = [self.get_stats(c) for c in range(self.nchains)]
+        nstats = min(
+            (len(s) for stats in chain_stats for s in stats.values()),
+            default=0,
+        )
+        sample_stats = {
+            key: np.stack([stats[key][:nstats] for stats in chain_stats])
+            for key in chain_stats[0]
+            if all(key in stats for stats in chain_stats)
+        }
+        return az.from_dict(
+            posterior={
+                name: posterior[:, i] for i, name in enumerate(varnames)
+            },
+            sample_stats=sample_stats or None,
+        )
+
+
+class ChainWriter(object):
+
+    """Appends the samples and statistics of one chain to a `SampleStore`.
+
+    Writing resumes after anything already written to the chain. Data are
+    written as they are added, and the progress recorded by `flush`."""
+
+    def __init__(self, store, chain=0):
+        self.store = store
+        self.chain = chain
+        self._posterior = store.get_posterior(mode="r+")[chain]
+        info = store.get_chain_info(chain)
+        self.nsamples = info["nsamples"]
+        self.nstats = info["nstats"]
+        self.stats_dtypes = info["stats"]
+        self._stats_files = {}
+        for key in self.stats_dtypes:
+            self._open_stat(key)
+
+    def _open_stat(self, key):
+        path = self.store._get_stat_path(self.chain, key)
+        fh = open(path, "ab")
+        # discard anything written after the last flush
+        fh.truncate(self.nstats * np.dtype(self.stats_dtypes[key]).itemsize)
+        self._stats_files[key] = fh
+
+    def add_samples(self, samples):
+        """Add samples (nsamples, nvars)."""
+        samples = np.asarray(samples)
+        n = len(samples)
+        if self.nsamples + n > self.store.max_samples:
+            raise ValueError(
+                "Sample store holds at most {0} samples per chain".format(
+                    self.store.max_samples
+                )
+            )
+        self._posterior[:, self.nsamples : self.nsamples + n] = samples.T
+        self.nsamples += n
+
+    def add_stats(self, stats):
+        """Add a dict of per-sample statistics arrays of equal length."""
+        stats = {k: np.asarray(v) for k, v in stats.items()}
+        if not stats:
+            return
+        n = len(next(iter(stats.values())))
+        if self.nstats > 0 and set(stats) != set(self.stats_dtypes):
+            raise ValueError("Statistics do not match those already written")
+        for key, values in stats.items():
+            if key not in self._stats_files:
+                self.stats_dtypes[key] = values.dtype.str
+                self._open_stat(key)
+            values.astype(self.stats_dtypes[key]).tofile(self._stats_files[key])
+        self.nstats += n
+
+    def add_hmc(self, hmc):
+        """Move the samples saved by `hmc` and its statistics into the store,
+        clearing them from `hmc`."""
+        self.add_samples(hmc.sample_saver.get_values_numpy())
+        hmc.sample_saver.clear()
+        if hmc.stats is not None:
+            self.add_stats(hmc.stats.get_samples(copy=False))
+            hmc.stats.clear()
+
+    def flush(self):
+        self._posterior.flush()
+        for fh in self._stats_files.values():
+            fh.flush()
+        _write_json(
+            self.store._get_chain_path(self.store.path, self.chain),
+            {
+                "nsamples": self.nsamples,
+                "nstats": self.nstats,
+                "stats": self.stats_dtypes,
+            },
+        )
+
+    def close(self):
+        self.flush()
+        for fh in self._stats_files.values():
+            fh.close()
+        self._stats_files = {}
+        self._posterior = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def sample_to_store(hmc, writer, nsample, block_size=1000):
+    """Sample `hmc` for `nsample` transitions, moving the samples and
+    statistics to a `ChainWriter` every `block_size` transitions, so that at
+    most one block is held in memory.
+
+    If `writer` resumes a chain, only the transitions needed to complete
+    `nsample` are run, assuming the samples already written were saved with
+    the current period of `hmc.sample_saver`."""
+    hmc.set_save_samples(True)
+    hmc.sample_saver.clear()
+    hmc.stats = None
+    nsampled = min(writer.nsamples * hmc.sample_saver.get_period(), nsample)
+    while nsampled < nsample:
+        nblock = min(block_size, nsample - nsampled)
+        hmc.optimize(nblock)
+        writer.add_hmc(hmc)
+        writer.flush()
+        nsampled += nblock
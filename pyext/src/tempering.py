@@ -0,0 +1,365 @@
+"""Replica exchange (parallel tempering) HMC.
+
+Replicas of the model are sampled with NUTS at a ladder of inverse
+temperatures `1 = beta_0 > beta_1 > ... > beta_min`, each in its own worker
+process (see `IMP.hmc.parallel.WorkerProxy`). Only the scoring function is
+tempered (see `IMP.hmc.log_density.TemperedLogDensity`), so in free space
+replica `i` samples `beta_i * logp(x) + log|J|`. Every `swap_interval`
+transitions, neighbouring replicas attempt to exchange positions, with the
+even and odd pairs alternating between rounds (Okabe et al., Chem Phys Lett
+2001). A swap only needs the position and the untempered log density of
+each replica, so little data passes between processes, and each replica
+keeps the metric and step size adapted at its own temperature.
+
+The ladder can be adapted during a burn-in so that the rejection rates of
+all neighbouring pairs are equal (Syed et al., "Non-reversible parallel
+tempering", JRSS B 2021). Only the samples of the cold replica, `beta = 1`,
+are saved.
+
+Replicas are accessed only through `call_async`/`get_result`, so other
+transports with the interface of `WorkerProxy` can be used, e.g. to place
+replicas on other hosts.
+"""
+
+import numpy as np
+
+from .parallel import WorkerProxy, get_chain_seeds, seed_all
+
+
+def get_geometric_ladder(nreplicas, beta_min=0.1):
+    """Get `nreplicas` inverse temperatures spaced geometrically from 1 to
+    `beta_min`."""
+    if nreplicas < 2:
+        return np.ones(max(nreplicas, 0))
+    return np.geomspace(1.0, beta_min, nreplicas)
+
+
+def get_swap_log_acceptance(beta_i, beta_j, logp_i, logp_j):
+    """Log probability of accepting the exchange of the positions of two
+    replicas with inverse temperatures `beta_i` and `beta_j` and untempered
+    log densities `logp_i` and `logp_j`."""
+    return min(0.0, (beta_i - beta_j) * (logp_j - logp_i))
+
+
+def adapt_ladder(betas, rejection_rates, eps=1e-6):
+    """Get a new ladder with the same end points over which the rejection
+    rates of swaps between neighbours are equal.
+
+    The cumulative rejection rate along the ladder, an estimate of the
+    communication barrier, is interpolated linearly in `log(beta)` and
+    inverted at equally spaced values."""
+    betas = np.asarray(betas, dtype=np.double)
+    rates = np.asarray(rejection_rates, dtype=np.double) + eps
+    barrier = np.concatenate([[0.0], np.cumsum(rates)])
+    targets = np.linspace(0.0, barrier[-1], len(betas))
+    new = np.exp(np.interp(targets, barrier, np.log(betas)))
+    new[0], new[-1] = betas[0], betas[-1]
+    return new
+
+
+class _Replica(object):
+
+    """Replica of the model sampled at one temperature in a worker
+    process."""
+
+    def __init__(self, sf_factory, seed, beta, kwargs):
+        from .defaults import setup_warmup_hmc
+
+        seed_all(seed)
+        self.hmc = setup_warmup_hmc(
+            sf_factory(), beta=beta, nadapt=0, log=lambda msg: None, **kwargs
+        )
+        self.tempered = self.hmc.hamiltonian.logpdf.logpdf
+
+    def warmup(self, nadapt, **kwargs):
+        from .adaptor import Adaptor
+
+        if self.hmc.hamiltonian.metric_type == "block":
+            kwargs["metric_blocks"] = self.hmc.opt_vars.get_blocks(
+                kwargs.get("metric_blocks")
+            )
+        if nadapt > 0:
+            Adaptor(
+                self.hmc, nadapt=nadapt, log=lambda msg: None, **kwargs
+            ).adapt(verbose=False)
+        self.hmc.stats = None
+        return float(self.hmc.step_size)
+
+    def get_state(self):
+        """Get the position in free space and the untempered log density."""
+        x = self.hmc.get_values().copy()
+        return (
+            self.hmc.transformation.free(x),
+            float(self.tempered.get_untempered_logpdf(x)),
+        )
+
+    def run(self, nsteps):
+        if not self.hmc.get_save_samples():
+            # statistics of hot replicas are not needed
+            self.hmc.stats = None
+        self.hmc.optimize(nsteps)
+        return self.get_state()
+
+    def set_position(self, position):
+        """Move the replica to a position in free space."""
+        self.hmc.set_values(self.hmc.transformation.constrain(position))
+        self.hmc.get_model().update()
+
+    def set_beta(self, beta):
+        self.tempered.set_beta(beta)
+
+    def set_save_samples(self, tf):
+        self.hmc.stats = None
+        self.hmc.sample_saver.clear()
+        self.hmc.set_save_samples(tf)
+
+    def get_results(self):
+        samples = self.hmc.sample_saver.get_values_numpy().copy()
+        stats = {k: np.array(v) for k, v in self.hmc.stats.get_samples().items()}
+        return self.hmc.get_sample_names(), samples, stats
+
+
+class ReplicaExchange(object):
+
+    """Replica exchange HMC over replicas in worker processes.
+
+    `replicas` are proxies with the interface of `WorkerProxy` for `_Replica`
+    objects, ordered from the cold replica to the hottest, at the inverse
+    temperatures `betas`. Use `from_factory` to start them. Swaps are
+    accepted with random numbers from a generator seeded with `seed`."""
+
+    def __init__(self, replicas, betas, seed=None, log=print):
+        if len(replicas) != len(betas):
+            raise ValueError("Need one inverse temperature per replica")
+        self.replicas = replicas
+        self.betas = np.array(betas, dtype=np.double)
+        self.log = log
+        self.rng = np.random.RandomState(seed)
+        self.nrounds = 0
+        self.roundtrips = 0
+        self._labels = list(range(len(replicas)))
+        self._directions = [None] * len(replicas)
+        self.reset_swap_statistics()
+
+    @classmethod
+    def from_factory(
+        cls,
+        sf_factory,
+        nreplicas=4,
+        betas=None,
+        beta_min=0.1,
+        seed=None,
+        log=print,
+        **kwargs
+    ):
+        """Start a replica in a worker process for each inverse temperature.
+
+        `sf_factory` is called without arguments in each worker and must
+        build the model and return its scoring function. `kwargs` are passed
+        to `IMP.hmc.defaults.setup_warmup_hmc`. If `betas` is not given, a
+        geometric ladder of `nreplicas` temperatures down to `beta_min` is
+        used."""
+        if betas is None:
+            betas = get_geometric_ladder(nreplicas, beta_min)
+        replicas = []
+        try:
+            for beta, s in zip(betas, get_chain_seeds(len(betas), seed)):
+                replicas.append(
+                    WorkerProxy(_Replica, (sf_factory, s, float(beta), kwargs))
+                )
+        except Exception:
+            for r in replicas:
+                r.close()
+            raise
+        return cls(replicas, betas, seed=seed, log=log)
+
+    def close(self):
+        for r in self.replicas:
+            r.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_number_of_replicas(self):
+        return len(self.replicas)
+
+    def reset_swap_statistics(self):
+        npairs = max(len(self.replicas) - 1, 0)
+        self.nattempts = np.zeros(npairs, dtype=int)
+        self.naccepts = np.zeros(npairs, dtype=int)
+        self._sum_accept_prob = np.zeros(npairs)
+
+    def get_swap_statistics(self):
+        """Get the inverse temperatures, and the number of attempts,
+        acceptances, the acceptance rate and mean acceptance probability of
+        swaps of each neighbouring pair, and the number of round trips of
+        replica states from the cold to the hottest replica and back."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return {
+                "betas": self.betas.copy(),
+                "nattempts": self.nattempts.copy(),
+                "naccepts": self.naccepts.copy(),
+                "acceptance_rate": self.naccepts / self.nattempts,
+                "mean_accept_prob": self._sum_accept_prob / self.nattempts,
+                "nrounds": self.nrounds,
+                "roundtrips": self.roundtrips,
+            }
+
+    def warmup(self, nadapt=1000, **kwargs):
+        """Adapt the step size and metric of every replica at its own
+        temperature. `kwargs` are passed to `IMP.hmc.adaptor.Adaptor`."""
+        self.log(
+            "Warming up {0} replicas for {1} steps.".format(
+                len(self.replicas), nadapt
+            )
+        )
+        for r in self.replicas:
+            r.call_async("warmup", nadapt, **kwargs)
+        step_sizes = [r.get_result() for r in self.replicas]
+        self.log("Step sizes:\n    {0}".format(np.array(step_sizes)))
+
+    def set_betas(self, betas):
+        self.betas = np.array(betas, dtype=np.double)
+        for r, beta in zip(self.replicas, self.betas):
+            r.call_async("set_beta", float(beta))
+        for r in self.replicas:
+            r.get_result()
+
+    def _update_roundtrips(self):
+        last = len(self._labels) - 1
+        for i, label in enumerate(self._labels):
+            if i == 0:
+                if self._directions[label] == "down":
+                    self.roundtrips += 1
+                self._directions[label] = "up"
+            elif i == last and self._directions[label] == "up":
+                self._directions[label] = "down"
+
+    def run_round(self, nsteps):
+        """Run every replica for `nsteps` transitions, then attempt to swap
+        the positions of the even or odd neighbouring pairs."""
+        for r in self.replicas:
+            r.call_async("run", nsteps)
+        states = [r.get_result() for r in self.replicas]
+
+        moved = {}
+        for i in range(self.nrounds % 2, len(self.replicas) - 1, 2):
+            j = i + 1
+            log_accept = get_swap_log_acceptance(
+                self.betas[i], self.betas[j], states[i][1], states[j][1]
+            )
+            self.nattempts[i] += 1
+            self._sum_accept_prob[i] += np.exp(log_accept)
+            if np.log(self.rng.uniform()) < log_accept:
+                self.naccepts[i] += 1
+                states[i], states[j] = states[j], states[i]
+                moved[i], moved[j] = states[i][0], states[j][0]
+                self._labels[i], self._labels[j] = (
+                    self._labels[j],
+                    self._labels[i],
+                )
+        for i, position in moved.items():
+            self.replicas[i].call_async("set_position", position)
+        for i in moved:
+            self.replicas[i].get_result()
+
+        self.nrounds += 1
+        self._update_roundtrips()
+        return states
+
+    def tune_ladder(self, nrounds, swap_interval=10, update_every=20):
+        """Run `nrounds` rounds as a burn-in, adapting the ladder every
+        `update_every` rounds from the rejection rates since the last
+        update (see `adapt_ladder`)."""
+        if len(self.replicas) < 3:
+            return
+        self.reset_swap_statistics()
+        for n in range(nrounds):
+            self.run_round(swap_interval)
+            if (n + 1) % update_every == 0:
+                rejection = 1 - self._sum_accept_prob / np.maximum(
+                    self.nattempts, 1
+                )
+                self.set_betas(adapt_ladder(self.betas, rejection))
+                self.reset_swap_statistics()
+                self.log(
+                    "Ladder round {0}/{1}: betas {2}".format(
+                        n + 1, nrounds, self.betas
+                    )
+                )
+        self.reset_swap_statistics()
+
+    def sample(self, nsample, swap_interval=10):
+        """Sample the cold replica for `nsample` transitions, attempting
+        swaps every `swap_interval` transitions. Returns the variable names,
+        samples and statistics of the cold replica."""
+        self.replicas[0].call("set_save_samples", True)
+        self.reset_swap_statistics()
+        nsampled = 0
+        while nsampled < nsample:
+            nsteps = min(swap_interval, nsample - nsampled)
+            self.run_round(nsteps)
+            nsampled += nsteps
+        stats = self.get_swap_statistics()
+        self.log(
+            "Swap acceptance rates:\n    {0}".format(stats["acceptance_rate"])
+        )
+        self.log("{0} round trips".format(stats["roundtrips"]))
+        return self.replicas[0].call("get_results")
+
+
+def run_replica_exchange(
+    sf_factory,
+    nreplicas=4,
+    betas=None,
+    beta_min=0.1,
+    nadapt=1000,
+    nsample=1000,
+    swap_interval=10,
+    ladder_rounds=0,
+    ladder_update_every=20,
+    seed=None,
+    varnames=None,
+    log=print,
+    adapt_kwargs=None,
+    **kwargs
+):
+    """Warm up and run replica exchange HMC, and return an ArviZ
+    `InferenceData` of the cold replica and the swap statistics.
+
+    Every replica is first warmed up for `nadapt` steps at its own
+    temperature, then, if `ladder_rounds` is nonzero, the ladder is adapted
+    for that many rounds of `swap_interval` transitions before sampling.
+    `adapt_kwargs` are passed to `IMP.hmc.adaptor.Adaptor` and `kwargs` to
+    `IMP.hmc.defaults.setup_warmup_hmc`. See `ReplicaExchange`."""
+    from .diagnostics import get_inference_data_from_chains
+
+    if adapt_kwargs is None:
+        adapt_kwargs = {}
+    with ReplicaExchange.from_factory(
+        sf_factory,
+        nreplicas=nreplicas,
+        betas=betas,
+        beta_min=beta_min,
+        seed=seed,
+        log=log,
+        **kwargs
+    ) as rex:
+        rex.warmup(nadapt, **adapt_kwargs)
+        if ladder_rounds > 0:
+            rex.tune_ladder(
+                ladder_rounds,
+                swap_interval=swap_interval,
+                update_every=ladder_update_every,
+            )
+        names, samples, stats = rex.sample(nsample, swap_interval=swap_interval)
+        swap_stats = rex.get_swap_statistics()
+    if varnames is None:
+        varnames = names
+    return (
+        get_inference_data_from_chains([(samples, stats)], varnames=varnames),
+        swap_stats,
+    )
@@ -0,0 +1,502 @@
+"""Transformations of constrained variables to an unconstrained space.
+
+Each constraint maps a vector `y` in the free (unconstrained) space in
+which HMC samples to a vector `x` satisfying the constraint, and contributes
+the log of the absolute determinant of the Jacobian of that map (the
+"log-Jacobian") to the log density.
+
+The constraints mirror those of HMCUtilities.jl, and `to_julia` converts
+them to their HMCUtilities equivalents. `JointConstraint` groups its
+constraints by type, so that transforming all variables takes one batched
+NumPy operation per type instead of one call per variable.
+"""
+
+import numpy as np
+
+
+def _log_logistic(y):
+    return -np.logaddexp(0.0, -y)
+
+
+class VariableConstraint(object):
+
+    """Base class for a constraint on a vector of variables."""
+
+    def free_dimension(self):
+        """Get the dimension of the free space."""
+        raise NotImplementedError
+
+    def dimension(self):
+        """Get the dimension of the constrained space."""
+        raise NotImplementedError
+
+    def to_julia(self):
+        """Get the equivalent `HMCUtilities.VariableConstraint`."""
+        raise NotImplementedError
+
+    def _get_group_key(self):
+        return type(self)
+
+    def constrain(self, y):
+        return JointConstraint(self).constrain(y)
+
+    def free(self, x):
+        return JointConstraint(self).free(x)
+
+
+class IdentityConstraint(VariableConstraint):
+
+    """Unconstrained variables."""
+
+    def __init__(self, n):
+        self.n = n
+
+    def free_dimension(self):
+        return self.n
+
+    def dimension(self):
+        return self.n
+
+    def to_julia(self):
+        from .julia import HMCUtilities
+
+        return HMCUtilities.IdentityConstraint(self.n)
+
+
+class LowerBoundedConstraint(VariableConstraint):
+
+    """Scalar bounded from below, transformed with `x = lb + exp(y)`."""
+
+    def __init__(self, lb):
+        self.lb = lb
+
+    def free_dimension(self):
+        return 1
+
+    def dimension(self):
+        return 1
+
+    def to_julia(self):
+        from .julia import HMCUtilities
+
+        return HMCUtilities.LowerBoundedConstraint(self.lb)
+
+
+class UpperBoundedConstraint(VariableConstraint):
+
+    """Scalar bounded from above, transformed with `x = ub - exp(y)`."""
+
+    def __init__(self, ub):
+        self.ub = ub
+
+    def free_dimension(self):
+        return 1
+
+    def dimension(self):
+        return 1
+
+    def to_julia(self):
+        from .julia import HMCUtilities
+
+        return HMCUtilities.UpperBoundedConstraint(self.ub)
+
+
+class BoundedConstraint(VariableConstraint):
+
+    """Scalar in an interval, transformed with a scaled logistic function."""
+
+    def __init__(self, lb, ub):
+        if not lb < ub:
+            raise ValueError("Lower bound must be less than upper bound.")
+        self.lb = lb
+        self.ub = ub
+
+    def free_dimension(self):
+        return 1
+
+    def dimension(self):
+        return 1
+
+    def to_julia(self):
+        from .julia import HMCUtilities
+
+        return HMCUtilities.BoundedConstraint(self.lb, self.ub)
+
+
+def make_interval_constraint(lb, ub):
+    """Make the constraint for a scalar in the interval `[lb, ub]`.
+
+    Either bound may be infinite. This is the equivalent of
+    `HMCUtilities.TransformConstraint`."""
+    if np.isinf(lb) and np.isinf(ub):
+        return IdentityConstraint(1)
+    elif np.isinf(ub):
+        return LowerBoundedConstraint(lb)
+    elif np.isinf(lb):
+        return UpperBoundedConstraint(ub)
+    else:
+        return BoundedConstraint(lb, ub)
+
+
+class UnitVectorConstraint(VariableConstraint):
+
+    """Vector of unit norm, e.g. a direction or a quaternion.
+
+    The free vector `y` is normalized, and the log-Jacobian is
+    `-|y|^2 / (2 scale^2)`, which gives the norm of `y` a proper
+    distribution. `scale` sets the typical norm of `y`, so a step of a given
+    size in the free space rotates `x` by a smaller angle for larger
+    `scale`."""
+
+    def __init__(self, n, scale=1.0):
+        self.n = n
+        self.scale = scale
+
+    def free_dimension(self):
+        return self.n
+
+    def dimension(self):
+        return self.n
+
+    def to_julia(self):
+        from .julia import HMCUtilities
+
+        if self.scale == 1:
+            return HMCUtilities.UnitVectorConstraint(self.n)
+        return HMCUtilities.UnitVectorScaledConstraint(self.n, self.scale)
+
+    def _get_group_key(self):
+        return (type(self), self.n)
+
+
+class UnitSimplexConstraint(VariableConstraint):
+
+    """Non-negative vector summing to one, using Stan's stick-breaking
+    transform from a free space of one dimension less."""
+
+    def __init__(self, n):
+        self.n = n
+
+    def free_dimension(self):
+        return self.n - 1
+
+    def dimension(self):
+        return self.n
+
+    def to_julia(self):
+        from .julia import HMCUtilities
+
+        return HMCUtilities.UnitSimplexConstraint(self.n)
+
+    def _get_group_key(self):
+        return (type(self), self.n)
+
+
+class _ConstraintGroup(object):
+
+    """Batched transformation of all constraints of the same type.
+
+    `yidx` and `xidx` index the free and constrained variables of the group
+    in the joint vectors. All methods write into preallocated output
+    vectors."""
+
+    def __init__(self, constraints, yoffsets, xoffsets):
+        self.yidx = np.array(
+            [
+                np.arange(o, o + c.free_dimension())
+                for c, o in zip(constraints, yoffsets)
+            ],
+            dtype=np.intp,
+        )
+        self.xidx = np.array(
+            [
+                np.arange(o, o + c.dimension())
+                for c, o in zip(constraints, xoffsets)
+            ],
+            dtype=np.intp,
+        )
+
+    def constrain(self, y, x):
+        """Write the constrained values into `x` and return the
+        log-Jacobian."""
+        raise NotImplementedError
+
+    def free(self, x, y):
+        raise NotImplementedError
+
+    def pullback(self, y, x, gx, gy):
+        """Write into `gy` the gradient with respect to `y` of the log
+        density plus log-Jacobian, given the gradient `gx` of the log
+        density with respect to `x`."""
+        raise NotImplementedError
+
+
+class _IdentityGroup(_ConstraintGroup):
+    def __init__(self, constraints, yoffsets, xoffsets):
+        self.yidx = np.concatenate(
+            [
+                np.arange(o, o + c.n, dtype=np.intp)
+                for c, o in zip(constraints, yoffsets)
+            ]
+        )
+        self.xidx = np.concatenate(
+            [
+                np.arange(o, o + c.n, dtype=np.intp)
+                for c, o in zip(constraints, xoffsets)
+            ]
+        )
+
+    def constrain(self, y, x):
+        x[self.xidx] = y[self.yidx]
+        return 0.0
+
+    def free(self, x, y):
+        y[self.yidx] = x[self.xidx]
+
+    def pullback(self, y, x, gx, gy):
+        gy[self.yidx] = gx[self.xidx]
+
+
+class _LowerBoundedGroup(_ConstraintGroup):
+    def __init__(self, constraints, yoffsets, xoffsets):
+        super().__init__(constraints, yoffsets, xoffsets)
+        self.yidx = self.yidx[:, 0]
+        self.xidx = self.xidx[:, 0]
+        self.lb = np.array([c.lb for c in constraints], dtype=np.double)
+
+    def constrain(self, y, x):
+        yi = y[self.yidx]
+        x[self.xidx] = self.lb + np.exp(yi)
+        return yi.sum()
+
+    def free(self, x, y):
+        y[self.yidx] = np.log(x[self.xidx] - self.lb)
+
+    def pullback(self, y, x, gx, gy):
+        gy[self.yidx] = gx[self.xidx] * (x[self.xidx] - self.lb) + 1.0
+
+
+class _UpperBoundedGroup(_LowerBoundedGroup):
+    def __init__(self, constraints, yoffsets, xoffsets):
+        _ConstraintGroup.__init__(self, constraints, yoffsets, xoffsets)
+        self.yidx = self.yidx[:, 0]
+        self.xidx = self.xidx[:, 0]
+        self.ub = np.array([c.ub for c in constraints], dtype=np.double)
+
+    def constrain(self, y, x):
+        yi = y[self.yidx]
+        x[self.xidx] = self.ub - np.exp(yi)
+        return yi.sum()
+
+    def free(self, x, y):
+        y[self.yidx] = np.log(self.ub - x[self.xidx])
+
+    def pullback(self, y, x, gx, gy):
+        gy[self.yidx] = gx[self.xidx] * (x[self.xidx] - self.ub) + 1.0
+
+
+class _BoundedGroup(_ConstraintGroup):
+    def __init__(self, constraints, yoffsets, xoffsets):
+        super().__init__(constraints, yoffsets, xoffsets)
+        self.yidx = self.yidx[:, 0]
+        self.xidx = self.xidx[:, 0]
+        self.lb = np.array([c.lb for c in constraints], dtype=np.double)
+        self.ub = np.array([c.ub for c in constraints], dtype=np.double)
+        self.width = self.ub - self.lb
+        self.log_width = np.log(self.width).sum()
+
+    def constrain(self, y, x):
+        yi = y[self.yidx]
+        log_s = _log_logistic(yi)
+        log_1ms = _log_logistic(-yi)
+        x[self.xidx] = self.lb + self.width * np.exp(log_s)
+        return self.log_width + log_s.sum() + log_1ms.sum()
+
+    def free(self, x, y):
+        xi = x[self.xidx]
+        y[self.yidx] = np.log(xi - self.lb) - np.log(self.ub - xi)
+
+    def pullback(self, y, x, gx, gy):
+        s = np.exp(_log_logistic(y[self.yidx]))
+        gy[self.yidx] = gx[self.xidx] * self.width * s * (1 - s) + 1 - 2 * s
+
+
+class _UnitVectorGroup(_ConstraintGroup):
+    def __init__(self, constraints, yoffsets, xoffsets):
+        super().__init__(constraints, yoffsets, xoffsets)
+        scale = np.array([c.scale for c in constraints], dtype=np.double)
+        self.inv_scale2 = (1 / scale ** 2)[:, np.newaxis]
+        self.scale = scale[:, np.newaxis]
+
+    def constrain(self, y, x):
+        yi = y[self.yidx]
+        r2 = np.einsum("ij,ij->i", yi, yi)[:, np.newaxis]
+        x[self.xidx] = yi / np.sqrt(r2)
+        return -0.5 * (r2 * self.inv_scale2).sum()
+
+    def free(self, x, y):
+        xi = x[self.xidx]
+        norm = np.sqrt(np.einsum("ij,ij->i", xi, xi))[:, np.newaxis]
+        y[self.yidx] = xi / norm * self.scale
+
+    def pullback(self, y, x, gx, gy):
+        yi = y[self.yidx]
+        xi = x[self.xidx]
+        gxi = gx[self.xidx]
+        r = np.sqrt(np.einsum("ij,ij->i", yi, yi))[:, np.newaxis]
+        proj = np.einsum("ij,ij->i", xi, gxi)[:, np.newaxis]
+        gy[self.yidx] = (gxi - xi * proj) / r - yi * self.inv_scale2
+
+
+class _UnitSimplexGroup(_ConstraintGroup):
+    def __init__(self, constraints, yoffsets, xoffsets):
+        super().__init__(constraints, yoffsets, xoffsets)
+        m = self.yidx.shape[1]
+        self.offsets = np.log(np.arange(m, 0, -1, dtype=np.double))
+
+    def _get_stick(self, y):
+        """Get the fraction broken off and the length of the remaining
+        stick before each break."""
+        z = np.exp(_log_logistic(y[self.yidx] - self.offsets))
+        rem = np.empty_like(z)
+        rem[:, 0] = 1.0
+        np.cumprod(1 - z[:, :-1], axis=1, out=rem[:, 1:])
+        return z, rem
+
+    def constrain(self, y, x):
+        z, rem = self._get_stick(y)
+        xi = np.empty(self.xidx.shape, dtype=np.double)
+        xi[:, :-1] = rem * z
+        xi[:, -1] = rem[:, -1] * (1 - z[:, -1])
+        x[self.xidx] = xi
+        return (np.log(z) + np.log1p(-z) + np.log(rem)).sum()
+
+    def free(self, x, y):
+        xi = x[self.xidx]
+        rem = 1 - np.cumsum(xi[:, :-1], axis=1)
+        rem = np.concatenate([np.ones((len(xi), 1)), rem[:, :-1]], axis=1)
+        z = xi[:, :-1] / rem
+        y[self.yidx] = np.log(z) - np.log1p(-z) + self.offsets
+
+    def pullback(self, y, x, gx, gy):
+        z, rem = self._get_stick(y)
+        gxi = gx[self.xidx]
+        gyi = np.empty(self.yidx.shape, dtype=np.double)
+        # reverse pass over the breaks; `adj` is the adjoint of the length
+        # of the stick remaining after the current break
+        adj = gxi[:, -1].copy()
+        for k in range(self.yidx.shape[1] - 1, -1, -1):
+            zk, remk = z[:, k], rem[:, k]
+            gyi[:, k] = remk * zk * (1 - zk) * (gxi[:, k] - adj) + 1 - 2 * zk
+            adj *= 1 - zk
+            adj += gxi[:, k] * zk + 1 / remk
+        gy[self.yidx] = gyi
+
+
+_group_types = {
+    IdentityConstraint: _IdentityGroup,
+    LowerBoundedConstraint: _LowerBoundedGroup,
+    UpperBoundedConstraint: _UpperBoundedGroup,
+    BoundedConstraint: _BoundedGroup,
+    UnitVectorConstraint: _UnitVectorGroup,
+    UnitSimplexConstraint: _UnitSimplexGroup,
+}
+
+
+class JointConstraint(VariableConstraint):
+
+    """Concatenation of constraints on consecutive blocks of variables.
+
+    Nested joint constraints are flattened."""
+
+    def __init__(self, *constraints):
+        self.constraints = []
+        for c in constraints:
+            if isinstance(c, JointConstraint):
+                self.constraints.extend(c.constraints)
+            else:
+                self.constraints.append(c)
+        self._free_dimension = sum(
+            c.free_dimension() for c in self.constraints
+        )
+        self._dimension = sum(c.dimension() for c in self.constraints)
+        self._groups = None
+
+    def free_dimension(self):
+        return self._free_dimension
+
+    def dimension(self):
+        return self._dimension
+
+    def to_julia(self):
+        from .julia import HMCUtilities
+
+        return HMCUtilities.JointConstraint(
+            *[c.to_julia() for c in self.constraints]
+        )
+
+    def get_groups(self):
+        """Get the batched transformations of each constraint type."""
+        if self._groups is None:
+            grouped = {}
+            yoffset = xoffset = 0
+            for c in self.constraints:
+                key = c._get_group_key()
+                if key not in grouped:
+                    grouped[key] = ([], [], [])
+                cs, ys, xs = grouped[key]
+                cs.append(c)
+                ys.append(yoffset)
+                xs.append(xoffset)
+                yoffset += c.free_dimension()
+                xoffset += c.dimension()
+            self._groups = [
+                _group_types[type(cs[0])](cs, ys, xs)
+                for cs, ys, xs in grouped.values()
+            ]
+        return self._groups
+
+    def constrain(self, y):
+        return self.constrain_with_logjac(y)[0]
+
+    def constrain_with_logjac(self, y):
+        """Get the constrained vector and the log-Jacobian at `y`."""
+        y = np.asarray(y, dtype=np.double)
+        x = np.empty(self._dimension, dtype=np.double)
+        logjac = 0.0
+        for g in self.get_groups():
+            logjac += g.constrain(y, x)
+        return x, logjac
+
+    def free(self, x):
+        x = np.asarray(x, dtype=np.double)
+        y = np.empty(self._free_dimension, dtype=np.double)
+        for g in self.get_groups():
+            g.free(x, y)
+        return y
+
+    def constrain_with_pushlogpdf(self, y):
+        """Constrain `y` and get a function that maps the log density at the
+        constrained vector to the log density in the free space."""
+        x, logjac = self.constrain_with_logjac(y)
+
+        def pushlogpdf(logpdf_x):
+            return logpdf_x + logjac
+
+        return x, pushlogpdf
+
+    def constrain_with_pushlogpdf_grad(self, y):
+        """Constrain `y` and get a function that maps the log density and
+        its gradient at the constrained vector to the log density and its
+        gradient in the free space."""
+        y = np.asarray(y, dtype=np.double)
+        x, logjac = self.constrain_with_logjac(y)
+        groups = self.get_groups()
+
+        def pushlogpdf_grad(logpdf_x, gradx_logpdf_x):
+            gy = np.empty(self._free_dimension, dtype=np.double)
+            for g in groups:
+                g.pullback(y, x, gradx_logpdf_x, gy)
+            return logpdf_x + logjac, gy
+
+        return x, pushlogpdf_grad
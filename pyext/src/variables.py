@@ -1,10 +1,31 @@
+import copy
+
 import numpy as np
 
 import IMP.isd
 import IMP.core
 import IMP.hmc
 
-from .julia import HMCUtilities
+from . import transforms
+
+
+def _get_optimized_particle_indexes(m, fks, pis, require_all=False):
+    """Get the particles in `pis` on which any (or all, if `require_all`) of
+    the float keys `fks` are optimized, in the order of `pis`."""
+    found = [
+        set(IMP.hmc.get_optimized_particle_indexes(m, fk, pis)) for fk in fks
+    ]
+    if require_all:
+        found = set.intersection(*found)
+    else:
+        found = set.union(*found)
+    return [pi for pi in pis if pi in found]
+
+
+def _as_particle_indexes(particles):
+    return [
+        p.get_index() if isinstance(p, IMP.Particle) else p for p in particles
+    ]
 
 
 class TransformationBuilder(object):
@@ -13,21 +34,68 @@ class TransformationBuilder(object):
     Check if variables are set up and create the necessary transformations.
     """
 
+    def get_candidates(self, m, pis):
+        """Get the particles in `pis` to which the transformation may apply.
+
+        This is a cheap pre-filter applied before `build`, which is only
+        called on the returned particles. By default all particles are
+        candidates."""
+        return pis
+
+    def prepare(self, m, pis):
+        """Precompute anything needed by `build` for the particles `pis` in
+        one batch. Called with the candidates before `build`."""
+        pass
+
+    def get_outdated(self, m, pis):
+        """Get the particles in `pis` whose transformation was built but is
+        no longer valid and must be rebuilt."""
+        return []
+
     def build(self, m, pi):
         """Build the transformation.
 
         If the transformation applies, return a list of
         `(FloatKey, ParticleIndex)` tuples for optimized attributes to which
-        the transformation is applied, and an `HMCUtilities.VariableConstraint`
+        the transformation is applied, and a `transforms.VariableConstraint`
         transformation object.
         """
         raise NotImplementedError
 
+    def get_free_scales(self, m, pi, kp_pairs, constraint):
+        """Get the typical scale of each free variable of the transformation
+        built for `pi`, with NaN where it is unknown. Used to seed the
+        metric (see `IMP.hmc.curvature`)."""
+        return np.full(constraint.free_dimension(), np.nan)
+
+    def copy(self):
+        """Get a copy of the builder that shares no cached state with it.
+
+        `OptimizedVariables` builds with its own copies of
+        `transform_builders`, made afresh on each full update."""
+        return copy.copy(self)
+
 
 class UnconstrainedTransformationBuilder(TransformationBuilder):
     def __init__(self, fks):
         self.fks = fks
 
+    def get_free_scales(self, m, pi, kp_pairs, constraint):
+        # a particle with a radius is unlikely to move much further than its
+        # size without clashing
+        scales = np.full(constraint.free_dimension(), np.nan)
+        if IMP.core.XYZR.get_is_setup(m, pi):
+            r = IMP.core.XYZR(m, pi).get_radius()
+            xyz_keys = IMP.core.XYZ.get_xyz_keys()
+            if r > 0:
+                for i, (fk, _) in enumerate(kp_pairs):
+                    if fk in xyz_keys:
+                        scales[i] = r
+        return scales
+
+    def get_candidates(self, m, pis):
+        return _get_optimized_particle_indexes(m, self.fks, pis)
+
     def build(self, m, pi):
         p = m.get_particle(pi)
         kp_pairs = []
@@ -36,7 +104,7 @@ class UnconstrainedTransformationBuilder(TransformationBuilder):
                 kp_pairs.append((fk, pi))
         n = len(kp_pairs)
         if n > 0:
-            return kp_pairs, HMCUtilities.IdentityConstraint(n)
+            return kp_pairs, transforms.IdentityConstraint(n)
         else:
             return
 
@@ -45,6 +113,11 @@ class UnitVectorTransformationBuilder(TransformationBuilder):
     def __init__(self, fks):
         self.fks = fks
 
+    def get_candidates(self, m, pis):
+        return _get_optimized_particle_indexes(
+            m, self.fks, pis, require_all=True
+        )
+
     def build(self, m, pi):
         p = m.get_particle(pi)
         kp_pairs = []
@@ -53,28 +126,119 @@ class UnitVectorTransformationBuilder(TransformationBuilder):
                 return
             kp_pairs.append((fk, pi))
         n = len(kp_pairs)
-        return kp_pairs, HMCUtilities.UnitVectorConstraint(n)
+        return kp_pairs, transforms.UnitVectorConstraint(n)
+
+    def get_free_scales(self, m, pi, kp_pairs, constraint):
+        # the norm of the free vector has a known distribution of this scale
+        return np.full(constraint.free_dimension(), constraint.scale)
 
 
 class UnitVectorScaledTransformationBuilder(TransformationBuilder):
+
+    """Transformation of a rigid body quaternion to a scaled unit vector.
+
+    The scale of each rigid body is computed from the coordinates of its
+    members, including the members of nested rigid bodies. Scales are
+    computed for all rigid bodies at once in `prepare` and cached until the
+    members of the rigid body change. The cache is for a single model, so
+    each `OptimizedVariables` uses its own copy of the builder."""
+
+    _rigid_body_keys = (
+        IMP.FloatKey("rigid_body_quaternion_0"),
+        IMP.FloatKey("rigid_body_local_quaternion_0"),
+    )
+
     def __init__(self, fks):
         self.fks = fks
+        self.is_rigid_body = fks[0] in self._rigid_body_keys
+        self._scalings = {}
+
+    def copy(self):
+        other = super().copy()
+        other._scalings = {}
+        return other
+
+    def get_candidates(self, m, pis):
+        return _get_optimized_particle_indexes(
+            m, self.fks, pis, require_all=True
+        )
+
+    @staticmethod
+    def get_leaf_member_indexes(m, pi):
+        """Get the members of a rigid body, replacing nested rigid bodies
+        with their members."""
+        rb = IMP.core.RigidBody(m, pi)
+        leaves = list(rb.get_member_particle_indexes())
+        for mpi in rb.get_body_member_particle_indexes():
+            leaves.extend(
+                UnitVectorScaledTransformationBuilder.get_leaf_member_indexes(
+                    m, mpi
+                )
+            )
+        return leaves
+
+    @staticmethod
+    def _get_coordinates(m, pis):
+        try:
+            spheres = m.get_spheres_numpy()
+        except (AttributeError, NotImplementedError):
+            return np.array(
+                [IMP.core.XYZ(m, pi).get_coordinates() for pi in pis],
+                dtype=np.double,
+            ).reshape(-1, 3)
+        return spheres[[pi.get_index() for pi in pis], :3]
+
+    def get_outdated(self, m, pis):
+        if not self.is_rigid_body:
+            return []
+        outdated = []
+        for pi in pis:
+            cached = self._scalings.get(pi)
+            leaves = self.get_leaf_member_indexes(m, pi)
+            if cached is None or cached[0] != tuple(leaves):
+                outdated.append(pi)
+        return outdated
+
+    def prepare(self, m, pis):
+        if not self.is_rigid_body:
+            return
+        rbs = []
+        leaves = []
+        for pi in pis:
+            rb_leaves = self.get_leaf_member_indexes(m, pi)
+            signature = tuple(rb_leaves)
+            cached = self._scalings.get(pi)
+            if cached is not None and cached[0] == signature:
+                continue
+            rbs.append((pi, signature))
+            leaves.append(rb_leaves)
+        if not rbs:
+            return
+
+        counts = np.array([len(l) for l in leaves], dtype=np.intp)
+        segments = np.repeat(np.arange(len(rbs)), counts)
+        centers = self._get_coordinates(m, [pi for pi, _ in rbs])
+        vs = self._get_coordinates(m, [pi for l in leaves for pi in l])
+        vs = vs - centers[segments]
+        # standard deviation of all member coordinate components about the
+        # center, per rigid body
+        n = 3 * np.maximum(counts, 1)
+        mean = np.bincount(segments, vs.sum(axis=1), len(rbs)) / n
+        mean2 = np.bincount(segments, (vs ** 2).sum(axis=1), len(rbs)) / n
+        sigma = np.sqrt(np.maximum(mean2 - mean ** 2, 0))
+        # upper bound on the scaling from pulling back the Euclidean metric
+        # on the rigid body members to the quaternion of the rigid body
+        # metric is equivalent to 4G, where G is the moment of inertia tensor
+        # bound corresponds to worst-case scenario of co-linear members
+        # fall back to no scaling for rigid bodies without extent
+        scalings = np.where(sigma > 0, 2 * sigma, 1.0)
+        for (pi, signature), r in zip(rbs, scalings):
+            self._scalings[pi] = (signature, r)
 
     def compute_scaling(self, m, pi):
-        if self.fks[0] in (
-            IMP.FloatKey("rigid_body_quaternion_0"),
-            IMP.FloatKey("rigid_body_local_quaternion_0")
-        ): # rigid body
-            rb = IMP.core.RigidBody(m, pi)
-            center = rb.get_coordinates()
-            vs = np.array([list(IMP.core.XYZ(p).get_coordinates() - center) for p in rb.get_rigid_members()])
-            sigma = np.std(vs, ddof = 0)
-            # upper bound on the scaling from pulling back the Euclidean metric on the rigid body members
-            # to the quaternion of the rigid body
-            # metric is equivalent to 4G, where G is the moment of inertia tensor
-            # bound corresponds to worst-case scenario of co-linear members
-            # TODO: recurse through nested rigid bodies
-            r = 2 * sigma
+        if self.is_rigid_body:
+            self.prepare(m, [pi])
+            r = self._scalings[pi][1]
         else: # fallback
             r = 1.0
         return r
@@ -88,7 +252,10 @@ class UnitVectorScaledTransformationBuilder(TransformationBuilder):
             kp_pairs.append((fk, pi))
         n = len(kp_pairs)
         r = self.compute_scaling(m, pi)
-        return kp_pairs, HMCUtilities.UnitVectorScaledConstraint(n, r)
+        return kp_pairs, transforms.UnitVectorConstraint(n, scale=r)
+
+    def get_free_scales(self, m, pi, kp_pairs, constraint):
+        return np.full(constraint.free_dimension(), constraint.scale)
 
 
 class WeightTransformationBuilder(TransformationBuilder):
@@ -100,19 +267,29 @@ class WeightTransformationBuilder(TransformationBuilder):
             return
         kp_pairs = [(fk, pi) for fk in w.get_weight_keys()]
         n = len(kp_pairs)
-        return kp_pairs, HMCUtilities.UnitSimplexConstraint(n)
+        return kp_pairs, transforms.UnitSimplexConstraint(n)
 
 
 class RadiusTransformationBuilder(TransformationBuilder):
+    def get_candidates(self, m, pis):
+        return IMP.hmc.get_optimized_particle_indexes(
+            m, IMP.core.XYZR.get_radius_key(), pis
+        )
+
     def build(self, m, pi):
         p = m.get_particle(pi)
         fk = IMP.core.XYZR.get_radius_key()
         if not (m.get_has_attribute(fk, pi) and p.get_is_optimized(fk)):
             return
-        return [(fk, pi)], HMCUtilities.LowerBoundedConstraint(0.0)
+        return [(fk, pi)], transforms.LowerBoundedConstraint(0.0)
 
 
 class NuisanceTransformationBuilder(TransformationBuilder):
+    def get_candidates(self, m, pis):
+        return IMP.hmc.get_optimized_particle_indexes(
+            m, IMP.isd.Nuisance.get_nuisance_key(), pis
+        )
+
     def build(self, m, pi):
         p = m.get_particle(pi)
         fk = IMP.isd.Nuisance.get_nuisance_key()
@@ -121,7 +298,9 @@ class NuisanceTransformationBuilder(TransformationBuilder):
         n = IMP.isd.Nuisance(m, pi)
         return (
             [(fk, pi)],
-            HMCUtilities.TransformConstraint(n.get_lower(), n.get_upper()),
+            transforms.make_interval_constraint(
+                n.get_lower(), n.get_upper()
+            ),
         )
 
 
@@ -135,6 +314,11 @@ class BoundingBoxTransformationBuilder(TransformationBuilder):
         self.bbox = bbox
         self.fks = fks
 
+    def get_candidates(self, m, pis):
+        return _get_optimized_particle_indexes(
+            m, self.fks, pis, require_all=True
+        )
+
     def build(self, m, pi):
         lb = self.bbox.get_corner(0)
         ub = self.bbox.get_corner(1)
@@ -144,10 +328,10 @@ class BoundingBoxTransformationBuilder(TransformationBuilder):
         for i, fk in enumerate(self.fks):
             if not (m.get_has_attribute(fk, pi) and p.get_is_optimized(fk)):
                 return
-            c = HMCUtilities.BoundedConstraint(lb[i], ub[i])
+            c = transforms.BoundedConstraint(lb[i], ub[i])
             constraints.append(c)
             kp_pairs.append((fk, pi))
-        joint_constraint = HMCUtilities.JointConstraint(*constraints)
+        joint_constraint = transforms.JointConstraint(*constraints)
         return kp_pairs, joint_constraint
 
 
@@ -190,30 +374,96 @@ class OptimizedVariables(object):
         self.optimized_key_index_pairs = []
         self.joint_constraint = None
         self.interface = None
+        # copies of the transformation builders and, for each, the result of
+        # `build` for each particle to which it applies, in the order in
+        # which they were added
+        self._builders = []
+        self._built = []
+        self._pis = set()
         self.update_variables()
 
-    def update_variables(self):
-        self.optimized_key_index_pairs.clear()
-        constraints = []
-        pis = self.m.get_particle_indexes()
-        for tb in self.transform_builders:
-            for pi in pis:
+    def _build_particles(self, pis):
+        for tb, built in zip(self._builders, self._built):
+            candidates = tb.get_candidates(self.m, pis)
+            tb.prepare(self.m, candidates)
+            for pi in candidates:
                 result = tb.build(self.m, pi)
-                if result is None:
-                    continue
-                kp_pairs, c = result
+                if result is not None:
+                    built[pi] = result
+        self._pis.update(pis)
+
+    def _assemble(self):
+        self.optimized_key_index_pairs = []
+        self._constraint_particles = []
+        constraints = []
+        for built in self._built:
+            for pi, (kp_pairs, c) in built.items():
                 self.optimized_key_index_pairs.extend(kp_pairs)
+                self._constraint_particles.append((pi, c.free_dimension()))
                 constraints.append(c)
 
-        self.joint_constraint = HMCUtilities.JointConstraint(*constraints)
+        self.joint_constraint = transforms.JointConstraint(*constraints)
         self.interface = IMP.hmc.ValueGradientInterface(
             self.m, *list(zip(*self.optimized_key_index_pairs))[:2]
         )
 
+    def add_particles(self, pis):
+        """Add the optimized variables of the given particles or particle
+        indexes.
+
+        Transformations already built for other particles are reused.
+        Particles that were already added are ignored."""
+        pis = [pi for pi in _as_particle_indexes(pis) if pi not in self._pis]
+        self._build_particles(pis)
+        self._assemble()
+
+    def remove_particles(self, pis):
+        """Remove the optimized variables of the given particles."""
+        pis = set(_as_particle_indexes(pis))
+        for built in self._built:
+            for pi in pis.intersection(built):
+                del built[pi]
+        self._pis.difference_update(pis)
+        self._assemble()
+
+    def update_variables(self, incremental=False):
+        """Find the optimized variables in the model.
+
+        If `incremental` is True, only particles that were added to or
+        removed from the model since the last update are processed, along
+        with outdated transformations, such as those of rigid bodies whose
+        members changed. Changes to which attributes are optimized on
+        existing particles are then not detected."""
+        pis = self.m.get_particle_indexes()
+        if not incremental:
+            # start with fresh builders, discarding their cached state
+            self._builders = [tb.copy() for tb in self.transform_builders]
+            self._built = [{} for _ in self._builders]
+            self._pis.clear()
+            self._build_particles(pis)
+        else:
+            current = set(pis)
+            removed = self._pis - current
+            for built in self._built:
+                for pi in removed.intersection(built):
+                    del built[pi]
+            self._pis.difference_update(removed)
+            for tb, built in zip(self._builders, self._built):
+                outdated = tb.get_outdated(self.m, list(built.keys()))
+                tb.prepare(self.m, outdated)
+                for pi in outdated:
+                    result = tb.build(self.m, pi)
+                    if result is None:
+                        del built[pi]
+                    else:
+                        built[pi] = result
+            self._build_particles([pi for pi in pis if pi not in self._pis])
+        self._assemble()
+
     def shuffle(self, sigma=1):
-        ny = HMCUtilities.free_dimension(self.joint_constraint)
-        y = np.random.normal(0, 1, size=ny)
-        x = HMCUtilities.constrain(self.joint_constraint, y)
+        ny = self.joint_constraint.free_dimension()
+        y = np.random.normal(0, sigma, size=ny)
+        x = self.joint_constraint.constrain(y)
         self.interface.set_values(x)
         self.m.update()
 
@@ -223,6 +473,54 @@ class OptimizedVariables(object):
     def get_interface(self):
         return self.interface
 
+    def get_indexes(self, particles=None, keys=None):
+        """Get the indexes of the optimized variables on the given particles
+        and/or with the given float keys."""
+        if particles is not None:
+            particles = set(IMP.get_indexes(particles))
+        if keys is not None:
+            keys = set(keys)
+        return [
+            i
+            for i, (fk, pi) in enumerate(self.optimized_key_index_pairs)
+            if (particles is None or pi in particles)
+            and (keys is None or fk in keys)
+        ]
+
+    def get_blocks(self, groups=None):
+        """Get blocks of indexes of free variables, e.g. for a
+        block-diagonal metric (see `IMP.hmc.metrics`).
+
+        By default, there is one block for the free variables of each
+        particle, so that, for example, the position and orientation of a
+        rigid body form a block. `groups` may instead be a list of lists of
+        particles or particle indexes, such as the domains of a protein,
+        giving one block per group."""
+        group_of = {}
+        if groups is not None:
+            for i, group in enumerate(groups):
+                for pi in _as_particle_indexes(group):
+                    group_of[pi] = i
+        blocks = {}
+        offset = 0
+        for pi, n in self._constraint_particles:
+            key = group_of.get(pi) if groups is not None else pi
+            if key is not None:
+                blocks.setdefault(key, []).extend(range(offset, offset + n))
+            offset += n
+        return [np.array(b, dtype=np.intp) for b in blocks.values()]
+
+    def get_free_scales(self):
+        """Get the typical scale of each free variable suggested by the
+        transformation builders, with NaN where it is unknown."""
+        scales = []
+        for tb, built in zip(self._builders, self._built):
+            for pi, (kp_pairs, c) in built.items():
+                scales.append(tb.get_free_scales(self.m, pi, kp_pairs, c))
+        if not scales:
+            return np.empty(0)
+        return np.concatenate(scales)
+
     def get_names(self):
         return [
             "{0}_{1}".format(
@@ -7,26 +7,101 @@
  */
 
 #include <IMP/hmc/SaveAttributesOptimizerState.h>
+#include <algorithm>
 
 IMPHMC_BEGIN_NAMESPACE
 
 SaveAttributesOptimizerState::SaveAttributesOptimizerState(
     ValueGradientInterface* interface)
     : OptimizerState(interface->get_model(), "SaveAttributesOptimizerState%1%"),
-      interface_(interface) {}
+      interface_(interface),
+      nsamples_(0) {}
+
+SaveAttributesOptimizerState::SaveAttributesOptimizerState(
+    ValueGradientInterface* interface, const Ints& indexes)
+    : OptimizerState(interface->get_model(), "SaveAttributesOptimizerState%1%"),
+      interface_(interface),
+      indexes_(indexes),
+      row_(interface->get_dimension()),
+      nsamples_(0) {
+  IMP_IF_CHECK(USAGE) {
+    for (unsigned int i = 0; i < indexes.size(); ++i) {
+      IMP_USAGE_CHECK(
+          indexes[i] >= 0 && indexes[i] < interface->get_dimension(),
+          "Index " << indexes[i] << " is out of range for the interface.");
+    }
+  }
+}
+
+void SaveAttributesOptimizerState::grow(unsigned int nsamples) {
+  std::size_t n = static_cast<std::size_t>(nsamples) * get_dimension();
+  if (n > data_.capacity()) {
+    data_.reserve(std::max(n, 2 * data_.capacity()));
+  }
+  data_.resize(n);
+}
 
 void SaveAttributesOptimizerState::do_update(unsigned int) {
-  const std::vector<double> vs = interface_->get_values();
-  Floats ret(vs.size());
-  for (unsigned int i = 0; i < vs.size(); ++i)
-    ret[i] = vs[i];
-  vs_.push_back(ret);
+  unsigned int d = get_dimension();
+  grow(nsamples_ + 1);
+  ++nsamples_;
+  if (d == 0) return;
+  double* row = &data_[static_cast<std::size_t>(nsamples_ - 1) * d];
+  if (indexes_.empty()) {
+    interface_->get_values_into(row, d);
+  } else {
+    interface_->get_values_into(&row_[0], row_.size());
+    for (unsigned int i = 0; i < d; ++i) row[i] = row_[indexes_[i]];
+  }
 }
 
 ValueGradientInterface* SaveAttributesOptimizerState::get_interface() {
   return interface_;
 }
 
-FloatsList SaveAttributesOptimizerState::get_values() const { return vs_; }
+Ints SaveAttributesOptimizerState::get_indexes() const { return indexes_; }
+
+unsigned int SaveAttributesOptimizerState::get_dimension() const {
+  if (indexes_.empty()) return interface_->get_dimension();
+  return indexes_.size();
+}
+
+unsigned int SaveAttributesOptimizerState::get_number_of_samples() const {
+  return nsamples_;
+}
+
+void SaveAttributesOptimizerState::reserve(unsigned int nsamples) {
+  data_.reserve(static_cast<std::size_t>(nsamples) * get_dimension());
+}
+
+void SaveAttributesOptimizerState::clear() {
+  data_.clear();
+  nsamples_ = 0;
+}
+
+FloatsList SaveAttributesOptimizerState::get_values() const {
+  unsigned int d = get_dimension();
+  FloatsList ret(nsamples_);
+  for (unsigned int i = 0; i < nsamples_; ++i) {
+    const double* row = &data_[static_cast<std::size_t>(i) * d];
+    ret[i] = Floats(row, row + d);
+  }
+  return ret;
+}
+
+void SaveAttributesOptimizerState::add_values_from(const double* data,
+                                                   unsigned int n) {
+  unsigned int d = get_dimension();
+  IMP_USAGE_CHECK(d > 0 && n % d == 0,
+                  "Buffer length must be a multiple of the dimension.");
+  std::size_t offset = data_.size();
+  grow(nsamples_ + n / d);
+  nsamples_ += n / d;
+  std::copy(data, data + n, data_.begin() + offset);
+}
+
+const double* SaveAttributesOptimizerState::get_data() const {
+  return data_.empty() ? nullptr : &data_[0];
+}
 
 IMPHMC_END_NAMESPACE
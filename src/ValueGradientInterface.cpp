@@ -7,6 +7,7 @@
  */
 
 #include <IMP/hmc/ValueGradientInterface.h>
+#include <map>
 
 IMPHMC_BEGIN_NAMESPACE
 
@@ -21,6 +22,28 @@ ValueGradientInterface::ValueGradientInterface(IMP::Model* m,
       gradx_(pis.size()) {
   IMP_USAGE_CHECK(pis.size() == fks.size(),
                   "Number of particle indexes and float keys must be equal.");
+  setup_key_groups();
+}
+
+void ValueGradientInterface::setup_key_groups() {
+  std::map<unsigned int, unsigned int> key_group;
+  for (unsigned int i = 0; i < fks_.size(); ++i) {
+    unsigned int k = fks_[i].get_index();
+    std::map<unsigned int, unsigned int>::const_iterator it =
+        key_group.find(k);
+    unsigned int g;
+    if (it == key_group.end()) {
+      g = group_keys_.size();
+      key_group[k] = g;
+      group_keys_.push_back(fks_[i]);
+      group_pis_.push_back(IMP::ParticleIndexes());
+      group_slots_.push_back(IMP::Ints());
+    } else {
+      g = it->second;
+    }
+    group_pis_[g].push_back(pis_[i]);
+    group_slots_[g].push_back(i);
+  }
 }
 
 int ValueGradientInterface::get_dimension() const { return x_.size(); }
@@ -31,22 +54,61 @@ IMP::ParticleIndexes ValueGradientInterface::get_particle_indexes() const {
   return pis_;
 }
 
+void ValueGradientInterface::get_values_into(double* data,
+                                             unsigned int n) const {
+  IMP_USAGE_CHECK(n == x_.size(),
+                  "Buffer must be same length as particle indexes.");
+  IMP::Model* m = get_model();
+  for (unsigned int g = 0; g < group_keys_.size(); ++g) {
+    const IMP::FloatKey fk = group_keys_[g];
+    const IMP::ParticleIndexes& pis = group_pis_[g];
+    const IMP::Ints& slots = group_slots_[g];
+    for (unsigned int j = 0; j < pis.size(); ++j)
+      data[slots[j]] = m->get_attribute(fk, pis[j]);
+  }
+}
+
+void ValueGradientInterface::set_values_from(const double* data,
+                                             unsigned int n) {
+  IMP_USAGE_CHECK(n == x_.size(),
+                  "Position vector must be same length as particle indexes.");
+  IMP::Model* m = get_model();
+  for (unsigned int g = 0; g < group_keys_.size(); ++g) {
+    const IMP::FloatKey fk = group_keys_[g];
+    const IMP::ParticleIndexes& pis = group_pis_[g];
+    const IMP::Ints& slots = group_slots_[g];
+    for (unsigned int j = 0; j < pis.size(); ++j)
+      m->set_attribute(fk, pis[j], data[slots[j]]);
+  }
+}
+
+void ValueGradientInterface::get_gradient_into(double* data,
+                                               unsigned int n) const {
+  IMP_USAGE_CHECK(n == gradx_.size(),
+                  "Buffer must be same length as particle indexes.");
+  IMP::Model* m = get_model();
+  for (unsigned int g = 0; g < group_keys_.size(); ++g) {
+    const IMP::FloatKey fk = group_keys_[g];
+    const IMP::ParticleIndexes& pis = group_pis_[g];
+    const IMP::Ints& slots = group_slots_[g];
+    for (unsigned int j = 0; j < pis.size(); ++j)
+      data[slots[j]] = m->get_derivative(fk, pis[j]);
+  }
+}
+
 IMP::Vector<double> ValueGradientInterface::get_values() const {
-  for (int i = 0; i < get_dimension(); ++i)
-    x_[i] = get_model()->get_attribute(fks_[i], pis_[i]);
+  if (!x_.empty()) get_values_into(&x_[0], x_.size());
   return x_;
 }
 
 void ValueGradientInterface::set_values(const IMP::Vector<double>& x) {
   IMP_USAGE_CHECK(x.size() == x_.size(),
                   "Position vector must be same length as particle indexes.");
-  for (int i = 0; i < get_dimension(); ++i)
-    get_model()->set_attribute(fks_[i], pis_[i], x[i]);
+  if (!x.empty()) set_values_from(&x[0], x.size());
 }
 
 IMP::Vector<double> ValueGradientInterface::get_gradient() const {
-  for (int i = 0; i < get_dimension(); ++i)
-    gradx_[i] = get_model()->get_derivative(fks_[i], pis_[i]);
+  if (!gradx_.empty()) get_gradient_into(&gradx_[0], gradx_.size());
   return gradx_;
 }
 
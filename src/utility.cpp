@@ -0,0 +1,29 @@
+/**
+ *  \file utility.cpp
+ *  \brief Utility functions for finding optimized attributes.
+ *
+ *  Copyright 2007-2019 IMP Inventors. All rights reserved.
+ *
+ */
+
+#include <IMP/hmc/utility.h>
+
+IMPHMC_BEGIN_NAMESPACE
+
+ParticleIndexes get_optimized_particle_indexes(Model* m, FloatKey k) {
+  return get_optimized_particle_indexes(m, k, m->get_particle_indexes());
+}
+
+ParticleIndexes get_optimized_particle_indexes(Model* m, FloatKey k,
+                                               const ParticleIndexes& pis) {
+  ParticleIndexes ret;
+  for (unsigned int i = 0; i < pis.size(); ++i) {
+    ParticleIndex pi = pis[i];
+    if (m->get_has_attribute(k, pi) && m->get_is_optimized(k, pi)) {
+      ret.push_back(pi);
+    }
+  }
+  return ret;
+}
+
+IMPHMC_END_NAMESPACE
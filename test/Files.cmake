@@ -1,3 +1,3 @@
-set(pyfiles "")
+set(pyfiles "${CMAKE_CURRENT_SOURCE_DIR}/test_initialization.py;${CMAKE_CURRENT_SOURCE_DIR}/test_metrics.py;${CMAKE_CURRENT_SOURCE_DIR}/test_nuts.py;${CMAKE_CURRENT_SOURCE_DIR}/test_store.py;${CMAKE_CURRENT_SOURCE_DIR}/test_tempering.py;${CMAKE_CURRENT_SOURCE_DIR}/test_transforms.py;${CMAKE_CURRENT_SOURCE_DIR}/test_variables.py")
 set(cppfiles "")
 set(cudafiles "")
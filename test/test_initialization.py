@@ -0,0 +1,90 @@
+import numpy as np
+
+import IMP
+import IMP.test
+import IMP.hmc
+from IMP.hmc import initialization
+
+
+class _Gaussian(object):
+
+    """Log density of a Gaussian with mean `mean` and covariance `cov`."""
+
+    def __init__(self, mean, cov):
+        self.mean = np.array(mean, dtype=np.double)
+        self.prec = np.linalg.inv(cov)
+        self.nevals = 0
+
+    def get_logpdf_with_gradient(self, x):
+        self.nevals += 1
+        g = self.prec.dot(x - self.mean)
+        return -0.5 * np.dot(x - self.mean, g), -g
+
+
+def _get_curvature_pairs(n, k):
+    """Get `k` random curvature pairs (s, y) with positive s^T y."""
+    A = np.random.normal(size=(n, n))
+    H = A.dot(A.T) + n * np.eye(n)
+    S = [np.random.normal(size=n) for _ in range(k)]
+    Y = [H.dot(s) + 0.1 * np.random.normal(size=n) for s in S]
+    return S, Y
+
+
+class Tests(IMP.test.TestCase):
+
+    def setUp(self):
+        IMP.test.TestCase.setUp(self)
+        np.random.seed(42)
+
+    def test_inverse_hessian_diagonal(self):
+        """Test the compact L-BFGS inverse Hessian diagonal"""
+        n = 8
+        for k in (1, 3, 8, 12):
+            S, Y = _get_curvature_pairs(n, k)
+            # columns of the inverse Hessian approximation from the two-loop
+            # recursion
+            Hinv = np.array(
+                [initialization._two_loop(e, S, Y) for e in np.eye(n)]
+            ).T
+            self.assertTrue(np.allclose(Hinv, Hinv.T))
+            diag = initialization.get_lbfgs_inverse_hessian_diagonal(S, Y)
+            self.assertTrue(np.allclose(diag, np.diag(Hinv)))
+            self.assertTrue(np.all(diag > 0))
+
+    def test_lbfgs_gaussian(self):
+        """Test L-BFGS finds the mode of a Gaussian"""
+        n = 10
+        A = np.random.normal(size=(n, n))
+        cov = A.dot(A.T) / n + 0.1 * np.eye(n)
+        mean = np.random.normal(size=n)
+        logpdf = _Gaussian(mean, cov)
+        result = initialization.lbfgs(logpdf, np.zeros(n), gtol=1e-8)
+        self.assertTrue(result.converged)
+        self.assertTrue(np.allclose(result.position, mean, atol=1e-5))
+        self.assertAlmostEqual(result.logp, 0.0, delta=1e-8)
+        self.assertEqual(result.nevals, logpdf.nevals)
+        self.assertEqual(len(result.inverse_hessian_diagonal), n)
+        self.assertTrue(np.all(result.inverse_hessian_diagonal > 0))
+
+    def test_lbfgs_diagonal_curvature(self):
+        """Test the L-BFGS diagonal approximates the variances of a
+        Gaussian with independent variables"""
+        var = np.array([0.5, 1.0, 2.0, 4.0])
+        logpdf = _Gaussian(np.zeros(4), np.diag(var))
+        result = initialization.lbfgs(
+            logpdf, np.ones(4), gtol=1e-10, ftol=0.0
+        )
+        self.assertTrue(
+            np.allclose(result.inverse_hessian_diagonal, var, rtol=0.05)
+        )
+
+    def test_lbfgs_no_pairs(self):
+        """Test L-BFGS at the mode has no curvature estimate"""
+        logpdf = _Gaussian(np.zeros(3), np.eye(3))
+        result = initialization.lbfgs(logpdf, np.zeros(3))
+        self.assertTrue(result.converged)
+        self.assertIsNone(result.inverse_hessian_diagonal)
+
+
+if __name__ == '__main__':
+    IMP.test.main()
@@ -0,0 +1,190 @@
+import numpy as np
+
+import IMP
+import IMP.test
+import IMP.hmc
+from IMP.hmc.adaptation import (
+    WelfordEstimator,
+    _get_diagonal,
+    _make_estimator,
+    merge_estimators,
+)
+from IMP.hmc.metrics import (
+    BlockDiagEuclideanMetric,
+    BlockEstimator,
+    LowRankEstimator,
+    LowRankEuclideanMetric,
+)
+
+
+def _get_block_inverse_metric(blocks, diag):
+    Minv = np.diag(diag)
+    for idx, B in blocks:
+        Minv[np.ix_(idx, idx)] = B
+    return Minv
+
+
+def _make_block_metric():
+    diag = np.array([1.0, 2.0, 0.5, 3.0, 1.5, 0.8, 2.5])
+    blocks = [
+        ([0, 3], [[1.0, 0.6], [0.6, 2.0]]),
+        ([5, 1], [[0.8, -0.3], [-0.3, 1.2]]),
+        ([2, 4, 6], [[1.0, 0.2, 0.1], [0.2, 0.5, 0.0], [0.1, 0.0, 2.0]]),
+    ]
+    return BlockDiagEuclideanMetric(diag, blocks), blocks, diag
+
+
+class Tests(IMP.test.TestCase):
+
+    def setUp(self):
+        IMP.test.TestCase.setUp(self)
+        np.random.seed(42)
+
+    def _check_metric(self, metric, Minv):
+        r = np.random.normal(size=len(Minv))
+        self.assertTrue(np.allclose(metric.velocity(r), Minv.dot(r)))
+        self.assertAlmostEqual(
+            metric.kinetic_energy(r), 0.5 * r.dot(Minv).dot(r), delta=1e-10
+        )
+        self.assertTrue(np.allclose(metric.get_diagonal(), np.diag(Minv)))
+        # momenta are distributed with covariance M = Minv^-1
+        p = np.array([metric.sample_momentum() for _ in range(40000)])
+        M = np.linalg.inv(Minv)
+        scale = np.sqrt(np.outer(np.diag(M), np.diag(M)))
+        self.assertTrue(np.all(np.abs(np.cov(p.T) - M) < 0.05 * scale))
+
+    def test_low_rank_metric(self):
+        """Test low-rank metric against the equivalent dense metric"""
+        diag = np.array([1.0, 0.5, 2.0, 1.5, 0.3])
+        factor = np.random.normal(size=(5, 2))
+        metric = LowRankEuclideanMetric(diag, factor)
+        self.assertEqual(metric.get_rank(), 2)
+        self._check_metric(metric, np.diag(diag) + factor.dot(factor.T))
+
+    def test_block_metric(self):
+        """Test block-diagonal metric against the equivalent dense metric"""
+        metric, blocks, diag = _make_block_metric()
+        self._check_metric(metric, _get_block_inverse_metric(blocks, diag))
+
+    def test_block_metric_invalid(self):
+        """Test invalid block-diagonal metrics are rejected"""
+        self.assertRaises(
+            ValueError,
+            BlockDiagEuclideanMetric,
+            np.ones(3),
+            [([0, 1], np.eye(2)), ([1, 2], np.eye(2))],
+        )
+        self.assertRaises(
+            ValueError,
+            BlockDiagEuclideanMetric,
+            np.ones(3),
+            [([0, 1], [[1.0, 2.0], [2.0, 1.0]])],
+        )
+
+    def _get_samples(self, n=6, nsamples=300):
+        A = np.random.normal(size=(n, n))
+        return np.random.normal(size=(nsamples, n)).dot(A) + 3.0
+
+    def test_welford_merge(self):
+        """Test merged Welford estimators match a single pass"""
+        x = self._get_samples()
+        for dense in (False, True):
+            full = WelfordEstimator(6, dense=dense)
+            parts = [WelfordEstimator(6, dense=dense) for _ in range(3)]
+            for i, xi in enumerate(x):
+                full.add_sample(xi)
+                parts[i % 3].add_sample(xi)
+            parts[0].merge(parts[1])
+            parts[0].merge(parts[2])
+            parts[0].merge(WelfordEstimator(6, dense=dense))
+            self.assertEqual(parts[0].count, full.count)
+            self.assertTrue(np.allclose(parts[0].mean, full.mean))
+            self.assertTrue(
+                np.allclose(parts[0].get_variance(), full.get_variance())
+            )
+
+    def test_block_estimator(self):
+        """Test the block estimator and its merge"""
+        x = self._get_samples()
+        blocks = [[0, 3], [5, 1]]
+        full = BlockEstimator(6, blocks)
+        parts = [BlockEstimator(6, blocks) for _ in range(2)]
+        for i, xi in enumerate(x):
+            full.add_sample(xi)
+            parts[i % 2].add_sample(xi)
+        parts[0].merge(parts[1])
+        cov = np.cov(x.T)
+        for est in (full, parts[0]):
+            metric = est.get_variance(regularize=False)
+            Minv = _get_block_inverse_metric(
+                [(b, cov[np.ix_(b, b)]) for b in blocks], np.diag(cov)
+            )
+            for i in range(6):
+                self.assertTrue(
+                    np.allclose(metric.velocity(np.eye(6)[i]), Minv[i])
+                )
+
+    def test_low_rank_estimator(self):
+        """Test the low-rank estimator and its merge"""
+        x = self._get_samples()
+        cov = np.cov(x.T)
+        # with a sketch as large as the dimension, the covariance is exact
+        full = LowRankEstimator(6, rank=6, sketch_size=6)
+        parts = [LowRankEstimator(6, rank=6, sketch_size=6) for _ in range(3)]
+        for i, xi in enumerate(x):
+            full.add_sample(xi)
+            parts[i % 3].add_sample(xi)
+        parts[0].merge(parts[1])
+        parts[0].merge(parts[2])
+        for est in (full, parts[0]):
+            self.assertEqual(est.count, len(x))
+            self.assertTrue(np.allclose(est.mean, x.mean(axis=0)))
+            metric = est.get_variance(regularize=False)
+            Minv = np.diag(metric.diag) + metric.factor.dot(metric.factor.T)
+            self.assertTrue(np.allclose(Minv, cov, rtol=1e-3, atol=1e-3))
+
+    def test_merge_estimators(self):
+        """Test pooling estimators of each metric for pooled warm-up"""
+        x = self._get_samples()
+        for metric in ("diag", "dense", "lowrank", "block"):
+            full = _make_estimator(metric, 6, 6, [[0, 3], [5, 1]])
+            parts = [
+                _make_estimator(metric, 6, 6, [[0, 3], [5, 1]])
+                for _ in range(3)
+            ]
+            for i, xi in enumerate(x):
+                full.add_sample(xi)
+                parts[i % 3].add_sample(xi)
+            pooled = merge_estimators(parts)
+            self.assertIs(type(pooled), type(full))
+            self.assertEqual(pooled.count, len(x))
+            # the pooled estimators are left unchanged
+            self.assertEqual(parts[0].count, 100)
+            self.assertTrue(
+                np.allclose(
+                    _get_diagonal(pooled.get_variance()),
+                    _get_diagonal(full.get_variance()),
+                )
+            )
+
+    def test_low_rank_estimator_leading(self):
+        """Test the low-rank estimator finds the leading correlation"""
+        n = 20
+        v = np.random.normal(size=n)
+        v /= np.linalg.norm(v)
+        x = np.random.normal(size=(2000, n)) + np.outer(
+            np.random.normal(size=2000) * 5.0, v
+        )
+        est = LowRankEstimator(n, rank=1)
+        for xi in x:
+            est.add_sample(xi)
+        metric = est.get_variance(regularize=False)
+        u = metric.factor[:, 0] / np.linalg.norm(metric.factor[:, 0])
+        self.assertGreater(abs(np.dot(u, v)), 0.95)
+        self.assertTrue(
+            np.allclose(metric.get_diagonal(), np.var(x, axis=0), rtol=0.1)
+        )
+
+
+if __name__ == '__main__':
+    IMP.test.main()
@@ -0,0 +1,200 @@
+import numpy as np
+
+import IMP
+import IMP.test
+import IMP.hmc
+from IMP.hmc import nuts
+
+
+class _Gaussian(object):
+
+    """Log density of a zero-mean Gaussian with covariance `cov`."""
+
+    def __init__(self, cov):
+        self.cov = np.array(cov, dtype=np.double)
+        self.prec = np.linalg.inv(self.cov)
+
+    def logpdf(self, x):
+        return -0.5 * np.dot(x, self.prec.dot(x))
+
+    def logpdf_with_gradient(self, x):
+        g = self.prec.dot(x)
+        return -0.5 * np.dot(x, g), -g
+
+
+def _make_hamiltonian(target, metric):
+    return nuts.Hamiltonian(
+        metric, target.logpdf, target.logpdf_with_gradient
+    )
+
+
+def _get_quadratic_part(prec):
+    def logpdf_with_gradient(x):
+        g = prec.dot(x)
+        return -0.5 * np.dot(x, g), -g
+
+    return logpdf_with_gradient
+
+
+def _make_split_hamiltonian(target, metric):
+    """Split the log density of `target` into a fast part with the diagonal
+    of its precision and a slow part with the off-diagonal terms."""
+    fast = np.diag(np.diag(target.prec))
+    return nuts.SplitHamiltonian(
+        metric,
+        target.logpdf,
+        target.logpdf_with_gradient,
+        _get_quadratic_part(fast),
+        _get_quadratic_part(target.prec - fast),
+    )
+
+
+class Tests(IMP.test.TestCase):
+
+    def setUp(self):
+        IMP.test.TestCase.setUp(self)
+        np.random.seed(42)
+
+    def test_leapfrog_reversible(self):
+        """Test the leapfrog integrator is reversible"""
+        target = _Gaussian([[1.0, 0.5], [0.5, 2.0]])
+        h = _make_hamiltonian(target, nuts.DiagEuclideanMetric([1.0, 0.5]))
+        z0 = nuts.make_phasepoint(h, [0.3, -1.2])
+        integrator = nuts.Leapfrog(0.1)
+        z = z0
+        for _ in range(10):
+            z = integrator.step(h, z, 0.1)
+        z = nuts.PhasePoint(z.position, -z.momentum, z.logp, z.grad)
+        for _ in range(10):
+            z = integrator.step(h, z, 0.1)
+        self.assertTrue(np.allclose(z.position, z0.position, atol=1e-10))
+        self.assertTrue(np.allclose(-z.momentum, z0.momentum, atol=1e-10))
+
+    def test_multiple_time_step_reversible(self):
+        """Test the multiple-time-step integrator is reversible"""
+        target = _Gaussian([[1.0, 0.5], [0.5, 2.0]])
+        h = _make_split_hamiltonian(
+            target, nuts.DiagEuclideanMetric([1.0, 0.5])
+        )
+        z0 = nuts.make_phasepoint(h, [0.3, -1.2])
+        integrator = nuts.MultipleTimeStepLeapfrog(0.2, n_fast_steps=3)
+        z = z0
+        for _ in range(10):
+            z = integrator.step(h, z, 0.2)
+        self.assertAlmostEqual(z.logp, target.logpdf(z.position), delta=1e-10)
+        self.assertTrue(np.allclose(z.grad, sum(z.grads)))
+        z = nuts.PhasePoint(z.position, -z.momentum, z.logp, z.grad, z.grads)
+        for _ in range(10):
+            z = integrator.step(h, z, 0.2)
+        self.assertTrue(np.allclose(z.position, z0.position, atol=1e-10))
+        self.assertTrue(np.allclose(-z.momentum, z0.momentum, atol=1e-10))
+
+    def test_multiple_time_step_single(self):
+        """Test one fast step per step is the leapfrog integrator"""
+        target = _Gaussian([[1.0, 0.5], [0.5, 2.0]])
+        h = _make_split_hamiltonian(target, nuts.UnitEuclideanMetric(2))
+        z = nuts.make_phasepoint(h, [0.3, -1.2])
+        z1 = nuts.MultipleTimeStepLeapfrog(0.3, n_fast_steps=1).step(h, z, 0.3)
+        z2 = nuts.Leapfrog(0.3).step(h, z, 0.3)
+        self.assertTrue(np.allclose(z1.position, z2.position, atol=1e-12))
+        self.assertTrue(np.allclose(z1.momentum, z2.momentum, atol=1e-12))
+
+    def _check_invariance(self, sampler, metric, ntransitions, split=False):
+        cov = np.array([[1.0, 0.8], [0.8, 2.0]])
+        target = _Gaussian(cov)
+        if split:
+            h = _make_split_hamiltonian(target, metric)
+        else:
+            h = _make_hamiltonian(target, metric)
+        x0 = np.random.multivariate_normal(np.zeros(2), cov, size=2000)
+        xs = np.empty_like(x0)
+        for i, x in enumerate(x0):
+            z = nuts.make_phasepoint(h, x)
+            for _ in range(ntransitions):
+                z, stats = sampler.transition(h, z)
+            xs[i] = z.position
+        # exact draws stay exact draws under a kernel in detailed balance
+        # with the target, so x^T cov^-1 x is still chi-squared with 2
+        # degrees of freedom (mean 2, variance 4)
+        chi2 = np.sum(xs.dot(target.prec) * xs, axis=1)
+        self.assertAlmostEqual(np.mean(chi2), 2.0, delta=0.2)
+        self.assertAlmostEqual(np.var(chi2), 4.0, delta=1.0)
+        self.assertTrue(np.allclose(xs.mean(axis=0), 0.0, atol=0.15))
+
+    def test_nuts_invariance(self):
+        """Test NUTS leaves a Gaussian invariant"""
+        sampler = nuts.NUTS(nuts.Leapfrog(0.6), max_depth=6)
+        self._check_invariance(sampler, nuts.UnitEuclideanMetric(2), 3)
+
+    def test_static_invariance(self):
+        """Test static HMC leaves a Gaussian invariant"""
+        sampler = nuts.StaticTrajectory(nuts.Leapfrog(0.3), n_steps=5)
+        self._check_invariance(sampler, nuts.DiagEuclideanMetric([1, 2]), 3)
+
+    def test_multiple_time_step_nuts_invariance(self):
+        """Test NUTS with multiple time steps leaves a Gaussian invariant"""
+        sampler = nuts.NUTS(
+            nuts.MultipleTimeStepLeapfrog(0.6, n_fast_steps=3), max_depth=6
+        )
+        self._check_invariance(
+            sampler, nuts.UnitEuclideanMetric(2), 10, split=True
+        )
+
+    def test_multiple_time_step_static_invariance(self):
+        """Test static HMC with multiple time steps leaves a Gaussian
+        invariant"""
+        sampler = nuts.StaticTrajectory(
+            nuts.MultipleTimeStepLeapfrog(0.3, n_fast_steps=2), n_steps=5
+        )
+        self._check_invariance(
+            sampler, nuts.DiagEuclideanMetric([1, 2]), 10, split=True
+        )
+
+    def test_nuts_moments(self):
+        """Test moments of a NUTS chain on a correlated Gaussian"""
+        cov = np.array([[1.0, 0.9, 0.0], [0.9, 1.0, 0.0], [0.0, 0.0, 4.0]])
+        target = _Gaussian(cov)
+        h = _make_hamiltonian(target, nuts.DenseEuclideanMetric(cov))
+        sampler = nuts.NUTS(nuts.Leapfrog(0.8))
+        z = nuts.make_phasepoint(h, np.zeros(3))
+        z, positions, keys, columns = nuts.sample_n(h, sampler, z, 4000)
+        stats = dict(zip(keys, columns))
+        self.assertEqual(len(positions), 4000)
+        self.assertFalse(np.any(stats["numerical_error"]))
+        self.assertGreater(np.mean(stats["acceptance_rate"]), 0.6)
+        self.assertTrue(np.allclose(positions.mean(axis=0), 0.0, atol=0.1))
+        self.assertTrue(
+            np.allclose(np.cov(positions.T), cov, rtol=0.1, atol=0.1)
+        )
+
+    def test_step_size_adaptation(self):
+        """Test warm-up adapts the step size and diagonal metric"""
+        target = _Gaussian(np.diag([1.0, 0.25]))
+        metric = nuts.DiagEuclideanMetric(2)
+        h = _make_hamiltonian(target, metric)
+        eps = nuts.find_good_eps(h, np.ones(2))
+        adaptor = nuts.StanHMCAdaptor(
+            500,
+            nuts.Preconditioner(metric),
+            nuts.NesterovDualAveraging(0.8, eps),
+        )
+        sampler = nuts.NUTS(nuts.Leapfrog(eps))
+        z = nuts.make_phasepoint(h, np.ones(2))
+        for _ in range(500):
+            z, stats = sampler.transition(h, z)
+            nuts.adapt_b(adaptor, z.position, stats["acceptance_rate"])
+            h = nuts.reconstruct(h, adaptor)
+            sampler = nuts.reconstruct(sampler, adaptor)
+        accept = []
+        for _ in range(500):
+            z, stats = sampler.transition(h, z)
+            accept.append(stats["acceptance_rate"])
+        # the averaged step size is on the cautious side of the target in
+        # low dimensions
+        self.assertGreater(np.mean(accept), 0.7)
+        self.assertLess(np.mean(accept), 0.98)
+        self.assertTrue(np.allclose(h.metric.Minv, [1.0, 0.25], rtol=0.5))
+
+
+if __name__ == '__main__':
+    IMP.test.main()
@@ -0,0 +1,171 @@
+import os
+
+import numpy as np
+
+import IMP
+import IMP.test
+import IMP.hmc
+from IMP.hmc.store import SampleStore, sample_to_store
+
+
+class _SampleSaver(object):
+
+    """Saves the position every `period` transitions."""
+
+    def __init__(self, nvars, period=1):
+        self.nvars = nvars
+        self.period = period
+        self.values = []
+
+    def get_period(self):
+        return self.period
+
+    def get_values_numpy(self):
+        return np.array(self.values, dtype=np.double).reshape(-1, self.nvars)
+
+    def clear(self):
+        self.values = []
+
+
+class _Stats(object):
+
+    def __init__(self):
+        self.samples = {"step": [], "acceptance_rate": []}
+
+    def get_samples(self, copy=True):
+        return {k: np.array(v) for k, v in self.samples.items()}
+
+    def clear(self):
+        for v in self.samples.values():
+            del v[:]
+
+
+class _HMC(object):
+
+    """Sampler whose position at transition `i` (counted over all chains
+    resumed from the same start) is `(i, -i)`."""
+
+    def __init__(self, start=0, period=1):
+        self.sample_saver = _SampleSaver(2, period)
+        self.stats = None
+        self.step = start
+        self.ntransitions = 0
+
+    def get_sample_names(self):
+        return ["x", "y"]
+
+    def set_save_samples(self, save):
+        pass
+
+    def optimize(self, n):
+        if self.stats is None:
+            self.stats = _Stats()
+        for _ in range(n):
+            self.step += 1
+            self.ntransitions += 1
+            if self.step % self.sample_saver.period == 0:
+                self.sample_saver.values.append([self.step, -self.step])
+            self.stats.samples["step"].append(self.step)
+            self.stats.samples["acceptance_rate"].append(0.5)
+
+
+class Tests(IMP.test.TestCase):
+
+    def _check_samples(self, store, steps):
+        posterior = store.get_posterior()[0]
+        n = store.get_chain_info(0)["nsamples"]
+        self.assertEqual(n, len(steps))
+        self.assertTrue(np.array_equal(posterior[0, :n], steps))
+        self.assertTrue(np.array_equal(posterior[1, :n], -steps))
+
+    def test_sample_to_store(self):
+        """Test sampling to a store in blocks"""
+        with IMP.test.temporary_directory() as tmpdir:
+            hmc = _HMC()
+            path = os.path.join(tmpdir, "store")
+            store = SampleStore.create_for_hmc(path, hmc, 100)
+            with store.get_writer() as writer:
+                sample_to_store(hmc, writer, 20, block_size=7)
+            self.assertEqual(hmc.ntransitions, 20)
+            store = SampleStore(path)
+            self._check_samples(store, np.arange(1, 21))
+            stats = store.get_stats(0)
+            self.assertTrue(np.array_equal(stats["step"], np.arange(1, 21)))
+            self.assertEqual(stats["acceptance_rate"].dtype, np.double)
+
+    def test_resume(self):
+        """Test a resumed chain only runs the remaining transitions"""
+        with IMP.test.temporary_directory() as tmpdir:
+            path = os.path.join(tmpdir, "store")
+            store = SampleStore.create(path, ["x", "y"], 100)
+            with store.get_writer() as writer:
+                sample_to_store(_HMC(period=2), writer, 10, block_size=4)
+            hmc = _HMC(start=10, period=2)
+            with SampleStore(path).get_writer() as writer:
+                self.assertEqual(writer.nsamples, 5)
+                sample_to_store(hmc, writer, 30, block_size=4)
+            self.assertEqual(hmc.ntransitions, 20)
+            store = SampleStore(path)
+            self._check_samples(store, np.arange(2, 31, 2))
+            self.assertTrue(
+                np.array_equal(store.get_stats(0)["step"], np.arange(1, 31))
+            )
+            # a complete chain is not extended
+            hmc = _HMC(start=30, period=2)
+            with store.get_writer() as writer:
+                sample_to_store(hmc, writer, 30)
+            self.assertEqual(hmc.ntransitions, 0)
+
+    def test_truncate_unflushed(self):
+        """Test statistics written after the last flush are discarded"""
+        with IMP.test.temporary_directory() as tmpdir:
+            path = os.path.join(tmpdir, "store")
+            store = SampleStore.create(path, ["x", "y"], 100)
+            writer = store.get_writer()
+            writer.add_samples(np.ones((5, 2)))
+            writer.add_stats({"step": np.arange(5)})
+            writer.flush()
+            writer.add_samples(np.ones((3, 2)))
+            writer.add_stats({"step": np.arange(5, 8)})
+            # crash after the data were written, but before the progress
+            for fh in writer._stats_files.values():
+                fh.close()
+            stat_path = store._get_stat_path(0, "step")
+            self.assertEqual(
+                os.path.getsize(stat_path), 8 * np.dtype(np.int64).itemsize
+            )
+
+            writer = SampleStore(path).get_writer()
+            self.assertEqual(writer.nsamples, 5)
+            self.assertEqual(writer.nstats, 5)
+            self.assertEqual(
+                os.path.getsize(stat_path), 5 * np.dtype(np.int64).itemsize
+            )
+            writer.add_stats({"step": np.arange(10, 12)})
+            writer.close()
+            self.assertTrue(
+                np.array_equal(
+                    store.get_stats(0)["step"], [0, 1, 2, 3, 4, 10, 11]
+                )
+            )
+
+    def test_max_samples(self):
+        """Test a chain cannot grow beyond the capacity of the store"""
+        with IMP.test.temporary_directory() as tmpdir:
+            path = os.path.join(tmpdir, "store")
+            store = SampleStore.create(path, ["x", "y"], 5)
+            with store.get_writer() as writer:
+                writer.add_samples(np.ones((3, 2)))
+                self.assertRaises(
+                    ValueError, writer.add_samples, np.ones((3, 2))
+                )
+                self.assertEqual(writer.nsamples, 3)
+                writer.add_samples(np.ones((2, 2)))
+            with store.get_writer() as writer:
+                self.assertRaises(
+                    ValueError, sample_to_store, _HMC(), writer, 10
+                )
+
+
+if __name__ == '__main__':
+    IMP.test.main()
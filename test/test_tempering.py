@@ -0,0 +1,143 @@
+import numpy as np
+
+import IMP
+import IMP.test
+import IMP.hmc
+from IMP.hmc import tempering
+
+
+class _Replica(object):
+
+    """Replica that does not move by itself, with log density
+    `-x^2 / 2`, so that only swaps change its position."""
+
+    def __init__(self, position):
+        self.position = np.array(position, dtype=np.double)
+
+    def run(self, nsteps):
+        logp = -0.5 * np.dot(self.position, self.position)
+        return self.position.copy(), float(logp)
+
+    def set_position(self, position):
+        self.position = np.array(position, dtype=np.double)
+
+    def set_beta(self, beta):
+        pass
+
+
+class _Proxy(object):
+
+    """Runs methods of a replica in this process with the interface of
+    `IMP.hmc.parallel.WorkerProxy`."""
+
+    def __init__(self, obj):
+        self.obj = obj
+        self._result = None
+
+    def call_async(self, method, *args, **kwargs):
+        self._result = getattr(self.obj, method)(*args, **kwargs)
+
+    def get_result(self):
+        result, self._result = self._result, None
+        return result
+
+    def call(self, method, *args, **kwargs):
+        self.call_async(method, *args, **kwargs)
+        return self.get_result()
+
+    def close(self):
+        pass
+
+
+def _make_exchange(positions, betas, seed=None):
+    return tempering.ReplicaExchange(
+        [_Proxy(_Replica([x])) for x in positions],
+        betas,
+        seed=seed,
+        log=lambda msg: None,
+    )
+
+
+class Tests(IMP.test.TestCase):
+
+    def test_geometric_ladder(self):
+        """Test geometric ladder of inverse temperatures"""
+        betas = tempering.get_geometric_ladder(5, beta_min=0.01)
+        self.assertAlmostEqual(betas[0], 1.0, delta=1e-12)
+        self.assertAlmostEqual(betas[-1], 0.01, delta=1e-12)
+        ratios = betas[1:] / betas[:-1]
+        self.assertTrue(np.allclose(ratios, ratios[0]))
+        self.assertTrue(np.allclose(tempering.get_geometric_ladder(1), [1]))
+
+    def test_swap_log_acceptance(self):
+        """Test swap acceptance against the ratio of tempered densities"""
+        np.random.seed(42)
+        for _ in range(20):
+            bi, bj = np.random.uniform(0.01, 1, size=2)
+            li, lj = np.random.normal(scale=10, size=2)
+            # log of pi_i(x_j) pi_j(x_i) / (pi_i(x_i) pi_j(x_j))
+            log_ratio = bi * lj + bj * li - bi * li - bj * lj
+            self.assertAlmostEqual(
+                tempering.get_swap_log_acceptance(bi, bj, li, lj),
+                min(0.0, log_ratio),
+                delta=1e-10,
+            )
+
+    def test_swaps_preserve_distribution(self):
+        """Test swaps leave the tempered distributions invariant"""
+        np.random.seed(42)
+        betas = np.array([1.0, 0.2])
+        cold, hot = [], []
+        naccepts = 0
+        for trial in range(4000):
+            # exact draws from N(0, 1 / beta)
+            positions = np.random.normal(size=2) / np.sqrt(betas)
+            rex = _make_exchange(positions, betas, seed=trial)
+            rex.run_round(1)
+            naccepts += rex.naccepts[0]
+            cold.append(rex.replicas[0].obj.position[0])
+            hot.append(rex.replicas[1].obj.position[0])
+        self.assertGreater(naccepts, 400)
+        self.assertLess(naccepts, 3600)
+        self.assertAlmostEqual(np.var(cold), 1.0, delta=0.1)
+        self.assertAlmostEqual(np.var(hot), 5.0, delta=0.5)
+
+    def test_swap_statistics(self):
+        """Test even and odd pairs alternate and round trips are counted"""
+        # with equal log densities every swap is accepted
+        rex = _make_exchange([0.0, 0.0, 0.0], [1.0, 0.5, 0.25], seed=1)
+        for _ in range(10):
+            rex.run_round(1)
+        stats = rex.get_swap_statistics()
+        self.assertEqual(list(stats["nattempts"]), [5, 5])
+        self.assertEqual(list(stats["naccepts"]), [5, 5])
+        self.assertTrue(np.allclose(stats["mean_accept_prob"], 1.0))
+        self.assertEqual(stats["nrounds"], 10)
+        self.assertGreater(stats["roundtrips"], 0)
+        rex.reset_swap_statistics()
+        self.assertEqual(list(rex.get_swap_statistics()["nattempts"]), [0, 0])
+
+    def test_adapt_ladder_equal_rates(self):
+        """Test a ladder with equal rejection rates is unchanged"""
+        betas = tempering.get_geometric_ladder(5, beta_min=0.05)
+        new = tempering.adapt_ladder(betas, [0.3] * 4)
+        self.assertTrue(np.allclose(new, betas))
+
+    def test_adapt_ladder(self):
+        """Test ladder adaptation equalizes the rejection rates"""
+        betas = tempering.get_geometric_ladder(4, beta_min=0.1)
+        rates = np.array([0.9, 0.1, 0.2])
+        new = tempering.adapt_ladder(betas, rates)
+        self.assertEqual(new[0], betas[0])
+        self.assertEqual(new[-1], betas[-1])
+        self.assertTrue(np.all(np.diff(new) < 0))
+        # replicas move towards the pair with the highest rejection rate
+        self.assertLess(np.log(new[0] / new[1]), np.log(betas[0] / betas[1]))
+        # the barrier, interpolated linearly in log(beta), is divided equally
+        barrier = np.concatenate([[0.0], np.cumsum(rates + 1e-6)])
+        at_new = np.interp(-np.log(new), -np.log(betas), barrier)
+        self.assertTrue(np.allclose(np.diff(at_new), barrier[-1] / 3))
+
+
+if __name__ == '__main__':
+    IMP.test.main()
@@ -0,0 +1,125 @@
+import numpy as np
+
+import IMP
+import IMP.test
+import IMP.hmc
+from IMP.hmc import transforms
+
+
+def _get_jacobian(f, y, eps=1e-6):
+    """Get the Jacobian of `f` at `y` by central finite differences."""
+    y = np.asarray(y, dtype=np.double)
+    cols = []
+    for i in range(len(y)):
+        dy = np.zeros_like(y)
+        dy[i] = eps
+        cols.append((f(y + dy) - f(y - dy)) / (2 * eps))
+    return np.array(cols).T
+
+
+def _get_gradient(f, y, eps=1e-6):
+    return _get_jacobian(lambda y: np.array([f(y)]), y, eps)[0]
+
+
+def _make_joint():
+    return transforms.JointConstraint(
+        transforms.IdentityConstraint(2),
+        transforms.LowerBoundedConstraint(1.0),
+        transforms.UnitVectorConstraint(3),
+        transforms.UpperBoundedConstraint(-2.0),
+        transforms.BoundedConstraint(-1.0, 3.0),
+        transforms.UnitSimplexConstraint(4),
+        transforms.UnitVectorConstraint(4, scale=2.5),
+        transforms.LowerBoundedConstraint(0.0),
+        transforms.UnitSimplexConstraint(3),
+    )
+
+
+class Tests(IMP.test.TestCase):
+
+    def setUp(self):
+        IMP.test.TestCase.setUp(self)
+        np.random.seed(42)
+
+    def test_scalar_log_jacobian(self):
+        """Test log-Jacobians of scalar constraints"""
+        c = transforms.JointConstraint(
+            transforms.IdentityConstraint(2),
+            transforms.LowerBoundedConstraint(1.0),
+            transforms.UpperBoundedConstraint(-2.0),
+            transforms.BoundedConstraint(-1.0, 3.0),
+            transforms.BoundedConstraint(10.0, 10.5),
+        )
+        for _ in range(5):
+            y = np.random.normal(size=c.free_dimension())
+            x, logjac = c.constrain_with_logjac(y)
+            J = _get_jacobian(c.constrain, y)
+            self.assertAlmostEqual(
+                logjac, np.log(abs(np.linalg.det(J))), delta=1e-6
+            )
+
+    def test_simplex_log_jacobian(self):
+        """Test log-Jacobian of the unit simplex constraint"""
+        for n in (2, 3, 5):
+            c = transforms.UnitSimplexConstraint(n)
+            y = np.random.normal(size=n - 1)
+            x, logjac = transforms.JointConstraint(c).constrain_with_logjac(y)
+            self.assertAlmostEqual(np.sum(x), 1.0, delta=1e-12)
+            self.assertTrue(np.all(x > 0))
+            # the last element is determined by the others
+            J = _get_jacobian(lambda y: c.constrain(y)[:-1], y)
+            self.assertAlmostEqual(
+                logjac, np.log(abs(np.linalg.det(J))), delta=1e-6
+            )
+
+    def test_unit_vector_log_jacobian(self):
+        """Test log-Jacobian of the scaled unit vector constraint"""
+        c = transforms.JointConstraint(
+            transforms.UnitVectorConstraint(4, scale=2.0)
+        )
+        y = np.random.normal(size=4)
+        x, logjac = c.constrain_with_logjac(y)
+        self.assertAlmostEqual(np.linalg.norm(x), 1.0, delta=1e-12)
+        self.assertAlmostEqual(logjac, -np.dot(y, y) / 8.0, delta=1e-12)
+
+    def test_round_trip(self):
+        """Test free is the inverse of constrain"""
+        c = _make_joint()
+        self.assertEqual(c.free_dimension(), 18)
+        self.assertEqual(c.dimension(), 20)
+        y = np.random.normal(size=c.free_dimension())
+        x = c.constrain(y)
+        self.assertTrue(np.allclose(c.constrain(c.free(x)), x, atol=1e-10))
+        # only the direction of the free unit vectors is recovered
+        y2 = c.free(x)
+        for s, e, scale in ((3, 6, 1.0), (11, 15, 2.5)):
+            self.assertAlmostEqual(
+                np.linalg.norm(y2[s:e]), scale, delta=1e-10
+            )
+            y2[s:e] = y[s:e]
+        self.assertTrue(np.allclose(y2, y, atol=1e-10))
+
+    def test_gradient(self):
+        """Test gradients in the free space against finite differences"""
+        c = _make_joint()
+        a = np.random.normal(size=c.dimension())
+
+        def logpdf_x(x):
+            return np.dot(a, x) - 0.5 * np.dot(x, x)
+
+        def logpdf_y(y):
+            x, push = c.constrain_with_pushlogpdf(y)
+            return push(logpdf_x(x))
+
+        for _ in range(5):
+            y = np.random.normal(size=c.free_dimension())
+            x, push = c.constrain_with_pushlogpdf_grad(y)
+            logp, grad = push(logpdf_x(x), a - x)
+            self.assertAlmostEqual(logp, logpdf_y(y), delta=1e-10)
+            self.assertTrue(
+                np.allclose(grad, _get_gradient(logpdf_y, y), atol=1e-5)
+            )
+
+
+if __name__ == '__main__':
+    IMP.test.main()
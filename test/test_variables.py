@@ -0,0 +1,109 @@
+import numpy as np
+
+import IMP
+import IMP.algebra
+import IMP.core
+import IMP.test
+import IMP.hmc
+from IMP.hmc.variables import (
+    OptimizedVariables,
+    UnitVectorScaledTransformationBuilder,
+)
+
+
+def _make_rigid_body(m, coords):
+    ps = [
+        IMP.core.XYZ.setup_particle(IMP.Particle(m), IMP.algebra.Vector3D(*c))
+        for c in coords
+    ]
+    return IMP.core.RigidBody.setup_particle(IMP.Particle(m), ps), ps
+
+
+def _get_baseline_scaling(rb, members):
+    center = rb.get_coordinates()
+    vs = np.array(
+        [list(IMP.core.XYZ(p).get_coordinates() - center) for p in members]
+    )
+    return 2 * np.std(vs, ddof=0)
+
+
+class Tests(IMP.test.TestCase):
+
+    def make_builder(self):
+        return UnitVectorScaledTransformationBuilder(
+            [
+                IMP.FloatKey("rigid_body_quaternion_{0}".format(i))
+                for i in range(4)
+            ]
+        )
+
+    def test_scaling_flat(self):
+        """Test scaling of a rigid body without nested bodies"""
+        m = IMP.Model()
+        rb, ps = _make_rigid_body(
+            m, [(0, 0, 0), (4, 0, 0), (0, 3, 1), (1, -2, 5)]
+        )
+        builder = self.make_builder()
+        self.assertAlmostEqual(
+            builder.compute_scaling(m, rb.get_particle_index()),
+            _get_baseline_scaling(rb, rb.get_rigid_members()),
+            delta=1e-6,
+        )
+
+    def test_scaling_nested(self):
+        """Test scaling of a rigid body includes nested body members"""
+        m = IMP.Model()
+        inner, inner_ps = _make_rigid_body(
+            m, [(10, 0, 0), (12, 1, 0), (11, -1, 3)]
+        )
+        outer, outer_ps = _make_rigid_body(m, [(0, 0, 0), (-3, 2, 1)])
+        outer.add_member(inner)
+        builder = self.make_builder()
+        leaves = builder.get_leaf_member_indexes(
+            m, outer.get_particle_index()
+        )
+        self.assertEqual(
+            sorted(leaves),
+            sorted(p.get_particle_index() for p in outer_ps + inner_ps),
+        )
+        # same as the baseline computation over the leaf members
+        self.assertAlmostEqual(
+            builder.compute_scaling(m, outer.get_particle_index()),
+            _get_baseline_scaling(outer, outer_ps + inner_ps),
+            delta=1e-6,
+        )
+        # which differs from the baseline over the direct members, which
+        # stood in for a nested body with its center
+        self.assertNotAlmostEqual(
+            builder.compute_scaling(m, outer.get_particle_index()),
+            _get_baseline_scaling(outer, outer.get_rigid_members()),
+            delta=1e-6,
+        )
+
+    def test_scaling_per_model(self):
+        """Test scalings are not shared between models"""
+        scales = []
+        for size in (1.0, 5.0):
+            m = IMP.Model()
+            # the same name and particle indexes in both models
+            m.set_name("model")
+            rb, ps = _make_rigid_body(
+                m, [(0, 0, 0), (size, 0, 0), (0, size, 2 * size)]
+            )
+            rb.set_coordinates_are_optimized(True)
+            scales.append(np.nanmax(OptimizedVariables(m).get_free_scales()))
+        self.assertAlmostEqual(scales[1], 5 * scales[0], delta=1e-6)
+
+    def test_copy(self):
+        """Test builder copies do not share cached scalings"""
+        builder = self.make_builder()
+        other = builder.copy()
+        m = IMP.Model()
+        rb, ps = _make_rigid_body(m, [(0, 0, 0), (4, 0, 0), (0, 3, 1)])
+        builder.compute_scaling(m, rb.get_particle_index())
+        self.assertEqual(len(builder._scalings), 1)
+        self.assertEqual(len(other._scalings), 0)
+
+
+if __name__ == '__main__':
+    IMP.test.main()